@@ -42,12 +42,12 @@ check_and_install_dependencies()
 
 # --- 2. SERVER IMPORTS ---
 import server_config as cfg
-import server_state as state
 import server_utils as utils
 import server_db as db_mod
 import server_logic as logic
 from server_logger import logger
 from server_voice import voice_server
+from server_file_index import file_index
 
 # --- HELPER FOR PUBLIC IP ---
 def get_public_ip():
@@ -110,7 +110,8 @@ def open_firewall_ports():
 
 def handle_client(conn, addr):
     """Обработка подключения клиента"""
-    current_user_id = None
+    session = utils.ClientSession(conn, addr)
+    session.start_writer()
     logger.info(f"New connection from {addr}")
     
     try:
@@ -118,50 +119,18 @@ def handle_client(conn, addr):
             req = utils.recv_json(conn)
             if not req: break
             
-            # Специальная обработка для первичного подключения
-            if req.get('action') == 'connect_user':
-                current_user_id = req['payload']['id']
-                with state.clients_lock:
-                    state.connected_clients[current_user_id] = conn
-                    state.online_users.add(current_user_id)
-                
-                utils.send_json(conn, {"status": "ok", "msg": "Connected"})
-                
-                # Уведомляем всех, что я онлайн
-                utils.broadcast_all({"event": "user_status", "user_id": current_user_id, "status": "online"})
-                
-                # Отправляем мне список тех, кто УЖЕ онлайн
-                with state.clients_lock:
-                    for online_uid in state.online_users:
-                        if online_uid != current_user_id:
-                            utils.send_json(conn, {"event": "user_status", "user_id": online_uid, "status": "online"})
-                
-                logger.info(f"User {current_user_id} connected")
-                continue
-            
-            # Обработка остальных запросов
-            response = logic.process_request(req)
-            utils.send_json(conn, response)
+            # connect_user и остальные действия идут через общий реестр
+            response = logic.process_request(req, session)
+            if response is not None:
+                session.send_json(response, critical=True)
             
     except Exception as e:
         logger.error(f"Error handling client {addr}: {e}")
     finally:
         # Очистка при отключении
-        if current_user_id:
-            # Выход из голосового канала
-            voice_server.leave_channel(current_user_id)
-            
-            with state.clients_lock:
-                if current_user_id in state.connected_clients: 
-                    del state.connected_clients[current_user_id]
-                if current_user_id in state.online_users: 
-                    state.online_users.remove(current_user_id)
-            
-            # Уведомление об оффлайне
-            utils.broadcast_all({"event": "user_status", "user_id": current_user_id, "status": "offline"})
-            logger.info(f"User {current_user_id} disconnected")
-        
-        conn.close()
+        logic.handle_disconnect(session)
+        # Писатель дописывает уже поставленные кадры и сам закрывает сокет
+        session.close_and_drain(cfg.CLIENT_DRAIN_TIMEOUT)
 
 def start_server():
     """Запуск основного цикла сервера"""
@@ -174,6 +143,7 @@ def start_server():
     
     db_mod.init_db()
     voice_server.start()
+    file_index.start()
     
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
@@ -197,6 +167,7 @@ def start_server():
     Listening on: {cfg.HOST}
     TCP Port: {cfg.PORT}
     UDP Voice Port: {cfg.VOICE_PORT}
+    Network core: {cfg.SERVER_MODE}
     Database: {cfg.DB_NAME}
     =========================================
     Logs are being written to logs/server.log
@@ -206,10 +177,15 @@ def start_server():
     logger.info(f"Сервер NovCord запущен на {cfg.HOST}:{cfg.PORT} (Public IPP: {public_ip})")
     
     try:
-        while True:
-            conn, addr = server.accept()
-            # Запускаем обработку клиента в отдельном потоке
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+        if cfg.SERVER_MODE == "async":
+            # Один event loop на все подключения, работа с БД - в пуле потоков
+            import server_async
+            server_async.serve(server)
+        else:
+            while True:
+                conn, addr = server.accept()
+                # Запускаем обработку клиента в отдельном потоке
+                threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
     except KeyboardInterrupt:
         print("\n[INFO] Stopping server...")
     except Exception as e:
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import server_config as cfg
+import server_utils as utils
+import server_logic as logic
+from server_logger import logger
+
+# Обработчики запросов блокирующие (SQLite, файлы), поэтому выполняются
+# в ограниченном пуле потоков, а event loop занимается только сетью.
+executor = ThreadPoolExecutor(max_workers=cfg.ASYNC_DB_WORKERS, thread_name_prefix="novcord-db")
+
+class AsyncSession(utils.ClientSession):
+    """
+    Сессия asyncio-подключения. Учёт очереди и политика медленных клиентов
+    общие с ClientSession; кадры передаются в event loop и пишутся корутиной writer_loop.
+    send_frame() можно вызывать из любого потока (broadcast_* из обработчиков).
+    """
+    def __init__(self, loop, writer, addr):
+        super().__init__(writer, addr)
+        self.loop = loop
+        self.writer = writer
+        self.outbox = asyncio.Queue()
+
+    def _push(self, frame):
+        self.loop.call_soon_threadsafe(self.outbox.put_nowait, frame)
+
+    async def writer_loop(self):
+        try:
+            while True:
+                frame = await self.outbox.get()
+                if frame is None: break
+                self.writer.write(frame)
+                await self.writer.drain()
+                self.frame_sent()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+
+    def close(self):
+        with self._lock:
+            if self.closed: return
+            self.closed = True
+        self.loop.call_soon_threadsafe(self.outbox.put_nowait, None)
+
+    def abort(self):
+        self.close()
+        self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+async def read_frame(reader):
+    """Читает один JSON-кадр с 4-байтовым префиксом длины (как utils.recv_json)"""
+    header = await reader.readexactly(4)
+    msglen = struct.unpack('>I', header)[0]
+    data = await reader.readexactly(msglen)
+    return json.loads(data.decode('utf-8'))
+
+async def handle_client(reader, writer):
+    loop = asyncio.get_running_loop()
+    addr = writer.get_extra_info('peername')
+    session = AsyncSession(loop, writer, addr)
+    writer_task = asyncio.create_task(session.writer_loop())
+    logger.info(f"New connection from {addr}")
+
+    try:
+        while True:
+            try:
+                req = await read_frame(reader)
+            except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+                break
+            if not req: break
+
+            response = await loop.run_in_executor(executor, logic.process_request, req, session)
+            if response is not None:
+                session.send_json(response, critical=True)
+    except Exception as e:
+        logger.error(f"Error handling client {addr}: {e}")
+    finally:
+        await loop.run_in_executor(executor, logic.handle_disconnect, session)
+        session.close()
+        await writer_task
+        writer.close()
+
+async def serve_forever(server_socket):
+    server = await asyncio.start_server(handle_client, sock=server_socket)
+    async with server:
+        await server.serve_forever()
+
+def serve(server_socket):
+    """Запускает asyncio-ядро на уже привязанном и слушающем сокете"""
+    asyncio.run(serve_forever(server_socket))
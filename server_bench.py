@@ -0,0 +1,425 @@
+"""
+Нагрузочные замеры сервера NovCord.
+Запуск: python server_bench.py db [--requests N] [--messages N] [--threads N]
+        python server_bench.py tcp --mode threaded|async [--clients N] [--idle N]
+        python server_bench.py voice [--workers N] [--streams N] [--channel-size N] [--rate PPS]
+        python server_bench.py mix [--sizes 10,30,100] [--speakers N]   (forward / select / mix)
+        python server_bench.py search [--messages N] [--queries N]
+
+Все замеры идут на временной копии БД, рабочая novcord_server.db не трогается.
+"""
+import os
+import sys
+import time
+import random
+import json
+import shutil
+import sqlite3
+import argparse
+import threading
+import tempfile
+from datetime import datetime
+import server_config as cfg
+
+def make_temp_db():
+    """Переключает сервер на пустую БД во временной папке"""
+    tmp_dir = tempfile.mkdtemp(prefix="novcord_bench_")
+    cfg.DB_NAME = os.path.join(tmp_dir, "bench.db")
+    return tmp_dir
+
+def seed_chat_data(users, messages):
+    """Заполняет БД пользователями, одной группой и сообщениями"""
+    conn = sqlite3.connect(cfg.DB_NAME)
+    cur = conn.cursor()
+    now = str(datetime.now())
+    cur.executemany("INSERT INTO users (id, email, username, discriminator, password_hash, avatar_color, created_at) VALUES (?,?,?,?,?,?,?)",
+                    [(i, f"bench{i}@novcord", f"bench{i}", "0001", "x", "#5865F2", now) for i in range(1, users + 1)])
+    cur.execute("INSERT INTO groups (id, name, owner_id, avatar_color) VALUES (1, 'bench', 1, '#5865F2')")
+    cur.executemany("INSERT INTO group_members (group_id, user_id) VALUES (1, ?)", [(i,) for i in range(1, users + 1)])
+    cur.executemany("INSERT INTO friends (user_id, friend_id, status) VALUES (?, ?, 'accepted')", [(1, i) for i in range(2, users + 1)])
+    rows = []
+    for i in range(messages):
+        sender = random.randint(1, users)
+        if i % 2:
+            rows.append((sender, 1, 'group', f"group message {i}", now))
+        else:
+            rows.append((sender, 1 if sender != 1 else 2, 'private', f"private message {i}", now))
+    cur.executemany("INSERT INTO messages (sender_id, target_id, target_type, content, timestamp) VALUES (?,?,?,?,?)", rows)
+    conn.commit()
+    conn.close()
+
+def run_requests(logic, count, users):
+    """Смешанная нагрузка: отправка, чтение чата, список друзей, отметка о прочтении"""
+    start = time.perf_counter()
+    for i in range(count):
+        uid = random.randint(1, users)
+        kind = i % 4
+        if kind == 0:
+            logic.process_request({"action": "send_msg", "payload": {"sender": uid, "target": 1, "type": "group", "text": "bench"}})
+        elif kind == 1:
+            logic.process_request({"action": "get_chat", "payload": {"my_id": uid, "target_id": 1 if uid != 1 else 2, "target_type": "private"}})
+        elif kind == 2:
+            logic.process_request({"action": "get_friends_data", "payload": {"id": uid}})
+        else:
+            logic.process_request({"action": "check_ban_status", "payload": {"id": uid}})
+    return count / (time.perf_counter() - start)
+
+def run_concurrent(logic, count, users, threads):
+    """Делит нагрузку между потоками, как при нескольких подключённых клиентах"""
+    if threads <= 1:
+        return run_requests(logic, count, users)
+    per_thread = count // threads
+    workers = [threading.Thread(target=run_requests, args=(logic, per_thread, users)) for _ in range(threads)]
+    start = time.perf_counter()
+    for w in workers: w.start()
+    for w in workers: w.join()
+    return per_thread * threads / (time.perf_counter() - start)
+
+def set_pool_sizes(db_mod, read_size, write_size):
+    for pool, size in ((db_mod.read_pool, read_size), (db_mod.write_pool, write_size)):
+        pool.close_all()
+        pool.size = size
+
+def bench_db(args):
+    import server_db as db_mod
+    import server_logic as logic
+
+    results = {}
+    modes = (("connect-per-request", 0, 0), ("pool + WAL", cfg.DB_READ_POOL_SIZE, 1))
+    for label, read_size, write_size in modes:
+        tmp_dir = make_temp_db()
+        try:
+            set_pool_sizes(db_mod, read_size, write_size)
+            db_mod.init_db()
+            random.seed(1)
+            seed_chat_data(args.users, args.messages)
+            results[label] = run_concurrent(logic, args.requests, args.users, args.threads)
+        finally:
+            set_pool_sizes(db_mod, read_size, write_size)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    for label, rps in results.items():
+        print(f"{label:>22}: {rps:10.1f} req/s")
+
+def bench_tcp(args):
+    """Поднимает TCP-ядро на временной БД: idle-подключения + активные клиенты"""
+    import socket
+    import server_utils as utils
+    import server_db as db_mod
+    import server_logic as logic
+    import main as server_main
+
+    cfg.SERVER_MODE = args.mode
+    tmp_dir = make_temp_db()
+    db_mod.init_db()
+    random.seed(1)
+    seed_chat_data(args.clients, args.messages)
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1024)
+    port = server.getsockname()[1]
+
+    def accept_loop():
+        if args.mode == "async":
+            import server_async
+            server_async.serve(server)
+        else:
+            while True:
+                conn, addr = server.accept()
+                threading.Thread(target=server_main.handle_client, args=(conn, addr), daemon=True).start()
+    threading.Thread(target=accept_loop, daemon=True).start()
+
+    idle = [socket.create_connection(("127.0.0.1", port)) for _ in range(args.idle)]
+    time.sleep(0.5)
+    server_threads = threading.active_count() - 1
+    latencies = []
+
+    def client(uid, count):
+        sock = socket.create_connection(("127.0.0.1", port))
+        for i in range(count):
+            start = time.perf_counter()
+            utils.send_json(sock, {"action": "get_chat", "payload": {"my_id": uid, "target_id": 1, "target_type": "group", "limit": 50}})
+            utils.recv_json(sock)
+            latencies.append(time.perf_counter() - start)
+        sock.close()
+
+    per_client = args.requests // args.clients
+    workers = [threading.Thread(target=client, args=(uid, per_client)) for uid in range(1, args.clients + 1)]
+    start = time.perf_counter()
+    for w in workers: w.start()
+    for w in workers: w.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"mode={args.mode} idle={args.idle} clients={args.clients} server threads={server_threads}")
+    print(f"  {len(latencies) / elapsed:10.1f} req/s   p50 {latencies[len(latencies) // 2] * 1000:.2f} ms   p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms")
+    for sock in idle: sock.close()
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def serve_voice(port, workers, streams, channel_size):
+    """Голосовой сервер для bench_voice (запускается в дочернем процессе, чтобы мерить его CPU отдельно)"""
+    cfg.HOST, cfg.VOICE_PORT, cfg.VOICE_WORKERS = "127.0.0.1", port, workers
+    from server_voice import voice_server
+    voice_server.start()
+    for uid in range(1, streams + 1):
+        voice_server.join_channel(uid, f"bench_{(uid - 1) // channel_size}")
+    print("ready", flush=True)
+    sys.stdin.read()   # работаем, пока родитель не закроет stdin
+    # Итоговые счётчики сервера - чтобы отделить отброшенное политикой (тишина, top-K) от потерь
+    channels = voice_server.get_stats()["channels"].values()
+    totals = {key: sum(c[key] for c in channels) for key in ("packets_in", "packets_out", "dropped")}
+    print(json.dumps(totals), flush=True)
+
+def bench_voice(args):
+    """
+    UDP-нагрузка на голосовой сервер: streams отправителей по каналам из channel_size человек,
+    каждый шлёт пакеты payload байт с частотой rate (0 - без ограничения).
+    """
+    import socket
+    import selectors
+    import subprocess
+
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    code = f"import server_bench; server_bench.serve_voice({port}, {args.workers}, {args.streams}, {args.channel_size})"
+    server = subprocess.Popen([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    server.stdout.readline()
+
+    socks = []
+    for uid in range(1, args.streams + 1):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.bind(("127.0.0.1", 0))
+        sock.setblocking(False)
+        sock.sendto(f"VOICE_INIT:{uid}".encode(), ("127.0.0.1", port))
+        socks.append(sock)
+    time.sleep(0.3)
+
+    sent, received = [0], [0]
+    stop = threading.Event()
+
+    def sender():
+        packet = os.urandom(args.payload)
+        interval = 1.0 / args.rate if args.rate else 0
+        next_tick = time.perf_counter()
+        while not stop.is_set():
+            for sock in socks:
+                try: sock.sendto(packet, ("127.0.0.1", port)); sent[0] += 1
+                except BlockingIOError: pass
+            if interval:
+                next_tick += interval
+                delay = next_tick - time.perf_counter()
+                if delay > 0: time.sleep(delay)
+
+    def receiver():
+        sel = selectors.DefaultSelector()
+        for sock in socks: sel.register(sock, selectors.EVENT_READ)
+        while not stop.is_set():
+            for key, _ in sel.select(0.1):
+                while True:
+                    try: key.fileobj.recv(4096)
+                    except BlockingIOError: break
+                    received[0] += 1
+
+    threads = [threading.Thread(target=sender), threading.Thread(target=receiver)]
+    start = time.perf_counter()
+    for t in threads: t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - start
+
+    server.stdin.close()
+    totals = json.loads(server.stdout.readline())
+    server.wait()
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    server_cpu = usage.ru_utime + usage.ru_stime
+    for sock in socks: sock.close()
+
+    # Потери - только то, что не дошло: кадры, отброшенные политикой (VOICE_SILENCE_LEVEL,
+    # VOICE_MAX_SPEAKERS), сервер не пересылает намеренно и в потери не входят
+    fanout = min(args.channel_size, args.streams) - 1
+    expected = (sent[0] - totals["dropped"]) * fanout
+    loss = 100.0 * max(0.0, 1 - received[0] / expected) if expected else 0.0
+    policy = 100.0 * totals["dropped"] / totals["packets_in"] if totals["packets_in"] else 0.0
+    print(f"workers={args.workers} streams={args.streams} channel={args.channel_size} rate={args.rate or 'max'} payload={args.payload}B")
+    print(f"  in {sent[0] / elapsed:10.1f} pkt/s   out {received[0] / elapsed:10.1f} pkt/s   loss {loss:.1f}%")
+    print(f"  dropped by policy {totals['dropped']} frames ({policy:.1f}% of received)   server in {totals['packets_in']} / out {totals['packets_out']}")
+    print(f"  server CPU {100 * server_cpu / elapsed:.1f}%   per stream {100 * server_cpu / elapsed / args.streams:.2f}%")
+
+def bench_mix(args):
+    """
+    Исходящий трафик и CPU группового звонка: пересылка всего (forward), пересылка с отбором
+    говорящих (select) и микширование (mix). Все участники шлют кадры (открытые микрофоны),
+    громкие - только speakers из них, у остальных тишина.
+    Моделируется seconds секунд звонка кадрами по VOICE_MIX_FRAME_MS; пакеты реально
+    уходят через sendto на локальные UDP-сокеты, которые их не читают.
+    """
+    import array
+    import socket
+    import struct
+    import server_voice
+
+    if server_voice.np is None:
+        print("numpy не установлен - режим микширования недоступен, замер только для пересылки")
+    voice = array.array('h', [random.randint(-8000, 8000) for _ in range(args.frame_bytes // 2)]).tobytes()
+    silence = array.array('h', [random.randint(-40, 40) for _ in range(args.frame_bytes // 2)]).tobytes()
+    slots = int(args.seconds * 1000 / cfg.VOICE_MIX_FRAME_MS)
+    silence_level = cfg.VOICE_SILENCE_LEVEL or 300
+    print(f"{'participants':>12} {'mode':>8} {'egress MB/s':>12} {'pkt/s':>10} {'CPU %':>7}")
+    for size in [int(n) for n in args.sizes.split(",")]:
+        speakers = min(args.speakers or size, size)
+        for mode in ("forward", "select", "mix"):
+            if mode == "mix" and server_voice.np is None: continue
+            cfg.VOICE_MIX_THRESHOLD = 2 if mode == "mix" else 0
+            cfg.VOICE_SILENCE_LEVEL = silence_level if mode == "select" else 0
+            vs = server_voice.VoiceServer()
+            vs.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            vs.sock.bind(("127.0.0.1", 0))
+            sinks = []
+            for uid in range(1, size + 1):
+                sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sink.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+                sink.bind(("127.0.0.1", 0))
+                sinks.append(sink)
+                vs.register_addr(uid, sink.getsockname())
+                vs.join_channel(uid, "bench_group")
+            senders = [(vs.routes[sink.getsockname()], memoryview(voice if i < speakers else silence))
+                       for i, sink in enumerate(sinks)]
+
+            sent_bytes = sent_packets = 0
+            cpu_start = time.process_time()
+            for tick in range(slots):
+                now = tick * cfg.VOICE_MIX_FRAME_MS / 1000
+                for (sender_id, targets, mixer, floor, stats), frame in senders:
+                    if floor is not None and not floor.admit(sender_id, server_voice.frame_level(frame, len(frame)), now):
+                        continue
+                    if mixer is not None:
+                        mixer.push(sender_id, bytes(frame))
+                        continue
+                    packet = struct.pack('>I', sender_id) + frame
+                    for addr in targets:
+                        vs.sock.sendto(packet, addr)
+                    sent_bytes += len(packet) * len(targets); sent_packets += len(targets)
+                for mixer in vs.mixers.values():
+                    for addr, packet in mixer.mix():
+                        vs.sock.sendto(packet, addr)
+                        sent_bytes += len(packet); sent_packets += 1
+            cpu = time.process_time() - cpu_start
+            cfg.VOICE_SILENCE_LEVEL = silence_level
+
+            print(f"{size:>12} {mode:>8} {sent_bytes / args.seconds / 1e6:12.2f} {sent_packets / args.seconds:10.0f} {100 * cpu / args.seconds:7.1f}")
+            for sink in sinks: sink.close()
+            vs.sock.close()
+
+SEARCH_WORDS = ("привет", "концерт", "завтра", "встреча", "файл", "игра", "сервер", "музыка", "фото", "голос",
+                "hello", "meeting", "update", "release", "build", "deploy", "ticket", "voice", "stream", "lunch")
+
+def bench_search(args):
+    import server_db as db_mod
+    import server_logic as logic
+
+    tmp_dir = make_temp_db()
+    try:
+        db_mod.init_db()
+        random.seed(1)
+        seed_chat_data(args.users, 0)
+        # Словарь: частые слова из SEARCH_WORDS и длинный хвост редких токенов
+        conn = sqlite3.connect(cfg.DB_NAME)
+        now = str(datetime.now())
+        started = time.perf_counter()
+        batch = []
+        for i in range(args.messages):
+            words = [random.choice(SEARCH_WORDS) for _ in range(3)] + [f"w{random.randint(0, 200000)}" for _ in range(5)]
+            random.shuffle(words)
+            sender = random.randint(1, args.users)
+            if i % 2: batch.append((sender, 1, 'group', " ".join(words), now))
+            else: batch.append((sender, 1 if sender != 1 else 2, 'private', " ".join(words), now))
+            if len(batch) >= 50000:
+                conn.executemany("INSERT INTO messages (sender_id, target_id, target_type, content, timestamp) VALUES (?,?,?,?,?)", batch)
+                conn.commit(); batch = []
+        if batch:
+            conn.executemany("INSERT INTO messages (sender_id, target_id, target_type, content, timestamp) VALUES (?,?,?,?,?)", batch)
+            conn.commit()
+        insert_time = time.perf_counter() - started
+        started = time.perf_counter()
+        db_mod.rebuild_message_index(conn.cursor()); conn.commit()
+        rebuild_time = time.perf_counter() - started
+        conn.close()
+        print(f"{args.messages} messages: insert with triggers {insert_time:.1f}s, fts-rebuild {rebuild_time:.1f}s, "
+              f"db {os.path.getsize(cfg.DB_NAME) / 1e6:.0f} MB")
+
+        kinds = {
+            "rare word": lambda: f"w{random.randint(0, 200000)}",
+            "common word": lambda: random.choice(SEARCH_WORDS),
+            "two words": lambda: f"{random.choice(SEARCH_WORDS)} {random.choice(SEARCH_WORDS)}",
+            "prefix": lambda: random.choice(SEARCH_WORDS)[:3],
+        }
+        for label, make_query in kinds.items():
+            for scope in ("all chats", "one chat"):
+                times = []
+                for _ in range(args.queries):
+                    payload = {"user_id": random.randint(1, args.users), "query": make_query()}
+                    if scope == "one chat": payload.update(target_id=1, target_type="group")
+                    t = time.perf_counter()
+                    res = logic.process_request({"action": "search_messages", "payload": payload})
+                    times.append(time.perf_counter() - t)
+                    assert res["status"] == "ok", res
+                times.sort()
+                print(f"{label:>12} {scope:>10}: avg {1000 * sum(times) / len(times):8.2f} ms, p95 {1000 * times[int(len(times) * 0.95)]:8.2f} ms")
+    finally:
+        db_mod.read_pool.close_all(); db_mod.write_pool.close_all()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="NovCord server benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("db", help="requests/sec через process_request")
+    p.add_argument("--requests", type=int, default=4000)
+    p.add_argument("--users", type=int, default=50)
+    p.add_argument("--messages", type=int, default=200)
+    p.add_argument("--threads", type=int, default=1)
+    p.set_defaults(func=bench_db)
+
+    p = sub.add_parser("tcp", help="задержка get_chat через TCP при множестве подключений")
+    p.add_argument("--mode", choices=("threaded", "async"), default="threaded")
+    p.add_argument("--clients", type=int, default=20)
+    p.add_argument("--idle", type=int, default=500)
+    p.add_argument("--requests", type=int, default=4000)
+    p.add_argument("--messages", type=int, default=2000)
+    p.set_defaults(func=bench_tcp)
+
+    p = sub.add_parser("voice", help="пакеты/сек и CPU голосового сервера на поток")
+    p.add_argument("--workers", type=int, default=cfg.VOICE_WORKERS)
+    p.add_argument("--streams", type=int, default=40)
+    p.add_argument("--channel-size", type=int, default=5)
+    p.add_argument("--rate", type=int, default=50, help="пакетов/сек на поток (20 мс кадры), 0 - без ограничения")
+    p.add_argument("--payload", type=int, default=160)
+    p.add_argument("--seconds", type=float, default=5)
+    p.set_defaults(func=bench_voice)
+
+    p = sub.add_parser("mix", help="egress и CPU группового звонка: пересылка против микширования")
+    p.add_argument("--sizes", default="10,30,100")
+    p.add_argument("--speakers", type=int, default=0, help="сколько участников говорят одновременно, 0 - все")
+    p.add_argument("--frame-bytes", type=int, default=640, help="16 кГц, 20 мс, 16 бит")
+    p.add_argument("--seconds", type=float, default=1)
+    p.set_defaults(func=bench_mix)
+
+    p = sub.add_parser("search", help="задержка search_messages на FTS5-индексе")
+    p.add_argument("--messages", type=int, default=2000000)
+    p.add_argument("--users", type=int, default=50)
+    p.add_argument("--queries", type=int, default=50)
+    p.set_defaults(func=bench_search)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
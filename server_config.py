@@ -45,12 +45,65 @@ def unpack_if_missing(folder_name):
 HOST = '0.0.0.0'
 PORT = 5000
 VOICE_PORT = 65433
+VOICE_WORKERS = 1                 # >1: столько UDP-сокетов/потоков на VOICE_PORT через SO_REUSEPORT (Linux)
+VOICE_SOCKET_BUFFER = 4 * 1024 * 1024   # SO_RCVBUF/SO_SNDBUF голосовых сокетов; 0 - системные значения
+# Микширование групповых каналов на сервере (нужен numpy; кадры - PCM 16-bit LE mono)
+VOICE_MIX_THRESHOLD = 0           # с какого числа участников канал микшируется; 0 - всегда пересылка
+VOICE_MIX_FRAME_MS = 20           # такт микшера, должен совпадать с длиной кадра клиента
+VOICE_MIX_MAX_BACKLOG = 3         # кадров в очереди говорящего, лишние отбрасываются
+VOICE_MIX_SENDER_ID = 0           # sender_id в заголовке смикшированного пакета
+# Отбор говорящих: тихие кадры не пересылаются, в канале звучат только самые громкие
+VOICE_SILENCE_LEVEL = 300         # средняя |амплитуда| кадра, ниже - тишина; 0 - пересылать всё как раньше
+VOICE_SILENCE_HANGOVER_MS = 400   # сколько ещё пропускать тишину после речи (хвосты слов)
+VOICE_MAX_SPEAKERS = 4            # top-K говорящих на канал; 0 - без ограничения
+VOICE_SPEAKER_SWITCH_RATIO = 1.5  # во сколько раз новый говорящий должен быть громче вытесняемого
+VOICE_SPEAKER_HOLD_MS = 1000      # минимальное время в слоте до вытеснения
+VOICE_SPEAKING_EVENT_MS = 250     # период проверки и рассылки voice_speaking
+VOICE_STATS_LOG_SECONDS = 60      # период сводки голосового трафика в логе и расчёта pkt/s; 0 - выкл
+
+# Сетевое ядро: "threaded" - поток на подключение, "async" - asyncio event loop
+SERVER_MODE = "threaded"
+ASYNC_DB_WORKERS = 16             # потоки для process_request в режиме async
+
+# Исходящая очередь каждого подключения (в кадрах)
+CLIENT_QUEUE_SIZE = 1000
+# Что делать при переполнении: "disconnect" - отключить клиента, "drop" - пометить медленным и терять события
+SLOW_CLIENT_POLICY = "disconnect"
+CLIENT_DRAIN_TIMEOUT = 5          # сек на отправку оставшейся очереди при отключении клиента
+
+# --- CHUNKED TRANSFER ---
+TRANSFER_CHUNK_SIZE = 256 * 1024          # максимум байт за один get_file_chunk / upload_chunk
+MAX_UPLOAD_SIZE = 512 * 1024 * 1024
+UPLOAD_EXPIRE_SECONDS = 24 * 3600         # брошенные загрузки удаляются через сутки
 
 # --- PATHS (Writeable) ---
 # Инициализируем папки. Если их нет -> распакуются из exe.
 # Если есть -> будут использоваться существующие.
 
 DB_NAME = os.path.join(BASE_DIR, "novcord_server.db")
+
+# --- DATABASE TUNING ---
+DB_READ_POOL_SIZE = 16            # параллельные читатели; 0 - новое соединение на каждый запрос
+DB_CACHED_STATEMENTS = 256        # кеш подготовленных запросов на соединение
+DB_SYNCHRONOUS = "NORMAL"         # в режиме WAL NORMAL безопасен и намного быстрее FULL
+DB_CACHE_SIZE_KB = 16384          # page cache на соединение
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_BUSY_TIMEOUT_MS = 5000
+
+# --- CHAT HISTORY ---
+CHAT_PAGE_SIZE = 50               # размер страницы get_chat, если limit не указан
+CHAT_MAX_PAGE_SIZE = 200
+SEARCH_PAGE_SIZE = 20             # результатов search_messages, если limit не указан
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_SNIPPET_TOKENS = 12        # длина фрагмента с совпадением (в словах)
+SEARCH_HIGHLIGHT = ("**", "**")   # чем обрамляются совпавшие слова во фрагменте
+PROFILE_CACHE_SIZE = 10000        # профилей в LRU-кеше server_profiles; 0 - без кеша
+EVENT_COALESCE_MS = 100           # окно слияния new_msg по (пользователь, чат); 0 - отправлять сразу
+BROADCAST_BATCH_SIZE = 500        # пользователей на одну транзакцию фоновой рассылки admin_broadcast_msg
+
+# --- FILE HASH INDEX ---
+HASH_INDEX_FILE = os.path.join(BASE_DIR, "file_hash_index.json")
+HASH_INDEX_SCAN_INTERVAL = 60     # сек между фоновыми пересканированиями server_assets и user_cache_*
 LOG_DIR = unpack_if_missing("logs")
 
 # Эти папки важны для контента
@@ -58,6 +111,7 @@ UPLOAD_DIR = unpack_if_missing("server_files")
 STICKERS_DIR = unpack_if_missing("stickers")
 NFTS_DIR = unpack_if_missing("nfts")
 ASSETS_DIR = unpack_if_missing("server_assets")
+PARTIAL_UPLOAD_DIR = unpack_if_missing("uploads_partial")   # незавершённые чанковые загрузки
 
 # Подпапки активов (они внутри server_assets, так что просто строим пути)
 ASSETS_BANNERS_DIR = os.path.join(ASSETS_DIR, "banners")
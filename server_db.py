@@ -1,85 +1,377 @@
+import json
+import time
 import sqlite3
+import queue
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 import server_config as cfg
 import server_state as state
+from server_logger import logger
+
+# --- CONNECTION POOL ---
+
+class ConnectionPool:
+    """
+    Пул долгоживущих соединений SQLite.
+    Соединения открываются лениво, настраиваются один раз (WAL, pragmas)
+    и переиспользуются вместе с кешем подготовленных запросов.
+    Пул с read_only=True выдаёт соединения, которым запрещена запись.
+    """
+    def __init__(self, size, read_only=False):
+        self.size = size
+        self.read_only = read_only
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(cfg.DB_NAME, check_same_thread=False,
+                               cached_statements=cfg.DB_CACHED_STATEMENTS)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={cfg.DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size=-{cfg.DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={cfg.DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA busy_timeout={cfg.DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if self.read_only: conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def acquire(self):
+        if self.size <= 0:
+            return sqlite3.connect(cfg.DB_NAME)
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except:
+                with self._lock: self._created -= 1
+                raise
+        return self._idle.get()
+
+    def release(self, conn):
+        if self.size <= 0:
+            conn.close()
+            return
+        try:
+            # Незакоммиченные изменения упавшего обработчика не должны перейти к следующему
+            if conn.in_transaction: conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self._lock: self._created -= 1
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        """Закрывает простаивающие соединения (например, после смены DB_NAME)"""
+        while True:
+            try: conn = self._idle.get_nowait()
+            except queue.Empty: break
+            conn.close()
+            with self._lock: self._created -= 1
+
+# В режиме WAL читатели не блокируют писателя и друг друга.
+# Писатель один: все изменения идут через write_pool под state.db_write_lock.
+read_pool = ConnectionPool(cfg.DB_READ_POOL_SIZE, read_only=True)
+write_pool = ConnectionPool(1)
+
+@contextmanager
+def reader():
+    with read_pool.connection() as conn:
+        yield conn
+
+@contextmanager
+def writer():
+    with state.db_write_lock, write_pool.connection() as conn:
+        yield conn
+
+# --- MIGRATIONS ---
+# Номер схемы хранится в PRAGMA user_version. При старте применяются только
+# шаги с номером больше текущего, каждый - в своей транзакции.
+
+def add_column(cur, table, column, type_def):
+    cur.execute(f"PRAGMA table_info({table})")
+    if column not in [r[1] for r in cur.fetchall()]:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {type_def}")
+
+def migrate_base_schema(cur):
+    """Схема до появления миграций; безопасна для уже существующих БД"""
+    # Основные таблицы
+    cur.execute('''CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT UNIQUE,
+        username TEXT,
+        discriminator TEXT,
+        password_hash TEXT,
+        is_verified INTEGER DEFAULT 0,
+        verification_code TEXT,
+        avatar_color TEXT,
+        avatar_image TEXT,
+        avatar_decoration TEXT,
+        banner_color TEXT DEFAULT 'black',
+        banner_image TEXT,
+        about_me TEXT DEFAULT 'Новичок',
+        custom_status TEXT DEFAULT '',
+        nickname_color TEXT DEFAULT 'white',
+        is_blocked INTEGER DEFAULT 0,
+        ban_reason TEXT DEFAULT '',
+        is_admin INTEGER DEFAULT 0,
+        chat_bg TEXT,
+        units INTEGER DEFAULT 0,
+        profile_music TEXT,
+        created_at TEXT
+    )''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS friends (user_id INTEGER, friend_id INTEGER, status TEXT, PRIMARY KEY (user_id, friend_id))''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS user_blocks (user_id INTEGER, blocked_id INTEGER, PRIMARY KEY (user_id, blocked_id))''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, sender_id INTEGER, target_id INTEGER, target_type TEXT,
+        content TEXT, timestamp TEXT, reply_to_id INTEGER, is_edited INTEGER DEFAULT 0,
+        attachment_type TEXT, attachment_filename TEXT, reactions TEXT DEFAULT '{}',
+        status TEXT DEFAULT 'sent',
+        forward_from_id INTEGER
+    )''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS message_reads (
+        message_id INTEGER,
+        user_id INTEGER,
+        read_at TEXT,
+        PRIMARY KEY (message_id, user_id)
+    )''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS groups (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, owner_id INTEGER, avatar_color TEXT, avatar_image TEXT, banner_image TEXT)''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS group_members (group_id INTEGER, user_id INTEGER, PRIMARY KEY (group_id, user_id))''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS group_blacklist (group_id INTEGER, user_id INTEGER, PRIMARY KEY (group_id, user_id))''')
+    
+    cur.execute('''CREATE TABLE IF NOT EXISTS nfts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        owner_id INTEGER,
+        filename TEXT,
+        name TEXT,
+        minted_at TEXT,
+        is_hidden INTEGER DEFAULT 0
+    )''')
+
+    # Колонки, добавленные в старых версиях
+    add_column(cur, "groups", "banner_image", "TEXT")
+    add_column(cur, "nfts", "is_hidden", "INTEGER DEFAULT 0")
+    add_column(cur, "users", "chat_bg", "TEXT")
+    add_column(cur, "users", "units", "INTEGER DEFAULT 0")
+    add_column(cur, "users", "profile_music", "TEXT")
+    add_column(cur, "messages", "status", "TEXT DEFAULT 'sent'")
+    add_column(cur, "messages", "forward_from_id", "INTEGER")
+
+    # SYSTEM BOT CREATION (ID 0)
+    try:
+        cur.execute("INSERT OR IGNORE INTO users (id, email, username, discriminator, password_hash, is_verified, about_me, nickname_color, avatar_color, created_at) VALUES (0, 'bot@novcord.sys', 'NovCord', '0000', 'sys', 1, 'Это официальный бот NovCord', '#5865F2', '#5865F2', ?)", (str(datetime.now()),))
+    except: pass
+
+def migrate_hot_indexes(cur):
+    """Индексы под частые запросы server_logic"""
+    # Сообщения чата по id (rowid идёт последним ключом индекса).
+    # У индекса пары target_type стоит последним: с ним впереди планировщик без
+    # статистики выбирал этот индекс и для запросов по группам.
+    cur.execute("DROP INDEX IF EXISTS idx_messages_pair")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_target ON messages (target_type, target_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_id, target_id, target_type)")
+    # Группы пользователя
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members (user_id, group_id)")
+    # Друзья и входящие заявки (PK покрывает только поиск по user_id)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_friends_user ON friends (user_id, status, friend_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_friends_friend ON friends (friend_id, status, user_id)")
+    # Поиск по тегу User#0000
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_tag ON users (username, discriminator)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_nfts_owner ON nfts (owner_id, is_hidden)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_group_blacklist_user ON group_blacklist (user_id)")
+
+def migrate_file_refs(cur):
+    """Счётчики ссылок на файлы контентно-адресуемого хранилища (server_store)"""
+    cur.execute("""CREATE TABLE IF NOT EXISTS file_refs (
+        hash TEXT PRIMARY KEY, size INTEGER, refs INTEGER DEFAULT 0, created_at TEXT
+    )""")
+
+def migrate_chat_reads(cur):
+    """
+    Прочтения хранятся отметкой "прочитано до id" на пользователя и чат вместо строки
+    на каждое сообщение. Для личного чата chat_id - собеседник (отправитель сообщений).
+    """
+    cur.execute("""CREATE TABLE IF NOT EXISTS chat_reads (
+        chat_type TEXT, chat_id INTEGER, user_id INTEGER, last_read_id INTEGER, read_at TEXT,
+        PRIMARY KEY (chat_type, chat_id, user_id)
+    )""")
+    cur.execute("""INSERT OR REPLACE INTO chat_reads (chat_type, chat_id, user_id, last_read_id, read_at)
+        SELECT m.target_type, CASE WHEN m.target_type='group' THEN m.target_id ELSE m.sender_id END,
+               mr.user_id, MAX(mr.message_id), MAX(mr.read_at)
+        FROM message_reads mr JOIN messages m ON m.id = mr.message_id
+        GROUP BY 1, 2, 3""")
+    cur.execute("DROP TABLE IF EXISTS message_reads")
+
+def migrate_message_reactions(cur):
+    """
+    Реакции - строки (сообщение, эмодзи, пользователь) вместо JSON в messages.reactions.
+    Колонка messages.reactions остаётся со старыми данными, но больше не читается.
+    """
+    cur.execute("""CREATE TABLE IF NOT EXISTS message_reactions (
+        message_id INTEGER, emoji TEXT, user_id INTEGER
+    )""")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_message_reactions ON message_reactions (message_id, emoji, user_id)")
+    cur.execute("SELECT id, reactions FROM messages WHERE reactions IS NOT NULL AND reactions NOT IN ('', '{}') ORDER BY id")
+    rows = []
+    for msg_id, blob in cur.fetchall():
+        try: reactions = json.loads(blob)
+        except ValueError: continue
+        for emoji, users in reactions.items():
+            rows.extend((msg_id, emoji, uid) for uid in users)
+    cur.executemany("INSERT OR IGNORE INTO message_reactions (message_id, emoji, user_id) VALUES (?,?,?)", rows)
+
+def rebuild_message_index(cur):
+    """Перестраивает messages_fts по текущему содержимому messages"""
+    cur.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+def migrate_message_search(cur):
+    """
+    Полнотекстовый индекс FTS5 по messages.content (external content: текст не дублируется).
+    Триггеры держат индекс в синхронизации при любой вставке, правке и удалении сообщений.
+    """
+    cur.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""")
+    rebuild_message_index(cur)
+
+MIGRATIONS = [
+    (1, "base schema", migrate_base_schema),
+    (2, "hot query indexes", migrate_hot_indexes),
+    (3, "file store refs", migrate_file_refs),
+    (4, "chat read watermarks", migrate_chat_reads),
+    (5, "message reactions rows", migrate_message_reactions),
+    (6, "message full-text search", migrate_message_search),
+]
+
+def get_schema_version(cur):
+    cur.execute("PRAGMA user_version")
+    return cur.fetchone()[0]
 
 def init_db():
-    with state.db_lock:
-        conn = sqlite3.connect(cfg.DB_NAME)
+    with writer() as conn:
         cur = conn.cursor()
-        
-        # Основные таблицы
-        cur.execute('''CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE,
-            username TEXT,
-            discriminator TEXT,
-            password_hash TEXT,
-            is_verified INTEGER DEFAULT 0,
-            verification_code TEXT,
-            avatar_color TEXT,
-            avatar_image TEXT,
-            avatar_decoration TEXT,
-            banner_color TEXT DEFAULT 'black',
-            banner_image TEXT,
-            about_me TEXT DEFAULT 'Новичок',
-            custom_status TEXT DEFAULT '',
-            nickname_color TEXT DEFAULT 'white',
-            is_blocked INTEGER DEFAULT 0,
-            ban_reason TEXT DEFAULT '',
-            is_admin INTEGER DEFAULT 0,
-            chat_bg TEXT,
-            units INTEGER DEFAULT 0,
-            profile_music TEXT,
-            created_at TEXT
-        )''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS friends (user_id INTEGER, friend_id INTEGER, status TEXT, PRIMARY KEY (user_id, friend_id))''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS user_blocks (user_id INTEGER, blocked_id INTEGER, PRIMARY KEY (user_id, blocked_id))''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, sender_id INTEGER, target_id INTEGER, target_type TEXT,
-            content TEXT, timestamp TEXT, reply_to_id INTEGER, is_edited INTEGER DEFAULT 0,
-            attachment_type TEXT, attachment_filename TEXT, reactions TEXT DEFAULT '{}',
-            status TEXT DEFAULT 'sent',
-            forward_from_id INTEGER
-        )''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS message_reads (
-            message_id INTEGER,
-            user_id INTEGER,
-            read_at TEXT,
-            PRIMARY KEY (message_id, user_id)
-        )''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS groups (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, owner_id INTEGER, avatar_color TEXT, avatar_image TEXT, banner_image TEXT)''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS group_members (group_id INTEGER, user_id INTEGER, PRIMARY KEY (group_id, user_id))''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS group_blacklist (group_id INTEGER, user_id INTEGER, PRIMARY KEY (group_id, user_id))''')
-        
-        cur.execute('''CREATE TABLE IF NOT EXISTS nfts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            owner_id INTEGER,
-            filename TEXT,
-            name TEXT,
-            minted_at TEXT,
-            is_hidden INTEGER DEFAULT 0
-        )''')
-
-        # АВТОМИГРАЦИИ
-        def add_column(table, column, type_def):
+        version = get_schema_version(cur)
+        for number, name, step in MIGRATIONS:
+            if number <= version: continue
             try:
-                cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {type_def}")
-            except sqlite3.OperationalError:
-                pass
-
-        add_column("groups", "banner_image", "TEXT")
-        add_column("nfts", "is_hidden", "INTEGER DEFAULT 0")
-        add_column("users", "chat_bg", "TEXT")
-        add_column("users", "units", "INTEGER DEFAULT 0")
-        add_column("users", "profile_music", "TEXT")
-        add_column("messages", "status", "TEXT DEFAULT 'sent'")
-        add_column("messages", "forward_from_id", "INTEGER")
-        
-        # SYSTEM BOT CREATION (ID 0)
-        try:
-            cur.execute("INSERT OR IGNORE INTO users (id, email, username, discriminator, password_hash, is_verified, about_me, nickname_color, avatar_color, created_at) VALUES (0, 'bot@novcord.sys', 'NovCord', '0000', 'sys', 1, 'Это официальный бот NovCord', '#5865F2', '#5865F2', ?)", (str(datetime.now()),))
-        except: pass
+                cur.execute("BEGIN")
+                step(cur)
+                cur.execute(f"PRAGMA user_version={number}")
+                conn.commit()
+            except:
+                conn.rollback()
+                logger.critical(f"Migration {number} ({name}) failed")
+                raise
+            logger.info(f"DB migrated to version {number}: {name}")
+
+# --- QUERY PLAN CHECK ---
+# Частые запросы server_logic. explain_hot_queries() проверяет, что ни один
+# из них не сканирует таблицу целиком.
+
+def hot_queries():
+    """
+    [(название, запрос, параметры, индексы, которые должны использоваться)].
+    Запросы берутся из тех же констант и функций, что выполняет server_logic;
+    импорт ленивый, потому что server_logic сам импортирует этот модуль.
+    """
+    import server_logic as logic
+    from server_profiles import PROFILE_SQL
+
+    private, group = logic.chat_streams('private', 1, 2), logic.chat_streams('group', 1, 1)
+    private_ids, private_params = logic.chat_ids_sql(private)
+    group_ids, group_params = logic.chat_ids_sql(group, (1, 100))
+    page = lambda streams, before_id, after_id: logic.chat_page_sql(*streams[0], before_id, after_id, 51)
+    return [
+        ("get_chat group page", *page(group, 100, None), ("idx_messages_target",)),
+        ("get_chat group page after", *page(group, None, 50), ("idx_messages_target",)),
+        ("get_chat private page", *page(private, 100, None), ("idx_messages_sender",)),
+        ("get_chat private view", logic.CHAT_VIEW_SQL.format(where=f"m.id IN ({private_ids})"), private_params, ("idx_messages_sender",)),
+        ("get_chat group view", logic.CHAT_VIEW_SQL.format(where=f"m.id IN ({group_ids})"), group_params, ("idx_messages_target",)),
+        ("group read watermarks", logic.GROUP_WATERMARKS_SQL, (1,), ("sqlite_autoindex_chat_reads_1",)),
+        ("chat reactions", logic.REACTIONS_SQL.format(ids=private_ids), private_params, ("idx_message_reactions",)),
+        ("mark_messages_read private", logic.MARK_PRIVATE_READ_SQL, (1, 2), ("idx_messages_sender",)),
+        ("last private message", logic.LAST_PRIVATE_ID_SQL, (1, 2), ("idx_messages_sender",)),
+        ("last group message", logic.LAST_GROUP_ID_SQL, (1,), ("idx_messages_target",)),
+        ("message readers group", *logic.message_readers_sql(5, 2, 1, 'group'), ("sqlite_autoindex_chat_reads_1",)),
+        ("message readers private", *logic.message_readers_sql(5, 2, 1, 'private'), ("sqlite_autoindex_chat_reads_1",)),
+        ("delete_chat_history", f"DELETE FROM messages WHERE id IN ({private_ids})", private_params, ("idx_messages_sender",)),
+        ("group members", logic.GROUP_MEMBER_IDS_SQL, (1,), ("sqlite_autoindex_group_members_1",)),
+        ("user groups", logic.USER_GROUPS_SQL, (1,), ("idx_group_members_user",)),
+        ("friends list", logic.FRIEND_IDS_SQL, (1, 1), ("idx_friends_friend",)),
+        ("friend requests", logic.FRIEND_REQUESTS_SQL, (1,), ("idx_friends_friend",)),
+        ("presence audience", logic.PRESENCE_AUDIENCE_SQL, (1, 1, 1), ("idx_friends_friend", "idx_group_members_user")),
+        ("profiles", PROFILE_SQL.format(marks="?,?,?"), (1, 2, 3), ("PRIMARY KEY",)),
+        ("user by tag", logic.USER_BY_TAG_SQL, ("a", "0001"), ("idx_users_tag",)),
+        ("login", logic.LOGIN_SQL, ("a", "a", "x"), ("idx_users_tag",)),
+        ("user gifts", logic.USER_GIFTS_SQL + " AND is_hidden=0", (1,), ("idx_nfts_owner",)),
+        ("broadcast read-back", logic.BROADCAST_READBACK_SQL, (1,), ("INTEGER PRIMARY KEY",)),
+    ]
+
+def explain_hot_queries(cur):
+    """
+    Возвращает [(name, plan_lines, ok)] для hot_queries().
+    Запрос считается плохим, если в плане есть SCAN или не используется ожидаемый индекс.
+    """
+    results = []
+    for name, sql, params, indexes in hot_queries():
+        cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+        plan = [r[3] for r in cur.fetchall()]
+        ok = not any(line.startswith("SCAN") for line in plan) and all(any(index in line for line in plan) for index in indexes)
+        results.append((name, plan, ok))
+    return results
+
+if __name__ == "__main__":
+    import sys
 
-        conn.commit()
-        conn.close()
\ No newline at end of file
+    command = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    if command == "migrate":
+        init_db()
+        with reader() as conn:
+            print(f"Schema version: {get_schema_version(conn.cursor())}")
+    elif command == "explain":
+        init_db()
+        failed = False
+        with reader() as conn:
+            for name, plan, ok in explain_hot_queries(conn.cursor()):
+                print(f"[{'OK' if ok else 'SCAN'}] {name}")
+                for line in plan: print(f"    {line}")
+                failed = failed or not ok
+        sys.exit(1 if failed else 0)
+    elif command == "fts-rebuild":
+        init_db()
+        with writer() as conn:
+            started = time.perf_counter()
+            rebuild_message_index(conn.cursor())
+            conn.commit()
+            print(f"messages_fts rebuilt in {time.perf_counter() - started:.1f}s")
+    else:
+        print("Usage: python server_db.py [migrate|explain|fts-rebuild]")
+        sys.exit(2)
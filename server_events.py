@@ -0,0 +1,87 @@
+"""
+Слияние событий new_msg ("обнови этот чат").
+
+Правки, удаления, реакции и новые сообщения шлют участникам чата new_msg, и клиент
+на каждое перезагружает чат. События одного чата за окно EVENT_COALESCE_MS
+сливаются в одно: в нём changes - какие изменения были, msg_ids - затронутые
+сообщения, остальные поля (sender_id, att_type, ...) - от последнего события.
+
+Ключ слияния: групповой чат - (group, id), всем участникам уходит один кадр;
+личный чат - (private, id собеседника, получатель).
+"""
+import time
+import threading
+import server_config as cfg
+import server_utils as utils
+from server_logger import logger
+
+class ChatEventCoalescer:
+    def __init__(self):
+        self.pending = {}       # key -> [deadline, set(user_id), event]; порядок вставки = порядок дедлайнов
+        self.cond = threading.Condition()
+        self.thread = None
+        self.merged = 0         # сколько событий поглощено слиянием
+
+    def push(self, key, user_ids, event, change, msg_id):
+        with self.cond:
+            entry = self.pending.get(key)
+            if entry is None:
+                event["changes"] = [change]
+                event["msg_ids"] = [msg_id] if msg_id is not None else []
+                self.pending[key] = [time.monotonic() + cfg.EVENT_COALESCE_MS / 1000, set(user_ids), event]
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, daemon=True)
+                    self.thread.start()
+                self.cond.notify()
+                return
+            self.merged += 1
+            _, users, merged = entry
+            users.update(user_ids)
+            if change not in merged["changes"]: merged["changes"].append(change)
+            if msg_id is not None and msg_id not in merged["msg_ids"]: merged["msg_ids"].append(msg_id)
+            for k, v in event.items():
+                if k not in ("changes", "msg_ids"): merged[k] = v
+
+    def _take_due(self):
+        """Ждёт первый дедлайн и забирает все наступившие записи"""
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            first = next(iter(self.pending.values()))
+            delay = first[0] - time.monotonic()
+            if delay > 0:
+                self.cond.wait(delay)
+            now = time.monotonic()
+            due = []
+            for key, entry in list(self.pending.items()):
+                if entry[0] > now: break
+                due.append(entry)
+                del self.pending[key]
+            return due
+
+    def _run(self):
+        while True:
+            for _, users, event in self._take_due():
+                try: utils.broadcast_to_users(users, event)
+                except Exception as e: logger.error(f"Event flush error: {e}")
+
+coalescer = ChatEventCoalescer()
+
+def chat_changed(user_ids, chat_type, chat_id, change, msg_id=None, **fields):
+    """
+    Сообщает user_ids, что чат изменился. change - "message", "edited", "deleted",
+    "reactions", "members" или "cleared". Для личного чата chat_id - собеседник
+    получателя, поэтому вызывается отдельно для каждой стороны.
+    """
+    event = {"event": "new_msg", "chat_id": chat_id, "type": chat_type}
+    event.update(fields)
+    if not cfg.EVENT_COALESCE_MS:
+        event["changes"] = [change]
+        event["msg_ids"] = [msg_id] if msg_id is not None else []
+        utils.broadcast_to_users(user_ids, event)
+        return
+    if chat_type == "group":
+        coalescer.push(("group", chat_id), user_ids, event, change, msg_id)
+    else:
+        for uid in user_ids:
+            coalescer.push(("private", chat_id, uid), (uid,), dict(event), change, msg_id)
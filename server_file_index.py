@@ -0,0 +1,149 @@
+"""
+Кеш хешей для get_assets_index / get_user_cache_index.
+
+Раньше каждый вызов (то есть каждый вход клиента) читал и хешировал все файлы
+server_assets и user_cache_<id>. Теперь хеш хранится по пути вместе с размером
+и mtime и пересчитывается только для изменившихся файлов. Индекс сохраняется
+в HASH_INDEX_FILE и переживает перезапуск; фоновый поток периодически
+пересканирует папки.
+
+У каждого списка есть version - хеш содержимого списка. Клиент присылает
+known_version и, если ничего не изменилось, получает ответ без списка файлов.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+import server_config as cfg
+import server_utils as utils
+from server_logger import logger
+
+# Тип актива -> (папка, допустимые расширения)
+ASSET_SCOPES = {
+    "banners": (cfg.ASSETS_BANNERS_DIR, ('.png', '.jpg', '.jpeg', '.gif')),
+    "rams": (cfg.ASSETS_RAMS_DIR, ('.gif', '.png')),
+    "chat_backgrounds": (cfg.ASSETS_CHAT_BG_DIR, ('.png', '.jpg', '.jpeg')),
+    "bot_avatar": (cfg.ASSETS_BOT_AVATAR_DIR, ('.png', '.jpg', '.jpeg', '.gif')),
+}
+
+def user_cache_dir(user_id):
+    return os.path.join(cfg.UPLOAD_DIR, f"user_cache_{user_id}")
+
+def listing_version(listing):
+    return hashlib.sha1(json.dumps(listing, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+class FileIndex:
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.lock = threading.Lock()
+        self.entries = {}      # path -> [size, mtime_ns, md5]
+        self.listings = {}     # scope ("assets" / "cache:<id>") -> (version, listing)
+        self.dirty = False
+        self.running = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        with self.lock:
+            if not self.dirty: return
+            data = json.dumps(self.entries)
+            self.dirty = False
+        tmp = self.index_file + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f: f.write(data)
+            os.replace(tmp, self.index_file)
+        except OSError as e:
+            logger.error(f"Hash index save error: {e}")
+
+    def file_hash(self, path):
+        """MD5 файла; пересчитывается, только если изменились размер или mtime"""
+        try: st = os.stat(path)
+        except OSError: return None
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        digest = utils.get_file_hash(path)
+        with self.lock:
+            self.entries[path] = [st.st_size, st.st_mtime_ns, digest]
+            self.dirty = True
+        return digest
+
+    def list_dir(self, directory, exts=None):
+        files = []
+        if not os.path.exists(directory): return files
+        for f in sorted(os.listdir(directory)):
+            path = os.path.join(directory, f)
+            if exts and not f.lower().endswith(exts): continue
+            if not os.path.isfile(path): continue
+            files.append({"name": f, "hash": self.file_hash(path)})
+        return files
+
+    def forget_missing(self, directory, present):
+        """Убирает из индекса записи удалённых файлов папки"""
+        prefix = os.path.join(directory, "")
+        with self.lock:
+            for path in [p for p in self.entries if p.startswith(prefix) and p not in present]:
+                del self.entries[path]
+                self.dirty = True
+
+    def _store(self, scope, listing):
+        entry = (listing_version(listing), listing)
+        with self.lock: self.listings[scope] = entry
+        return entry
+
+    # --- LISTINGS ---
+
+    def refresh_assets(self):
+        listing = {}
+        for kind, (directory, exts) in ASSET_SCOPES.items():
+            listing[kind] = self.list_dir(directory, exts)
+            self.forget_missing(directory, {os.path.join(directory, f["name"]) for f in listing[kind]})
+        return self._store("assets", listing)
+
+    def refresh_user_cache(self, user_id):
+        directory = user_cache_dir(user_id)
+        listing = self.list_dir(directory)
+        self.forget_missing(directory, {os.path.join(directory, f["name"]) for f in listing})
+        return self._store(f"cache:{user_id}", listing)
+
+    def assets(self):
+        """(version, {тип: [{"name","hash"}]})"""
+        with self.lock: entry = self.listings.get("assets")
+        return entry or self.refresh_assets()
+
+    def user_cache(self, user_id):
+        with self.lock: entry = self.listings.get(f"cache:{user_id}")
+        return entry or self.refresh_user_cache(user_id)
+
+    # --- BACKGROUND SCANNER ---
+
+    def scan_all(self):
+        self.refresh_assets()
+        if os.path.exists(cfg.UPLOAD_DIR):
+            for d in os.listdir(cfg.UPLOAD_DIR):
+                if d.startswith("user_cache_") and os.path.isdir(os.path.join(cfg.UPLOAD_DIR, d)):
+                    self.refresh_user_cache(d[len("user_cache_"):])
+        self.save()
+
+    def _scan_loop(self):
+        while self.running:
+            time.sleep(cfg.HASH_INDEX_SCAN_INTERVAL)
+            try: self.scan_all()
+            except Exception as e: logger.error(f"Hash index scan error: {e}")
+
+    def start(self):
+        if self.running: return
+        self.running = True
+        try: self.scan_all()
+        except Exception as e: logger.error(f"Hash index scan error: {e}")
+        threading.Thread(target=self._scan_loop, daemon=True).start()
+
+file_index = FileIndex(cfg.HASH_INDEX_FILE)
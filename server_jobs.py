@@ -0,0 +1,60 @@
+"""
+Фоновые задачи админки (массовая рассылка и т.п.).
+
+Задача выполняется в отдельном потоке и сама берёт соединения БД короткими
+порциями, поэтому обычные запросы обслуживаются, пока она идёт.
+Прогресс доступен по job_id через admin_get_jobs.
+"""
+import time
+import uuid
+import threading
+from server_logger import logger
+
+KEEP_FINISHED = 50      # сколько завершённых задач помнить для admin_get_jobs
+
+class Job:
+    def __init__(self, kind, total):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.total = total
+        self.done = 0
+        self.status = "running"     # running / done / error
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+
+    def info(self):
+        return {"job_id": self.id, "kind": self.kind, "state": self.status, "done": self.done,
+                "total": self.total, "error": self.error, "started": self.started, "finished": self.finished}
+
+jobs = {}               # job_id -> Job, в порядке запуска
+jobs_lock = threading.Lock()
+
+def _run(job, fn, args):
+    try:
+        fn(job, *args)
+        job.status = "done"
+    except Exception as e:
+        job.status, job.error = "error", str(e)
+        logger.error(f"Job {job.kind} {job.id} failed: {e}")
+    job.finished = time.time()
+    logger.info(f"Job {job.kind} {job.id}: {job.status}, {job.done}/{job.total} in {job.finished - job.started:.1f}s")
+
+def start(kind, total, fn, *args):
+    """Запускает fn(job, *args) в фоне; fn увеличивает job.done по мере работы"""
+    job = Job(kind, total)
+    with jobs_lock:
+        finished = [j for j in jobs.values() if j.status != "running"]
+        for old in finished[:max(0, len(finished) - KEEP_FINISHED + 1)]:
+            del jobs[old.id]
+        jobs[job.id] = job
+    threading.Thread(target=_run, args=(job, fn, args), daemon=True).start()
+    return job
+
+def get(job_id):
+    with jobs_lock:
+        return jobs.get(job_id)
+
+def list_jobs():
+    with jobs_lock:
+        return [j.info() for j in jobs.values()]
@@ -1,695 +1,1353 @@
-import sqlite3
+import re
 import json
+import sqlite3
+import bisect
+import base64
 import hashlib
+import uuid
 import threading
 import random
 import string
 import os
+import time
+import traceback
 from datetime import datetime
 import server_config as cfg
 import server_state as state
 import server_utils as utils
+import server_db as db_mod
+import server_store as store
+import server_events as events
+import server_jobs as jobs
+from server_logger import logger
 from server_voice import voice_server
+from server_file_index import file_index
+from server_profiles import profile_cache
+
+# --- ACTION REGISTRY ---
+
+class Action:
+    """Зарегистрированное действие: обработчик, флаги и счётчики вызовов"""
+    def __init__(self, name, func, write, required, db, session):
+        self.name = name
+        self.func = func
+        self.write = write          # True - действие изменяет данные и идёт через единственного писателя
+        self.required = required    # обязательные поля payload
+        self.db = db                # False - обработчик работает только с файлами и не занимает БД
+        self.session = session      # передавать ли обработчику сессию клиента
+
+        # Статистика
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0           # запросы, не прошедшие валидацию
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed, failed):
+        self.calls += 1
+        self.total_time += elapsed
+        if elapsed > self.max_time: self.max_time = elapsed
+        if failed: self.errors += 1
+
+    def stats(self):
+        return {
+            "write": self.write, "calls": self.calls, "errors": self.errors, "rejected": self.rejected,
+            "avg_ms": round(self.total_time / self.calls * 1000, 3) if self.calls else 0,
+            "max_ms": round(self.max_time * 1000, 3)
+        }
+
+ACTIONS = {}   # action name -> Action
+hooks = []     # func(action_name, payload, response, elapsed), вызываются после каждого запроса
+
+def action(name, write=False, required=(), db=True, session=False):
+    """
+    Декоратор регистрации обработчика.
+    Обработчик вызывается как func(db, cur, payload) или func(db, cur, payload, session).
+    Если обработчик сам отправил ответ клиенту, он возвращает None.
+    write=True выбирает соединение писателя, поэтому без db=True он не имеет смысла.
+    """
+    if write and not db:
+        raise ValueError(f"Action {name}: write=True requires db=True")
+    def decorator(func):
+        ACTIONS[name] = Action(name, func, write, required, db, session)
+        return func
+    return decorator
+
+def add_hook(func):
+    """Подключает хук, получающий (action_name, payload, response, elapsed)"""
+    hooks.append(func)
+
+def get_action_stats():
+    return {name: act.stats() for name, act in ACTIONS.items() if act.calls or act.rejected}
 
-def process_request(req):
-    action = req.get('action')
+class InvalidRequest(ValueError):
+    """Некорректное значение поля payload; клиент получает ошибку без трассировки в логе"""
+
+def int_param(payload, key, default=None):
+    """Целое поле payload (или default, если поля нет); иначе InvalidRequest"""
+    value = payload.get(key)
+    if value is None: return default
+    try:
+        if isinstance(value, bool): raise ValueError
+        return int(value)
+    except (TypeError, ValueError):
+        raise InvalidRequest(f"Invalid field: {key} must be an integer")
+
+def validate(act, payload):
+    """Возвращает текст ошибки, если в payload нет обязательных полей"""
+    if not isinstance(payload, dict): return "Invalid payload"
+    missing = [k for k in act.required if k not in payload]
+    if missing: return f"Missing fields: {', '.join(missing)}"
+    return None
+
+def process_request(req, session=None):
+    name = req.get('action')
     payload = req.get('payload', {})
 
-    with state.db_lock:
-        db = sqlite3.connect(cfg.DB_NAME)
-        cur = db.cursor()
+    act = ACTIONS.get(name)
+    if act is None: return {"status": "error"}
+
+    error = validate(act, payload)
+    if error:
+        act.rejected += 1
+        return {"status": "error", "msg": error}
+
+    start = time.perf_counter()
+    failed = False
+    try:
+        if act.db:
+            with (db_mod.writer() if act.write else db_mod.reader()) as db:
+                cur = db.cursor()
+                response = call_handler(act, db, cur, payload, session)
+        else:
+            response = call_handler(act, None, None, payload, session)
+    except InvalidRequest as e:
+        act.rejected += 1
+        response = {"status": "error", "error": "invalid_request", "msg": str(e)}
+    except Exception as e:
+        traceback.print_exc()
+        failed = True
+        response = {"status": "error", "msg": str(e)}
+
+    elapsed = time.perf_counter() - start
+    act.record(elapsed, failed)
+    for hook in hooks:
+        try: hook(name, payload, response, elapsed)
+        except Exception as e: logger.error(f"Hook error for {name}: {e}")
+    return response
+
+def call_handler(act, db, cur, payload, session):
+    if act.session: return act.func(db, cur, payload, session)
+    return act.func(db, cur, payload)
+
+# --- CONNECTION & PRESENCE ---
+# Статусы и изменения профиля получают только друзья и участники общих групп
+
+GROUP_MEMBER_IDS_SQL = "SELECT user_id FROM group_members WHERE group_id=?"
+
+PRESENCE_AUDIENCE_SQL = """SELECT friend_id FROM friends WHERE user_id=? AND status='accepted'
+    UNION SELECT user_id FROM friends WHERE friend_id=? AND status='accepted'
+    UNION SELECT gm.user_id FROM group_members gm JOIN group_members mine ON gm.group_id = mine.group_id WHERE mine.user_id=?"""
+
+def presence_audience(cur, user_id):
+    cur.execute(PRESENCE_AUDIENCE_SQL, (user_id, user_id, user_id))
+    return {r[0] for r in cur.fetchall() if r[0] != user_id}
+
+def online_among(user_ids):
+    with state.clients_lock:
+        return [uid for uid in user_ids if uid in state.online_users]
+
+def introduce_presence(user_id, others):
+    """Новая связь user_id с others: ему - снимок их статусов, им - его статус"""
+    online = online_among(others)
+    if user_id not in state.online_users: return
+    utils.broadcast_to_user(user_id, {"event": "presence_snapshot", "online": online})
+    utils.broadcast_to_users(online, {"event": "user_status", "user_id": user_id, "status": "online"})
+
+def share_presence(user_ids):
+    """Новая группа: каждому участнику онлайн - один снимок статусов остальных"""
+    online = online_among(user_ids)
+    for uid in online:
+        utils.broadcast_to_user(uid, {"event": "presence_snapshot", "online": [o for o in online if o != uid]})
+
+@action('connect_user', required=('id',), session=True)
+def handle_connect_user(db, cur, payload, session):
+    current_user_id = payload['id']
+    session.user_id = current_user_id
+    session.delta_events = bool(payload.get('delta_events'))
+    with state.clients_lock:
+        state.connected_clients[current_user_id] = session
+        state.online_users.add(current_user_id)
+    
+    session.send_json({"status": "ok", "msg": "Connected"}, critical=True)
+    
+    # Мой статус - друзьям и участникам общих групп (JSON кодируется один раз)
+    audience = presence_audience(cur, current_user_id)
+    online = online_among(audience)
+    utils.broadcast_to_users(online, {"event": "user_status", "user_id": current_user_id, "status": "online"})
+    
+    # Мне - одним кадром список тех из них, кто УЖЕ онлайн
+    session.send_json({"event": "presence_snapshot", "online": online})
+    
+    logger.info(f"User {current_user_id} connected")
+    return None
+
+def handle_disconnect(session):
+    """Очистка при отключении клиента (общая для потокового и asyncio ядра)"""
+    current_user_id = session.user_id
+    if not current_user_id: return
+
+    with state.clients_lock:
+        # Пользователь мог уже переподключиться новым сокетом
+        if state.connected_clients.get(current_user_id) is not session: return
+        del state.connected_clients[current_user_id]
+        state.online_users.discard(current_user_id)
+
+    # Выход из голосового канала
+    voice_server.leave_channel(current_user_id)
+
+    # Уведомление об оффлайне
+    with db_mod.reader() as db:
+        audience = presence_audience(db.cursor(), current_user_id)
+    utils.broadcast_to_users(audience, {"event": "user_status", "user_id": current_user_id, "status": "offline"})
+    logger.info(f"User {current_user_id} disconnected")
+
+# --- ACCOUNT ---
+
+@action('register', write=True, required=('email', 'username', 'password'))
+def handle_register(db, cur, payload):
+    email, user, pwd = payload['email'], payload['username'].lower(), payload['password']
+    cur.execute("SELECT id FROM users WHERE email=? OR username=?", (email, user))
+    if cur.fetchone(): return {"status": "error", "msg": "Занято"}
+    disc = str(random.randint(1000, 9999))
+    p_hash = hashlib.sha256(pwd.encode()).hexdigest()
+    code = ''.join(random.choices(string.digits, k=6))
+    color = random.choice(['#5865F2', '#EB459E', '#F2CC58', '#23A559'])
+    cur.execute("INSERT INTO users (email, username, discriminator, password_hash, verification_code, avatar_color, created_at) VALUES (?,?,?,?,?,?,?)",
+                (email, user, disc, p_hash, code, color, str(datetime.now())))
+    uid = cur.lastrowid
+    db.commit()
+    threading.Thread(target=utils.send_email, args=(email, code)).start()
+    return {"status": "ok", "user_id": uid}
+
+LOGIN_SQL = "SELECT * FROM users WHERE (email=? OR username=?) AND password_hash=?"
+
+@action('login', required=('login', 'password'))
+def handle_login(db, cur, payload):
+    login, pwd = payload['login'].lower(), hashlib.sha256(payload['password'].encode()).hexdigest()
+    cur.execute(LOGIN_SQL, (login, login, pwd))
+    u = cur.fetchone()
+    if not u: return {"status": "error", "msg": "Неверно"}
+    if u[15]: return {"status": "error", "msg": "Пользователь заблокирован"} 
+    return {"status": "ok", "user": {
+        "id": u[0], "email": u[1], "username": u[2], "discriminator": u[3], "is_verified": u[5], 
+        "color": u[7], "image": u[8], "decoration": u[9], "banner": u[10], "banner_image": u[11], 
+        "about_me": u[12], "custom_status": u[13], "nickname_color": u[14], "is_admin": u[17],
+        "chat_bg": u[18], "units": u[19] if u[19] is not None else 0,
+        "profile_music": u[20] if len(u) > 20 else None
+    }}
+
+@action('check_ban_status', required=('id',))
+def handle_check_ban_status(db, cur, payload):
+    cur.execute("SELECT is_blocked, ban_reason, username, discriminator FROM users WHERE id=?", (payload['id'],))
+    res = cur.fetchone()
+    if res and res[0] == 1: return {"status": "banned", "reason": res[1], "tag": f"{res[2]}#{res[3]}"}
+    return {"status": "ok"}
+
+@action('verify', write=True, required=('id', 'code'))
+def handle_verify(db, cur, payload):
+    uid, code = payload['id'], payload['code']
+    cur.execute("SELECT verification_code FROM users WHERE id=?", (uid,))
+    res = cur.fetchone()
+    if res and code == res[0]:
+        cur.execute("UPDATE users SET is_verified=1 WHERE id=?", (uid,))
+        db.commit(); return {"status": "ok"}
+    return {"status": "error", "msg": "Неверный код"}
+
+# --- VOICE CALL LOGIC ---
+
+@action('join_voice', required=('user_id', 'chat_id', 'chat_type'))
+def handle_join_voice(db, cur, payload):
+    uid = payload['user_id']
+    channel_id = str(payload['chat_id'])
+
+    voice_server.join_channel(uid, channel_id)
+
+    if payload['chat_type'] == 'private':
         try:
-            if action == 'register':
-                email, user, pwd = payload['email'], payload['username'].lower(), payload['password']
-                cur.execute("SELECT id FROM users WHERE email=? OR username=?", (email, user))
-                if cur.fetchone(): return {"status": "error", "msg": "Занято"}
-                disc = str(random.randint(1000, 9999))
-                p_hash = hashlib.sha256(pwd.encode()).hexdigest()
-                code = ''.join(random.choices(string.digits, k=6))
-                color = random.choice(['#5865F2', '#EB459E', '#F2CC58', '#23A559'])
-                cur.execute("INSERT INTO users (email, username, discriminator, password_hash, verification_code, avatar_color, created_at) VALUES (?,?,?,?,?,?,?)",
-                            (email, user, disc, p_hash, code, color, str(datetime.now())))
-                uid = cur.lastrowid
-                db.commit()
-                threading.Thread(target=utils.send_email, args=(email, code)).start()
-                return {"status": "ok", "user_id": uid}
-
-            elif action == 'login':
-                login, pwd = payload['login'].lower(), hashlib.sha256(payload['password'].encode()).hexdigest()
-                cur.execute("SELECT * FROM users WHERE (email=? OR username=?) AND password_hash=?", (login, login, pwd))
-                u = cur.fetchone()
-                if not u: return {"status": "error", "msg": "Неверно"}
-                if u[15]: return {"status": "error", "msg": "Пользователь заблокирован"} 
-                return {"status": "ok", "user": {
-                    "id": u[0], "email": u[1], "username": u[2], "discriminator": u[3], "is_verified": u[5], 
-                    "color": u[7], "image": u[8], "decoration": u[9], "banner": u[10], "banner_image": u[11], 
-                    "about_me": u[12], "custom_status": u[13], "nickname_color": u[14], "is_admin": u[17],
-                    "chat_bg": u[18], "units": u[19] if u[19] is not None else 0,
-                    "profile_music": u[20] if len(u) > 20 else None
-                }}
-
-            elif action == 'check_ban_status':
-                cur.execute("SELECT is_blocked, ban_reason, username, discriminator FROM users WHERE id=?", (payload['id'],))
-                res = cur.fetchone()
-                if res and res[0] == 1: return {"status": "banned", "reason": res[1], "tag": f"{res[2]}#{res[3]}"}
-                return {"status": "ok"}
-
-            elif action == 'verify':
-                uid, code = payload['id'], payload['code']
-                cur.execute("SELECT verification_code FROM users WHERE id=?", (uid,))
-                res = cur.fetchone()
-                if res and code == res[0]:
-                    cur.execute("UPDATE users SET is_verified=1 WHERE id=?", (uid,))
-                    db.commit(); return {"status": "ok"}
-                return {"status": "error", "msg": "Неверный код"}
-
-            # --- VOICE CALL LOGIC ---
-            elif action == 'join_voice':
-                uid = payload['user_id']
-                channel_id = str(payload['chat_id'])
-                
-                voice_server.join_channel(uid, channel_id)
-                
-                if payload['chat_type'] == 'private':
-                    try:
-                        parts = channel_id.split('_')
-                        if len(parts) == 3:
-                            id1, id2 = int(parts[1]), int(parts[2])
-                            target_id = id1 if id1 != uid else id2
-                            
-                            # Ringing event
-                            utils.broadcast_to_user(target_id, {
-                                "event": "voice_ring", 
-                                "caller_id": uid,
-                                "chat_id": channel_id,
-                                "chat_type": "private"
-                            })
-                            
-                            event = {"event": "voice_update", "type": "join", "user_id": uid, "chat_id": uid} # Send caller ID as chat_id for mapping
-                            utils.broadcast_to_user(target_id, event)
-                            utils.broadcast_to_user(uid, event)
-                    except: pass
-                else:
-                    event = {"event": "voice_update", "type": "join", "user_id": uid, "chat_id": channel_id}
-                    cur.execute("SELECT user_id FROM group_members WHERE group_id=?", (channel_id,))
-                    for m in cur.fetchall():
-                        utils.broadcast_to_user(m[0], event)
-                        
-                return {"status": "ok"}
-
-            elif action == 'leave_voice':
-                uid = payload['user_id']
-                channel_id = str(payload['chat_id'])
-                voice_server.leave_channel(uid)
-                
-                # Check empty logic removed for simplicity to ensure "leave" event always fires
-                is_empty = False 
-                
-                if payload['chat_type'] == 'private':
-                    try:
-                        parts = channel_id.split('_')
-                        if len(parts) == 3:
-                            id1, id2 = int(parts[1]), int(parts[2])
-                            target_id = id1 if id1 != uid else id2
-                            
-                            event = {"event": "voice_update", "type": "leave", "user_id": uid, "chat_id": uid, "is_empty": is_empty}
-                            utils.broadcast_to_user(target_id, event)
-                    except: pass
-                else:
-                    event = {"event": "voice_update", "type": "leave", "user_id": uid, "chat_id": channel_id, "is_empty": is_empty}
-                    cur.execute("SELECT user_id FROM group_members WHERE group_id=?", (channel_id,))
-                    for m in cur.fetchall():
-                        utils.broadcast_to_user(m[0], event)
-                        
-                return {"status": "ok"}
-            
-            elif action == 'voice_state':
-                # NEW: Sync Mute/Deafen state
-                uid = payload['user_id']
-                channel_id = str(payload['chat_id'])
-                is_muted = payload.get('is_muted', False)
-                is_deafened = payload.get('is_deafened', False)
-                
-                event = {
-                    "event": "voice_state_update",
-                    "user_id": uid,
+            parts = channel_id.split('_')
+            if len(parts) == 3:
+                id1, id2 = int(parts[1]), int(parts[2])
+                target_id = id1 if id1 != uid else id2
+
+                # Ringing event
+                utils.broadcast_to_user(target_id, {
+                    "event": "voice_ring", 
+                    "caller_id": uid,
                     "chat_id": channel_id,
-                    "is_muted": is_muted,
-                    "is_deafened": is_deafened
-                }
-                
-                if payload['chat_type'] == 'private':
-                    try:
-                        parts = channel_id.split('_')
-                        if len(parts) == 3:
-                            id1, id2 = int(parts[1]), int(parts[2])
-                            target_id = id1 if id1 != uid else id2
-                            utils.broadcast_to_user(target_id, event)
-                    except: pass
-                else:
-                    cur.execute("SELECT user_id FROM group_members WHERE group_id=?", (channel_id,))
-                    for m in cur.fetchall():
-                        if m[0] != uid: # Don't send back to self necessarily, but useful for confirm
-                            utils.broadcast_to_user(m[0], event)
-                
-                return {"status": "ok"}
-
-            elif action == 'get_voice_participants':
-                channel_id = str(payload['chat_id'])
-                participants = []
-                with voice_server.lock:
-                    for uid, cid in voice_server.user_channels.items():
-                        if cid == channel_id:
-                            cur.execute("SELECT id, username, avatar_color, avatar_image FROM users WHERE id=?", (uid,))
-                            u = cur.fetchone()
-                            if u:
-                                participants.append({
-                                    "id": u[0], "username": u[1], "color": u[2], "image": u[3]
-                                })
-                return {"status": "ok", "participants": participants}
-
-            # --- ASSETS SYNC ---
-            elif action == 'get_assets_index':
-                assets = {"banners": [], "rams": [], "chat_backgrounds": [], "bot_avatar": []}
-                if os.path.exists(cfg.ASSETS_BANNERS_DIR):
-                    for f in os.listdir(cfg.ASSETS_BANNERS_DIR):
-                        if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
-                            assets["banners"].append({"name": f, "hash": utils.get_file_hash(os.path.join(cfg.ASSETS_BANNERS_DIR, f))})
-                if os.path.exists(cfg.ASSETS_RAMS_DIR):
-                    for f in os.listdir(cfg.ASSETS_RAMS_DIR):
-                        if f.lower().endswith(('.gif', '.png')):
-                            assets["rams"].append({"name": f, "hash": utils.get_file_hash(os.path.join(cfg.ASSETS_RAMS_DIR, f))})
-                if os.path.exists(cfg.ASSETS_CHAT_BG_DIR):
-                    for f in os.listdir(cfg.ASSETS_CHAT_BG_DIR):
-                        if f.lower().endswith(('.png', '.jpg', '.jpeg')):
-                            assets["chat_backgrounds"].append({"name": f, "hash": utils.get_file_hash(os.path.join(cfg.ASSETS_CHAT_BG_DIR, f))})
-                if os.path.exists(cfg.ASSETS_BOT_AVATAR_DIR):
-                    for f in os.listdir(cfg.ASSETS_BOT_AVATAR_DIR):
-                        if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
-                            assets["bot_avatar"].append({"name": f, "hash": utils.get_file_hash(os.path.join(cfg.ASSETS_BOT_AVATAR_DIR, f))})
-                return {"status": "ok", "assets": assets}
-
-            elif action == 'get_asset_file':
-                asset_type = payload['type']
-                filename = payload['filename']
-                if ".." in filename or "/" in filename or "\\" in filename: return {"status": "error", "msg": "Invalid filename"}
-                type_dirs = {"banners": cfg.ASSETS_BANNERS_DIR, "rams": cfg.ASSETS_RAMS_DIR, "chat_backgrounds": cfg.ASSETS_CHAT_BG_DIR, "bot_avatar": cfg.ASSETS_BOT_AVATAR_DIR}
-                if asset_type not in type_dirs: return {"status": "error", "msg": "Invalid type"}
-                path = os.path.join(type_dirs[asset_type], filename)
-                b64 = utils.load_file_b64(path)
-                return {"status": "ok", "b64": b64, "filename": filename} if b64 else {"status": "error", "msg": "Not found"}
-
-            # --- USER CACHE SYNC ---
-            elif action == 'get_user_cache_index':
-                user_id = payload['user_id']
-                cache_dir = os.path.join(cfg.UPLOAD_DIR, f"user_cache_{user_id}")
-                files = []
-                if os.path.exists(cache_dir):
-                    for f in os.listdir(cache_dir):
-                        path = os.path.join(cache_dir, f)
-                        if os.path.isfile(path): files.append({"name": f, "hash": utils.get_file_hash(path)})
-                return {"status": "ok", "files": files}
-
-            elif action == 'upload_cache_file':
-                user_id, filename, b64_data = payload['user_id'], payload['filename'], payload['b64']
-                if ".." in filename: return {"status": "error"}
-                cache_dir = os.path.join(cfg.UPLOAD_DIR, f"user_cache_{user_id}")
-                if not os.path.exists(cache_dir): os.makedirs(cache_dir)
-                try:
-                    with open(os.path.join(cache_dir, filename), "wb") as f:
-                        f.write(base64.b64decode(b64_data))
-                    return {"status": "ok"}
-                except: return {"status": "error"}
-
-            elif action == 'get_cache_file':
-                user_id, filename = payload['user_id'], payload['filename']
-                if ".." in filename: return {"status": "error"}
-                path = os.path.join(cfg.UPLOAD_DIR, f"user_cache_{user_id}", filename)
-                b64 = utils.load_file_b64(path)
-                return {"status": "ok", "b64": b64} if b64 else {"status": "error"}
-
-            # --- FILES ---
-            elif action == 'get_file_content':
-                fname = payload['filename']
-                is_sticker, is_nft = payload.get('is_sticker', False), payload.get('is_nft', False)
-                path = fname 
-                if is_sticker: path = os.path.join(cfg.STICKERS_DIR, fname)
-                elif is_nft: path = os.path.join(cfg.NFTS_DIR, fname)
-                else: path = os.path.join(cfg.UPLOAD_DIR, fname)
-                if ".." in path: return {"status": "error"}
-                return {"status": "ok", "b64": utils.load_file_b64(path)}
-
-            elif action == 'get_stickers_index':
-                index = {}
-                if os.path.exists(cfg.STICKERS_DIR):
-                    for pack in os.listdir(cfg.STICKERS_DIR):
-                        pack_path = os.path.join(cfg.STICKERS_DIR, pack)
-                        if os.path.isdir(pack_path):
-                            files = [f for f in os.listdir(pack_path) if f.lower().endswith(('.png', '.gif', '.jpg'))]
-                            if files: index[pack] = files
-                return {"status": "ok", "data": index}
-            
-            elif action == 'get_server_nfts_assets':
-                files = []
-                if os.path.exists(cfg.NFTS_DIR):
-                    files = [f for f in os.listdir(cfg.NFTS_DIR) if f.lower().endswith(('.gif', '.png', '.jpg'))]
-                return {"status": "ok", "files": files}
-
-            elif action == 'mint_gift':
-                sender, target, fname = payload['sender_id'], payload['target_id'], payload['filename']
-                name = os.path.splitext(fname)[0].replace('_', ' ').title()
-                price = 100
-                cur.execute("SELECT units FROM users WHERE id=?", (sender,))
-                res = cur.fetchone()
-                current_units = res[0] if res else 0
-                if current_units < price: return {"status": "error", "msg": "Недостаточно Units"}
-                cur.execute("UPDATE users SET units = units - ? WHERE id=?", (price, sender))
-                cur.execute("INSERT INTO nfts (owner_id, filename, name, minted_at) VALUES (?,?,?,?)", (target, fname, name, str(datetime.now())))
-                cur.execute("INSERT INTO messages (sender_id, target_id, target_type, content, timestamp, attachment_type, attachment_filename, status) VALUES (?,?,?,?,?,?,?,?)", (sender, target, 'private', name, str(datetime.now()), 'gift', fname, 'sent'))
-                db.commit()
-                utils.broadcast_to_user(target, {"event": "new_gift", "from": sender}); utils.broadcast_to_user(target, {"event": "gift_anim"})
-                utils.broadcast_to_user(sender, {"event": "gift_anim"})
-                return {"status": "ok", "new_balance": current_units - price}
-
-            elif action == 'get_user_gifts':
-                uid = payload['user_id']
-                viewer = payload.get('viewer_id')
-                if str(uid) == "0": return {"status": "ok", "gifts": []}
-                if str(viewer) == str(uid): cur.execute("SELECT id, filename, name, minted_at, is_hidden FROM nfts WHERE owner_id=?", (uid,))
-                else: cur.execute("SELECT id, filename, name, minted_at, is_hidden FROM nfts WHERE owner_id=? AND is_hidden=0", (uid,))
-                return {"status": "ok", "gifts": [{"id": r[0], "filename": r[1], "name": r[2], "date": r[3], "hidden": r[4]} for r in cur.fetchall()]}
-
-            elif action == 'get_friends_data':
-                uid = payload['id']
-                cur.execute('''SELECT u.id, u.username, u.discriminator, u.avatar_color, u.avatar_image, u.about_me, u.banner_color, u.banner_image, u.custom_status, u.nickname_color, u.avatar_decoration, u.units, u.profile_music
-                    FROM users u JOIN friends f ON (u.id=f.friend_id OR u.id=f.user_id)
-                    WHERE (f.user_id=? OR f.friend_id=?) AND f.status='accepted' AND u.id!=?''', (uid, uid, uid))
-                
-                friends = []
-                for r in cur.fetchall():
-                    friends.append({
-                        "id": r[0], "username": r[1], "tag": r[2], "color": r[3], "image": r[4], 
-                        "about": r[5], "banner": r[6], "banner_image": r[7], "status_text": r[8], 
-                        "nick_color": r[9], "decoration": r[10], 
-                        "units": r[11] if r[11] is not None else 0,
-                        "profile_music": r[12]
-                    })
-                
-                cur.execute("SELECT units FROM users WHERE id=?", (uid,))
-                my_res = cur.fetchone()
-                my_units = my_res[0] if my_res else 0
-
-                try:
-                    cur.execute("SELECT * FROM users WHERE id=0")
-                    bot = cur.fetchone()
-                    if bot:
-                        friends.insert(0, {
-                            "id": 0, "username": "NovCord", "tag": "0000", "color": "#5865F2", "image": None,
-                            "about": "Official Bot", "banner": "black", "banner_image": None,
-                            "status_text": "SYSTEM", "nick_color": "white", "decoration": None, "units": 0,
-                            "is_bot": True, "profile_music": None
-                        })
-                except: pass
-
-                cur.execute("SELECT u.id, u.username, u.discriminator FROM users u JOIN friends f ON u.id=f.user_id WHERE f.friend_id=? AND f.status='pending'", (uid,))
-                reqs = [{"id":r[0], "username":r[1], "tag":r[2]} for r in cur.fetchall()]
-                
-                cur.execute('''SELECT g.id, g.name, g.avatar_color, g.owner_id, g.avatar_image, g.banner_image FROM groups g JOIN group_members gm ON g.id=gm.group_id WHERE gm.user_id=?''', (uid,))
-                groups = [{"id":r[0], "name":r[1], "color":r[2], "owner":r[3], "image": r[4], "banner": r[5], "type": "group"} for r in cur.fetchall()]
-                
-                return {"status": "ok", "friends": friends, "requests": reqs, "groups": groups, "my_units": my_units}
-
-            elif action == 'add_friend':
-                uid, target = payload['from'], payload['target'].lower()
-                try:
-                    name, tag = target.split('#')
-                    cur.execute("SELECT id FROM users WHERE username=? AND discriminator=?", (name, tag))
-                    res = cur.fetchone()
-                    if not res: return {"status": "error", "msg": "Не найден"}
-                    tid = res[0]
-                    if tid == uid: return {"status": "error", "msg": "Это вы"}
-                    cur.execute("SELECT * FROM friends WHERE (user_id=? AND friend_id=?) OR (user_id=? AND friend_id=?)", (uid, tid, tid, uid))
-                    if cur.fetchone(): return {"status": "error", "msg": "Уже друзья"}
-                    cur.execute("INSERT INTO friends (user_id, friend_id, status) VALUES (?,?,'pending')", (uid, tid))
-                    db.commit(); utils.broadcast_to_user(tid, {"event": "update_friends"})
-                    return {"status": "ok"}
-                except: return {"status": "error", "msg": "Формат: User#0000"}
-
-            elif action == 'accept_friend':
-                cur.execute("UPDATE friends SET status='accepted' WHERE user_id=? AND friend_id=?", (payload['target_id'], payload['my_id']))
-                db.commit(); utils.broadcast_to_user(payload['target_id'], {"event": "update_friends"})
-                return {"status": "ok"}
-            
-            elif action == 'block_user':
-                uid, tid = payload['user_id'], payload['blocked_id']
-                if str(tid) == "0": return {"status": "error", "msg": "Cannot block bot"}
-                cur.execute("INSERT OR IGNORE INTO user_blocks (user_id, blocked_id) VALUES (?,?)", (uid, tid))
-                db.commit()
-                utils.broadcast_to_user(tid, {"event": "update_friends"}) 
-                return {"status": "ok"}
-            
-            elif action == 'unblock_user':
-                uid, tid = payload['user_id'], payload['blocked_id']
-                cur.execute("DELETE FROM user_blocks WHERE user_id=? AND blocked_id=?", (uid, tid))
-                db.commit()
-                return {"status": "ok"}
-
-            elif action == 'delete_chat_history':
-                uid, tid = payload['user_id'], payload['target_id']
-                if str(tid) == "0": return {"status": "error", "msg": "Cannot delete bot chat"}
-                cur.execute("DELETE FROM messages WHERE (sender_id=? AND target_id=? AND target_type='private') OR (sender_id=? AND target_id=? AND target_type='private')", (uid, tid, tid, uid))
-                db.commit()
-                utils.broadcast_to_user(uid, {"event": "new_msg", "chat_id": tid, "type": "private"}) 
-                utils.broadcast_to_user(tid, {"event": "new_msg", "chat_id": uid, "type": "private"})
-                return {"status": "ok"}
-
-            elif action == 'create_group':
-                members = payload['members']
-                if 'invite_user' in payload and payload['invite_user']:
-                    try:
-                        nm, tg = payload['invite_user'].lower().split('#')
-                        cur.execute("SELECT id FROM users WHERE username=? AND discriminator=?", (nm, tg))
-                        usr = cur.fetchone()
-                        if usr:
-                            cur.execute("SELECT * FROM group_blacklist WHERE user_id=?", (usr[0],))
-                            if usr[0] not in members: members.append(usr[0])
-                    except: pass
-                cur.execute("INSERT INTO groups (name, owner_id, avatar_color) VALUES (?,?,?)", (payload['name'], payload['owner_id'], '#5865F2'))
-                gid = cur.lastrowid
-                for m_id in members: cur.execute("INSERT INTO group_members (group_id, user_id) VALUES (?,?)", (gid, m_id))
-                db.commit()
-                for m_id in members: utils.broadcast_to_user(m_id, {"event": "update_friends"})
-                return {"status": "ok"}
-            
-            elif action == 'update_group':
-                gid = payload['group_id']
-                fname = utils.save_file_to_disk(payload['image_b64']) if payload.get('image_b64') else None
-                bfname = utils.save_file_to_disk(payload['banner_b64'], "gif" if payload.get('is_gif_bn') else "png") if payload.get('banner_b64') else None
-                sql = "UPDATE groups SET name=?, avatar_color=?"; params = [payload['name'], payload['color']]
-                if fname: sql += ", avatar_image=?"; params.append(fname)
-                if bfname: sql += ", banner_image=?"; params.append(bfname)
-                sql += " WHERE id=?"; params.append(gid)
-                cur.execute(sql, params); db.commit()
-                cur.execute("SELECT user_id FROM group_members WHERE group_id=?", (gid,))
-                for m in cur.fetchall(): utils.broadcast_to_user(m[0], {"event": "update_friends"})
-                return {"status": "ok"}
-
-            elif action == 'invite_group_user':
-                gid, target = payload['group_id'], payload['target']
-                try:
-                    tid = None
-                    if isinstance(target, int): tid = target
-                    else:
-                        nm, tg = target.lower().split('#')
-                        cur.execute("SELECT id FROM users WHERE username=? AND discriminator=?", (nm, tg))
-                        res = cur.fetchone(); 
-                        if res: tid = res[0]
-                    if not tid: return {"status": "error", "msg": "Пользователь не найден"}
-                    cur.execute("SELECT * FROM group_blacklist WHERE group_id=? AND user_id=?", (gid, tid))
-                    if cur.fetchone(): return {"status": "error", "msg": "Пользователь в черном списке"}
-                    cur.execute("SELECT * FROM group_members WHERE group_id=? AND user_id=?", (gid, tid))
-                    if cur.fetchone(): return {"status": "error", "msg": "Уже участник"}
-                    cur.execute("INSERT INTO group_members (group_id, user_id) VALUES (?,?)", (gid, tid))
-                    db.commit(); utils.broadcast_to_user(tid, {"event": "update_friends"})
-                    return {"status": "ok", "msg": "Приглашен"}
-                except: return {"status": "error", "msg": "Ошибка"}
-
-            elif action == 'leave_group':
-                gid, uid = payload['group_id'], payload['user_id']
-                cur.execute("DELETE FROM group_members WHERE group_id=? AND user_id=?", (gid, uid))
-                db.commit()
-                cur.execute("SELECT user_id FROM group_members WHERE group_id=?", (gid,))
-                for m in cur.fetchall(): utils.broadcast_to_user(m[0], {"event": "new_msg", "chat_id": gid, "type": "group"})
-                return {"status": "ok"}
-            
-            elif action == 'delete_group':
-                gid, uid = payload['group_id'], payload['user_id']
-                cur.execute("SELECT owner_id FROM groups WHERE id=?", (gid,))
-                res = cur.fetchone()
-                if res and res[0] == uid:
-                    cur.execute("SELECT user_id FROM group_members WHERE group_id=?", (gid,))
-                    members = cur.fetchall()
-                    cur.execute("DELETE FROM group_members WHERE group_id=?", (gid,))
-                    cur.execute("DELETE FROM groups WHERE id=?", (gid,))
-                    cur.execute("DELETE FROM group_blacklist WHERE group_id=?", (gid,))
-                    db.commit()
-                    for m in members: utils.broadcast_to_user(m[0], {"event": "update_friends"})
-                    return {"status": "ok"}
-                return {"status": "error", "msg": "Not owner"}
-
-            elif action == 'kick_group_user':
-                gid, uid = payload['group_id'], payload['user_id']
-                cur.execute("DELETE FROM group_members WHERE group_id=? AND user_id=?", (gid, uid)); db.commit()
-                utils.broadcast_to_user(uid, {"event": "update_friends"})
-                cur.execute("SELECT user_id FROM group_members WHERE group_id=?", (gid,))
-                for m in cur.fetchall(): utils.broadcast_to_user(m[0], {"event": "new_msg", "chat_id": gid, "type": "group"})
-                return {"status": "ok"}
-
-            elif action == 'ban_group_user':
-                gid, uid = payload['group_id'], payload['user_id']
-                cur.execute("DELETE FROM group_members WHERE group_id=? AND user_id=?", (gid, uid))
-                cur.execute("INSERT INTO group_blacklist (group_id, user_id) VALUES (?,?)", (gid, uid)); db.commit()
-                utils.broadcast_to_user(uid, {"event": "update_friends"})
-                return {"status": "ok"}
-
-            elif action == 'unban_group_user':
-                gid, uid = payload['group_id'], payload['user_id']
-                cur.execute("DELETE FROM group_blacklist WHERE group_id=? AND user_id=?", (gid, uid)); db.commit()
-                return {"status": "ok"}
-
-            elif action == 'get_group_blacklist':
-                cur.execute('''SELECT u.id, u.username, u.discriminator, u.avatar_image FROM users u JOIN group_blacklist gb ON u.id=gb.user_id WHERE gb.group_id=?''', (payload['group_id'],))
-                return {"status": "ok", "blacklist": [{"id":r[0], "username":r[1], "tag":r[2], "image":r[3]} for r in cur.fetchall()]}
-
-            elif action == 'get_group_members':
-                cur.execute('''SELECT u.id, u.username, u.discriminator, u.avatar_color, u.avatar_image, u.nickname_color, u.avatar_decoration, u.units
-                               FROM users u JOIN group_members gm ON u.id=gm.user_id WHERE gm.group_id=?''', (payload['group_id'],))
-                return {"status": "ok", "members": [{"id":r[0], "username":r[1], "tag":r[2], "color":r[3], "image":r[4], "nick_color":r[5], "decoration":r[6], "units": r[7] if r[7] is not None else 0} for r in cur.fetchall()]}
-
-            elif action == 'send_msg':
-                sender, target = payload['sender'], payload['target']
-                
-                if payload['type'] == 'private':
-                    cur.execute("SELECT * FROM user_blocks WHERE user_id=? AND blocked_id=?", (target, sender))
-                    if cur.fetchone():
-                        return {"status": "blocked"}
-
-                att_fname = None
-                if payload.get('att_data'):
-                    ext = "mp4" if payload.get('att_type') == 'video' else "png"
-                    if payload.get('att_type') == 'gif': ext = "gif"
-                    if payload.get('att_type') == 'audio': ext = "mp3"
-                    if payload.get('att_type') == 'voice': ext = "wav"
-                    att_fname = utils.save_file_to_disk(payload['att_data'], ext)
-                elif payload.get('att_type') == 'sticker':
-                    att_fname = payload['text'] 
-                elif payload.get('att_file'): # Forwarded file logic
-                    att_fname = payload['att_file']
-                
-                cur.execute("INSERT INTO messages (sender_id, target_id, target_type, content, timestamp, reply_to_id, attachment_type, attachment_filename, status, forward_from_id) VALUES (?,?,?,?,?,?,?,?,?,?)",
-                            (sender, target, payload['type'], payload['text'], str(datetime.now()), payload.get('reply'), payload.get('att_type'), att_fname, 'sent', payload.get('forward_sender_id')))
-                msg_id = cur.lastrowid
-                db.commit()
-                
-                if payload['type'] == 'private':
-                    utils.broadcast_to_user(payload['target'], {"event": "new_msg", "chat_id": payload['sender'], "type": "private", "att_type": payload.get('att_type'), "att_data": payload.get('att_data'), "sender_id": sender})
-                    utils.broadcast_to_user(payload['sender'], {"event": "new_msg", "chat_id": payload['target'], "type": "private", "att_type": payload.get('att_type'), "att_data": payload.get('att_data'), "sender_id": sender})
-                else:
-                    cur.execute("SELECT user_id FROM group_members WHERE group_id=?", (payload['target'],))
-                    for m in cur.fetchall(): utils.broadcast_to_user(m[0], {"event": "new_msg", "chat_id": payload['target'], "type": "group", "att_type": payload.get('att_type'), "att_data": payload.get('att_data'), "sender_id": sender})
-                return {"status": "ok", "msg_id": msg_id}
-            
-            elif action == 'edit_msg':
-                cur.execute("SELECT sender_id, target_id, target_type FROM messages WHERE id=?", (payload['msg_id'],))
-                res = cur.fetchone()
-                if res and res[0] == payload['sender_id']:
-                    cur.execute("UPDATE messages SET content=?, is_edited=1 WHERE id=?", (payload['content'], payload['msg_id']))
-                    db.commit()
-                    if res[2] == 'private':
-                         utils.broadcast_to_user(res[1], {"event": "new_msg", "chat_id": res[0], "type": "private"})
-                         utils.broadcast_to_user(res[0], {"event": "new_msg", "chat_id": res[1], "type": "private"})
-                    else:
-                        cur.execute("SELECT user_id FROM group_members WHERE group_id=?", (res[1],))
-                        for m in cur.fetchall(): utils.broadcast_to_user(m[0], {"event": "new_msg", "chat_id": res[1], "type": "group"})
-                    return {"status": "ok"}
-                return {"status": "error"}
-
-            elif action == 'delete_msg':
-                cur.execute("SELECT sender_id, target_id, target_type FROM messages WHERE id=?", (payload['msg_id'],))
-                res = cur.fetchone()
-                if res and res[0] == payload['sender_id']:
-                    cur.execute("DELETE FROM messages WHERE id=?", (payload['msg_id'],))
-                    cur.execute("DELETE FROM message_reads WHERE message_id=?", (payload['msg_id'],))
-                    db.commit()
-                    if res[2] == 'private':
-                        utils.broadcast_to_user(res[1], {"event": "new_msg", "chat_id": res[0], "type": "private"})
-                        utils.broadcast_to_user(res[0], {"event": "new_msg", "chat_id": res[1], "type": "private"})
-                    else:
-                        cur.execute("SELECT user_id FROM group_members WHERE group_id=?", (res[1],))
-                        for m in cur.fetchall(): utils.broadcast_to_user(m[0], {"event": "new_msg", "chat_id": res[1], "type": "group"})
-                    return {"status": "ok"}
-                return {"status": "error"}
-
-            elif action == 'add_reaction':
-                mid, emoji = payload['msg_id'], payload['emoji']
-                cur.execute("SELECT reactions, target_id, target_type, sender_id FROM messages WHERE id=?", (mid,))
-                curr = cur.fetchone()
-                if curr:
-                    reacts = json.loads(curr[0])
-                    if emoji not in reacts: reacts[emoji] = []
-                    if payload['user_id'] not in reacts[emoji]: reacts[emoji].append(payload['user_id'])
-                    else:
-                        if payload['user_id'] in reacts[emoji]: reacts[emoji].remove(payload['user_id'])
-                        if not reacts[emoji]: del reacts[emoji]
-                    cur.execute("UPDATE messages SET reactions=? WHERE id=?", (json.dumps(reacts), mid))
-                    db.commit()
-                    if curr[2] == 'private':
-                        p1, p2 = curr[3], curr[1]; utils.broadcast_to_user(p1, {"event": "new_msg", "chat_id": p2, "type": "private"}); utils.broadcast_to_user(p2, {"event": "new_msg", "chat_id": p1, "type": "private"})
-                    else:
-                        cur.execute("SELECT user_id FROM group_members WHERE group_id=?", (curr[1],))
-                        for m in cur.fetchall(): utils.broadcast_to_user(m[0], {"event": "new_msg", "chat_id": curr[1], "type": "group"})
-                    return {"status": "ok"}
-                return {"status": "error"}
-
-            elif action == 'get_chat':
-                my_id, t_id, t_type = payload['my_id'], payload['target_id'], payload['target_type']
-                
-                is_blocked = False
-                if t_type == 'private':
-                    cur.execute("SELECT * FROM messages WHERE target_type='private' AND ((sender_id=? AND target_id=?) OR (sender_id=? AND target_id=?))", (my_id, t_id, t_id, my_id))
-                    cur2 = db.cursor()
-                    cur2.execute("SELECT * FROM user_blocks WHERE user_id=? AND blocked_id=?", (my_id, t_id))
-                    if cur2.fetchone(): is_blocked = True
-                else:
-                    cur.execute("SELECT * FROM messages WHERE target_type='group' AND target_id=?", (t_id,))
-                
-                msgs = []
-                for r in cur.fetchall():
-                    # r[1] is sender_id
-                    cur.execute("SELECT username, avatar_color, avatar_image, nickname_color, avatar_decoration FROM users WHERE id=?", (r[1],))
-                    u = cur.fetchone()
-                    
-                    # Forward info
-                    forward_name, forward_color, forward_img = None, None, None
-                    if len(r) > 12 and r[12]: # forward_from_id column
-                         cur.execute("SELECT username, avatar_color, avatar_image FROM users WHERE id=?", (r[12],))
-                         fu = cur.fetchone()
-                         if fu: forward_name, forward_color, forward_img = fu[0], fu[1], fu[2]
-
-                    reply_text = None
-                    if r[6]:
-                        cur.execute("SELECT username, content, attachment_filename FROM messages m JOIN users u ON m.sender_id=u.id WHERE m.id=?", (r[6],))
-                        rep = cur.fetchone()
-                        if rep: reply_text = rep[2] if rep[2] else rep[1]
-
-                    read_count = 0
-                    if t_type == 'group':
-                        cur.execute("SELECT COUNT(*) FROM message_reads WHERE message_id=?", (r[0],))
-                        read_count = cur.fetchone()[0]
-
-                    status = 'sent'
-                    if len(r) > 11 and r[11]:
-                        status = r[11]
-
-                    msgs.append({
-                        "id": r[0], "sender_id": r[1], "content": r[4], "time": r[5], "reply_id": r[6], "reply_text": reply_text,
-                        "is_edited": r[7], "att_type": r[8], "att_file": r[9], "attachment_filename": r[9],
-                        "reactions": json.loads(r[10]) if r[10] else {},
-                        "status": status,
-                        "read_count": read_count,
-                        "sender_name": u[0] if u else "?", "sender_color": u[1] if u else "grey", "sender_image": u[2] if u else None,
-                        "nick_color": u[3] if u else "white", "decoration": u[4],
-                        "forward_from": forward_name, "forward_sender_color": forward_color, "forward_sender_image": forward_img
-                    })
-                return {"status": "ok", "messages": msgs, "is_blocked": is_blocked}
-
-            elif action == 'update_profile':
-                av_fname = utils.save_file_to_disk(payload['avatar_b64'], "gif" if payload.get('is_gif_av') else "png") if payload.get('avatar_b64') else None
-                bn_fname = utils.save_file_to_disk(payload['banner_b64'], "gif" if payload.get('is_gif_bn') else "png") if payload.get('banner_b64') else None
-                dec_fname = utils.save_file_to_disk(payload['decor_b64'], "gif") if payload.get('decor_b64') else None
-                bg_fname = utils.save_file_to_disk(payload['bg_b64'], "jpg") if payload.get('bg_b64') and payload.get('bg_b64') != 'reset' else None
-                
-                sql = "UPDATE users SET username=?, about_me=?, banner_color=?, custom_status=?, nickname_color=?"
-                params = [payload['username'], payload['about'], payload['banner'], payload['custom_status'], payload['nickname_color']]
-                if av_fname: sql += ", avatar_image=?"; params.append(av_fname)
-                if bn_fname: sql += ", banner_image=?"; params.append(bn_fname)
-                if dec_fname: sql += ", avatar_decoration=?"; params.append(dec_fname)
-                if bg_fname: sql += ", chat_bg=?"; params.append(bg_fname)
-                elif payload.get('bg_b64') == 'reset': sql += ", chat_bg=?"; params.append(None)
-                
-                sql += " WHERE id=?"; params.append(payload['id'])
-                cur.execute(sql, params); db.commit()
-                utils.broadcast_all({"event": "profile_updated", "user_id": payload['id']})
-                return {"status": "ok", "new_avatar": av_fname, "new_banner": bn_fname, "new_decor": dec_fname, "new_bg": bg_fname}
-
-            elif action == 'admin_get_all_users':
-                cur.execute("SELECT id, username, discriminator, email, is_blocked, is_admin FROM users")
-                return {"status": "ok", "users": [{"id":r[0], "tag":f"{r[1]}#{r[2]}", "email":r[3], "blocked":r[4], "is_admin":r[5]} for r in cur.fetchall()]}
-            elif action == 'admin_ban_user':
-                cur.execute("UPDATE users SET is_blocked=1, ban_reason=? WHERE id=?", (payload.get('reason', 'Нарушение правил'), payload['target_id']))
-                db.commit(); return {"status": "ok"}
-            elif action == 'admin_unban_user':
-                cur.execute("UPDATE users SET is_blocked=0 WHERE id=?", (payload['target_id'],)); db.commit(); return {"status": "ok"}
-            elif action == 'admin_broadcast_msg':
-                target_id = payload.get('target_id')
-                text = payload['text']
-                if target_id is not None:
-                    cur.execute("INSERT INTO messages (sender_id, target_id, target_type, content, timestamp, status) VALUES (0, ?, 'private', ?, ?, 'sent')",
-                                (target_id, text, str(datetime.now())))
-                    db.commit()
-                    utils.broadcast_to_user(target_id, {"event": "new_msg", "chat_id": 0, "type": "private"})
-                else:
-                    cur.execute("SELECT id FROM users WHERE id != 0")
-                    users = cur.fetchall()
-                    for u in users:
-                        cur.execute("INSERT INTO messages (sender_id, target_id, target_type, content, timestamp, status) VALUES (0, ?, 'private', ?, ?, 'sent')",
-                                    (u[0], text, str(datetime.now())))
-                        utils.broadcast_to_user(u[0], {"event": "new_msg", "chat_id": 0, "type": "private"})
-                    db.commit()
-                return {"status": "ok"}
-            elif action == 'admin_add_units':
-                cur.execute("UPDATE users SET units = units + ? WHERE id=?", (payload['amount'], payload['target_id']))
-                db.commit()
-                utils.broadcast_to_user(payload['target_id'], {"event": "profile_updated", "user_id": payload['target_id']})
-                return {"status": "ok"}
-            
-            elif action == 'get_mutual_info':
-                return {"status": "ok", "mutual_friends": [], "mutual_groups": []}
-            
-            elif action == 'update_profile_music':
-                uid, track_src, track_name = payload['user_id'], payload['track_src'], payload['track_name']
-                music_data = json.dumps({"src": track_src, "name": track_name})
-                cur.execute("UPDATE users SET profile_music=? WHERE id=?", (music_data, uid))
-                db.commit()
-                utils.broadcast_all({"event": "profile_updated", "user_id": uid})
-                return {"status": "ok"}
-
-            elif action == 'mark_messages_read':
-                user_id = payload['user_id']
-                chat_id = payload['chat_id']
-                chat_type = payload['chat_type']
-                if chat_type == 'private':
-                    cur.execute("SELECT id FROM messages WHERE target_type='private' AND sender_id=? AND target_id=? AND status != 'read'", (chat_id, user_id))
-                else:
-                    cur.execute("SELECT id FROM messages WHERE target_type='group' AND target_id=? AND sender_id != ?", (chat_id, user_id))
-                msg_ids = [r[0] for r in cur.fetchall()]
-                for mid in msg_ids:
-                    cur.execute("INSERT OR IGNORE INTO message_reads (message_id, user_id, read_at) VALUES (?,?,?)", (mid, user_id, str(datetime.now())))
-                    if chat_type == 'private': cur.execute("UPDATE messages SET status='read' WHERE id=?", (mid,))
-                db.commit()
-                if chat_type == 'private' and msg_ids:
-                    utils.broadcast_to_user(chat_id, {"event": "messages_read", "chat_id": user_id, "type": "private"})
-                return {"status": "ok"}
-
-            elif action == 'get_message_readers':
-                msg_id = payload['message_id']
-                cur.execute("SELECT u.id, u.username, u.discriminator, u.avatar_color, u.avatar_image, mr.read_at FROM message_reads mr JOIN users u ON mr.user_id = u.id WHERE mr.message_id = ?", (msg_id,))
-                readers = [{"id": r[0], "username": r[1], "tag": r[2], "color": r[3], "image": r[4], "read_at": r[5]} for r in cur.fetchall()]
-                return {"status": "ok", "readers": readers}
-
-        except Exception as e: 
-            import traceback
-            traceback.print_exc()
-            return {"status": "error", "msg": str(e)}
-        finally: db.close()
-    return {"status": "error"}
\ No newline at end of file
+                    "chat_type": "private"
+                })
+
+                event = {"event": "voice_update", "type": "join", "user_id": uid, "chat_id": uid} # Send caller ID as chat_id for mapping
+                utils.broadcast_to_user(target_id, event)
+                utils.broadcast_to_user(uid, event)
+        except: pass
+    else:
+        event = {"event": "voice_update", "type": "join", "user_id": uid, "chat_id": channel_id}
+        cur.execute(GROUP_MEMBER_IDS_SQL, (channel_id,))
+        for m in cur.fetchall():
+            utils.broadcast_to_user(m[0], event)
+
+    return {"status": "ok"}
+
+@action('leave_voice', required=('user_id', 'chat_id', 'chat_type'))
+def handle_leave_voice(db, cur, payload):
+    uid = payload['user_id']
+    channel_id = str(payload['chat_id'])
+    voice_server.leave_channel(uid)
+
+    # Check empty logic removed for simplicity to ensure "leave" event always fires
+    is_empty = False 
+
+    if payload['chat_type'] == 'private':
+        try:
+            parts = channel_id.split('_')
+            if len(parts) == 3:
+                id1, id2 = int(parts[1]), int(parts[2])
+                target_id = id1 if id1 != uid else id2
+
+                event = {"event": "voice_update", "type": "leave", "user_id": uid, "chat_id": uid, "is_empty": is_empty}
+                utils.broadcast_to_user(target_id, event)
+        except: pass
+    else:
+        event = {"event": "voice_update", "type": "leave", "user_id": uid, "chat_id": channel_id, "is_empty": is_empty}
+        cur.execute(GROUP_MEMBER_IDS_SQL, (channel_id,))
+        for m in cur.fetchall():
+            utils.broadcast_to_user(m[0], event)
+
+    return {"status": "ok"}
+
+@action('voice_state', required=('user_id', 'chat_id', 'chat_type'))
+def handle_voice_state(db, cur, payload):
+    # NEW: Sync Mute/Deafen state
+    uid = payload['user_id']
+    channel_id = str(payload['chat_id'])
+    is_muted = payload.get('is_muted', False)
+    is_deafened = payload.get('is_deafened', False)
+
+    event = {
+        "event": "voice_state_update",
+        "user_id": uid,
+        "chat_id": channel_id,
+        "is_muted": is_muted,
+        "is_deafened": is_deafened
+    }
+
+    if payload['chat_type'] == 'private':
+        try:
+            parts = channel_id.split('_')
+            if len(parts) == 3:
+                id1, id2 = int(parts[1]), int(parts[2])
+                target_id = id1 if id1 != uid else id2
+                utils.broadcast_to_user(target_id, event)
+        except: pass
+    else:
+        cur.execute(GROUP_MEMBER_IDS_SQL, (channel_id,))
+        for m in cur.fetchall():
+            if m[0] != uid: # Don't send back to self necessarily, but useful for confirm
+                utils.broadcast_to_user(m[0], event)
+
+    return {"status": "ok"}
+
+@action('get_voice_participants', required=('chat_id',))
+def handle_get_voice_participants(db, cur, payload):
+    channel_id = str(payload['chat_id'])
+    participants = []
+    speaking = set(voice_server.get_speaking(channel_id))
+    members = voice_server.get_channel_members(channel_id)
+    profiles = profile_cache.get_many(cur, members)
+    for uid in members:
+        u = profiles.get(int(uid))
+        if u:
+            participants.append({
+                "id": u["id"], "username": u["username"], "color": u["avatar_color"], "image": u["avatar_image"],
+                "speaking": u["id"] in speaking
+            })
+    return {"status": "ok", "participants": participants}
+
+# --- ASSETS SYNC ---
+
+@action('get_assets_index', db=False)
+def handle_get_assets_index(db, cur, payload):
+    # Хеши берутся из file_index; при совпадении known_version список не отправляется
+    version, assets = file_index.assets()
+    if payload.get('known_version') == version:
+        return {"status": "ok", "version": version, "unchanged": True}
+    return {"status": "ok", "assets": assets, "version": version}
+
+ASSET_TYPE_DIRS = {"banners": cfg.ASSETS_BANNERS_DIR, "rams": cfg.ASSETS_RAMS_DIR, "chat_backgrounds": cfg.ASSETS_CHAT_BG_DIR, "bot_avatar": cfg.ASSETS_BOT_AVATAR_DIR}
+
+@action('get_asset_file', required=('type', 'filename'), db=False)
+def handle_get_asset_file(db, cur, payload):
+    asset_type = payload['type']
+    filename = payload['filename']
+    if ".." in filename or "/" in filename or "\\" in filename: return {"status": "error", "msg": "Invalid filename"}
+    if asset_type not in ASSET_TYPE_DIRS: return {"status": "error", "msg": "Invalid type"}
+    path = os.path.join(ASSET_TYPE_DIRS[asset_type], filename)
+    b64 = utils.load_file_b64(path)
+    return {"status": "ok", "b64": b64, "filename": filename} if b64 else {"status": "error", "msg": "Not found"}
+
+# --- USER CACHE SYNC ---
+
+@action('get_user_cache_index', required=('user_id',), db=False)
+def handle_get_user_cache_index(db, cur, payload):
+    version, files = file_index.user_cache(payload['user_id'])
+    if payload.get('known_version') == version:
+        return {"status": "ok", "version": version, "unchanged": True}
+    return {"status": "ok", "files": files, "version": version}
+
+def is_plain_filename(name):
+    """Имя файла без каталогов: не абсолютное, без / и \\, не . и .."""
+    return (isinstance(name, str) and name not in ("", ".", "..") and os.path.basename(name) == name
+            and not os.path.isabs(name) and "/" not in name and "\\" not in name)
+
+@action('upload_cache_file', required=('user_id', 'filename', 'b64'), db=False)
+def handle_upload_cache_file(db, cur, payload):
+    user_id, filename, b64_data = payload['user_id'], payload['filename'], payload['b64']
+    if not is_plain_filename(filename) or ".." in filename: return {"status": "error"}
+    cache_dir = os.path.join(cfg.UPLOAD_DIR, f"user_cache_{user_id}")
+    if not os.path.exists(cache_dir): os.makedirs(cache_dir)
+    try:
+        with open(os.path.join(cache_dir, filename), "wb") as f:
+            f.write(base64.b64decode(b64_data))
+        file_index.refresh_user_cache(user_id)
+        return {"status": "ok"}
+    except: return {"status": "error"}
+
+@action('get_cache_file', required=('user_id', 'filename'), db=False)
+def handle_get_cache_file(db, cur, payload):
+    user_id, filename = payload['user_id'], payload['filename']
+    if not is_plain_filename(filename) or ".." in filename: return {"status": "error"}
+    path = os.path.join(cfg.UPLOAD_DIR, f"user_cache_{user_id}", filename)
+    b64 = utils.load_file_b64(path)
+    return {"status": "ok", "b64": b64} if b64 else {"status": "error"}
+
+# --- FILES ---
+
+@action('get_file_content', required=('filename',), db=False)
+def handle_get_file_content(db, cur, payload):
+    fname = payload['filename']
+    is_sticker, is_nft = payload.get('is_sticker', False), payload.get('is_nft', False)
+    path = fname 
+    if is_sticker: path = os.path.join(cfg.STICKERS_DIR, fname)
+    elif is_nft: path = os.path.join(cfg.NFTS_DIR, fname)
+    else: path = store.resolve(fname)
+    if ".." in path or os.path.isabs(fname): return {"status": "error"}
+    return {"status": "ok", "b64": utils.load_file_b64(path)}
+
+# --- CHUNKED TRANSFER ---
+# Файлы передаются кусками по TRANSFER_CHUNK_SIZE, поэтому память на передачу
+# не зависит от размера файла. Незавершённая загрузка хранится в PARTIAL_UPLOAD_DIR
+# (<id>.part + <id>.json) и может быть продолжена после переподключения.
+
+def resolve_download_path(payload):
+    """Путь для get_file_chunk по тем же правилам, что у get_file_content / get_asset_file / get_cache_file"""
+    source, fname = payload.get('source', 'file'), payload['filename']
+    if not isinstance(fname, str) or ".." in fname or os.path.isabs(fname): return None
+    if source == 'asset':
+        if not is_plain_filename(fname) or payload.get('type') not in ASSET_TYPE_DIRS: return None
+        return os.path.join(ASSET_TYPE_DIRS[payload['type']], fname)
+    if source == 'cache':
+        if not is_plain_filename(fname): return None
+        return os.path.join(cfg.UPLOAD_DIR, f"user_cache_{payload.get('user_id')}", fname)
+    if payload.get('is_sticker'): return os.path.join(cfg.STICKERS_DIR, fname)
+    if payload.get('is_nft'): return os.path.join(cfg.NFTS_DIR, fname)
+    return store.resolve(fname)
+
+@action('get_file_chunk', required=('filename',), db=False)
+def handle_get_file_chunk(db, cur, payload):
+    offset = max(0, int_param(payload, 'offset', 0))
+    # length <= 0 - кусок по умолчанию: f.read(-1) прочитал бы файл целиком
+    length = int_param(payload, 'length', 0)
+    length = cfg.TRANSFER_CHUNK_SIZE if length <= 0 else min(length, cfg.TRANSFER_CHUNK_SIZE)
+    b64, size, read = utils.read_file_chunk(resolve_download_path(payload), offset, length)
+    if b64 is None: return {"status": "error", "msg": "Not found"}
+    return {"status": "ok", "b64": b64, "offset": offset, "size": size, "eof": offset + read >= size}
+
+def upload_paths(upload_id):
+    if not upload_id or not all(c in string.hexdigits for c in upload_id): return None, None
+    base = os.path.join(cfg.PARTIAL_UPLOAD_DIR, upload_id)
+    return base + ".part", base + ".json"
+
+def load_upload(upload_id):
+    part_path, meta_path = upload_paths(upload_id)
+    if not meta_path or not os.path.exists(meta_path): return None, None, None
+    with open(meta_path, "r", encoding="utf-8") as f:
+        return json.load(f), part_path, meta_path
+
+def cleanup_expired_uploads():
+    now = time.time()
+    for f in os.listdir(cfg.PARTIAL_UPLOAD_DIR):
+        path = os.path.join(cfg.PARTIAL_UPLOAD_DIR, f)
+        try:
+            if now - os.path.getmtime(path) > cfg.UPLOAD_EXPIRE_SECONDS: os.remove(path)
+        except OSError: pass
+
+@action('upload_begin', required=('user_id', 'size'), db=False)
+def handle_upload_begin(db, cur, payload):
+    """
+    target="attachment" (по умолчанию) - файл попадёт в server_files, его имя затем передаётся в send_msg как att_file;
+    target="cache" - файл попадёт в user_cache_<id>/<filename>, как upload_cache_file.
+    """
+    size, target = int_param(payload, 'size'), payload.get('target', 'attachment')
+    if size < 0 or size > cfg.MAX_UPLOAD_SIZE: return {"status": "error", "msg": "File too large"}
+    meta = {"user_id": payload['user_id'], "size": size, "target": target}
+    if target == 'cache':
+        filename = payload.get('filename') or ""
+        # Имя склеивается с user_cache_<id> в upload_finish: абсолютный путь или каталоги вывели бы файл наружу
+        if not is_plain_filename(filename) or ".." in filename: return {"status": "error", "msg": "Invalid filename"}
+        meta["filename"] = filename
+    else:
+        ext = str(payload.get('ext', 'bin'))
+        if not ext.isalnum() or len(ext) > 5: return {"status": "error", "msg": "Invalid extension"}
+        meta["ext"] = ext
+
+    cleanup_expired_uploads()
+    upload_id = uuid.uuid4().hex
+    part_path, meta_path = upload_paths(upload_id)
+    open(part_path, "wb").close()
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    return {"status": "ok", "upload_id": upload_id, "chunk_size": cfg.TRANSFER_CHUNK_SIZE}
+
+@action('upload_status', required=('upload_id',), db=False)
+def handle_upload_status(db, cur, payload):
+    """Сколько байт уже принято - с этого смещения клиент продолжает загрузку"""
+    meta, part_path, _ = load_upload(payload['upload_id'])
+    if not meta: return {"status": "error", "msg": "Unknown upload"}
+    return {"status": "ok", "received": os.path.getsize(part_path), "size": meta["size"]}
+
+@action('upload_chunk', required=('upload_id', 'offset', 'b64'), db=False)
+def handle_upload_chunk(db, cur, payload):
+    meta, part_path, _ = load_upload(payload['upload_id'])
+    if not meta: return {"status": "error", "msg": "Unknown upload"}
+    received = os.path.getsize(part_path)
+    offset, data = int_param(payload, 'offset'), base64.b64decode(payload['b64'])
+    if len(data) > cfg.TRANSFER_CHUNK_SIZE or offset + len(data) > meta["size"]:
+        return {"status": "error", "msg": "Chunk too large", "received": received}
+    # Куски принимаются строго по порядку; повтор уже принятого куска просто подтверждается
+    if offset != received:
+        if offset + len(data) <= received: return {"status": "ok", "received": received}
+        return {"status": "error", "msg": "Unexpected offset", "received": received}
+    with open(part_path, "ab") as f:
+        f.write(data)
+    return {"status": "ok", "received": received + len(data)}
+
+@action('upload_finish', required=('upload_id',), db=False)
+def handle_upload_finish(db, cur, payload):
+    meta, part_path, meta_path = load_upload(payload['upload_id'])
+    if not meta: return {"status": "error", "msg": "Unknown upload"}
+    received = os.path.getsize(part_path)
+    if received != meta["size"]:
+        return {"status": "error", "msg": "Upload incomplete", "received": received}
+
+    if meta["target"] == 'cache':
+        cache_dir = os.path.join(cfg.UPLOAD_DIR, f"user_cache_{meta['user_id']}")
+        if not os.path.exists(cache_dir): os.makedirs(cache_dir)
+        os.replace(part_path, os.path.join(cache_dir, meta["filename"]))
+        filename = meta["filename"]
+        file_index.refresh_user_cache(meta['user_id'])
+    else:
+        filename = utils.move_file_to_uploads(part_path, meta["ext"])
+    os.remove(meta_path)
+    return {"status": "ok", "filename": filename}
+
+@action('get_stickers_index', db=False)
+def handle_get_stickers_index(db, cur, payload):
+    index = {}
+    if os.path.exists(cfg.STICKERS_DIR):
+        for pack in os.listdir(cfg.STICKERS_DIR):
+            pack_path = os.path.join(cfg.STICKERS_DIR, pack)
+            if os.path.isdir(pack_path):
+                files = [f for f in os.listdir(pack_path) if f.lower().endswith(('.png', '.gif', '.jpg'))]
+                if files: index[pack] = files
+    return {"status": "ok", "data": index}
+
+@action('get_server_nfts_assets', db=False)
+def handle_get_server_nfts_assets(db, cur, payload):
+    files = []
+    if os.path.exists(cfg.NFTS_DIR):
+        files = [f for f in os.listdir(cfg.NFTS_DIR) if f.lower().endswith(('.gif', '.png', '.jpg'))]
+    return {"status": "ok", "files": files}
+
+@action('mint_gift', write=True, required=('sender_id', 'target_id', 'filename'))
+def handle_mint_gift(db, cur, payload):
+    sender, target, fname = payload['sender_id'], payload['target_id'], payload['filename']
+    name = os.path.splitext(fname)[0].replace('_', ' ').title()
+    price = 100
+    cur.execute("SELECT units FROM users WHERE id=?", (sender,))
+    res = cur.fetchone()
+    current_units = res[0] if res else 0
+    if current_units < price: return {"status": "error", "msg": "Недостаточно Units"}
+    cur.execute("UPDATE users SET units = units - ? WHERE id=?", (price, sender))
+    cur.execute("INSERT INTO nfts (owner_id, filename, name, minted_at) VALUES (?,?,?,?)", (target, fname, name, str(datetime.now())))
+    cur.execute("INSERT INTO messages (sender_id, target_id, target_type, content, timestamp, attachment_type, attachment_filename, status) VALUES (?,?,?,?,?,?,?,?)", (sender, target, 'private', name, str(datetime.now()), 'gift', fname, 'sent'))
+    db.commit()
+    profile_cache.invalidate(sender)
+    utils.broadcast_to_user(target, {"event": "new_gift", "from": sender}); utils.broadcast_to_user(target, {"event": "gift_anim"})
+    utils.broadcast_to_user(sender, {"event": "gift_anim"})
+    return {"status": "ok", "new_balance": current_units - price}
+
+USER_GIFTS_SQL = "SELECT id, filename, name, minted_at, is_hidden FROM nfts WHERE owner_id=?"
+
+@action('get_user_gifts', required=('user_id',))
+def handle_get_user_gifts(db, cur, payload):
+    uid = payload['user_id']
+    viewer = payload.get('viewer_id')
+    if str(uid) == "0": return {"status": "ok", "gifts": []}
+    if str(viewer) == str(uid): cur.execute(USER_GIFTS_SQL, (uid,))
+    else: cur.execute(USER_GIFTS_SQL + " AND is_hidden=0", (uid,))
+    return {"status": "ok", "gifts": [{"id": r[0], "filename": r[1], "name": r[2], "date": r[3], "hidden": r[4]} for r in cur.fetchall()]}
+
+FRIEND_IDS_SQL = """SELECT friend_id FROM friends WHERE user_id=? AND status='accepted'
+    UNION SELECT user_id FROM friends WHERE friend_id=? AND status='accepted'"""
+FRIEND_REQUESTS_SQL = "SELECT u.id, u.username, u.discriminator FROM users u JOIN friends f ON u.id=f.user_id WHERE f.friend_id=? AND f.status='pending'"
+USER_BY_TAG_SQL = "SELECT id FROM users WHERE username=? AND discriminator=?"
+USER_GROUPS_SQL = "SELECT g.id, g.name, g.avatar_color, g.owner_id, g.avatar_image, g.banner_image FROM groups g JOIN group_members gm ON g.id=gm.group_id WHERE gm.user_id=?"
+
+@action('get_friends_data', required=('id',))
+def handle_get_friends_data(db, cur, payload):
+    uid = payload['id']
+    cur.execute(FRIEND_IDS_SQL, (uid, uid))
+    friend_ids = [r[0] for r in cur.fetchall() if r[0] != uid]
+    profiles = profile_cache.get_many(cur, friend_ids + [uid])
+
+    friends = []
+    for fid in friend_ids:
+        p = profiles.get(fid)
+        if not p: continue
+        friends.append({
+            "id": p["id"], "username": p["username"], "tag": p["discriminator"], "color": p["avatar_color"], "image": p["avatar_image"],
+            "about": p["about_me"], "banner": p["banner_color"], "banner_image": p["banner_image"], "status_text": p["custom_status"],
+            "nick_color": p["nickname_color"], "decoration": p["avatar_decoration"],
+            "units": p["units"] if p["units"] is not None else 0,
+            "profile_music": p["profile_music"]
+        })
+
+    me = profiles.get(int(uid))
+    my_units = me["units"] if me else 0
+
+    try:
+        cur.execute("SELECT * FROM users WHERE id=0")
+        bot = cur.fetchone()
+        if bot:
+            friends.insert(0, {
+                "id": 0, "username": "NovCord", "tag": "0000", "color": "#5865F2", "image": None,
+                "about": "Official Bot", "banner": "black", "banner_image": None,
+                "status_text": "SYSTEM", "nick_color": "white", "decoration": None, "units": 0,
+                "is_bot": True, "profile_music": None
+            })
+    except: pass
+
+    cur.execute(FRIEND_REQUESTS_SQL, (uid,))
+    reqs = [{"id":r[0], "username":r[1], "tag":r[2]} for r in cur.fetchall()]
+
+    cur.execute(USER_GROUPS_SQL, (uid,))
+    groups = [{"id":r[0], "name":r[1], "color":r[2], "owner":r[3], "image": r[4], "banner": r[5], "type": "group"} for r in cur.fetchall()]
+
+    return {"status": "ok", "friends": friends, "requests": reqs, "groups": groups, "my_units": my_units}
+
+@action('add_friend', write=True, required=('from', 'target'))
+def handle_add_friend(db, cur, payload):
+    uid, target = payload['from'], payload['target'].lower()
+    try:
+        name, tag = target.split('#')
+        cur.execute(USER_BY_TAG_SQL, (name, tag))
+        res = cur.fetchone()
+        if not res: return {"status": "error", "msg": "Не найден"}
+        tid = res[0]
+        if tid == uid: return {"status": "error", "msg": "Это вы"}
+        cur.execute("SELECT * FROM friends WHERE (user_id=? AND friend_id=?) OR (user_id=? AND friend_id=?)", (uid, tid, tid, uid))
+        if cur.fetchone(): return {"status": "error", "msg": "Уже друзья"}
+        cur.execute("INSERT INTO friends (user_id, friend_id, status) VALUES (?,?,'pending')", (uid, tid))
+        db.commit(); utils.broadcast_to_user(tid, {"event": "update_friends"})
+        return {"status": "ok"}
+    except: return {"status": "error", "msg": "Формат: User#0000"}
+
+@action('accept_friend', write=True, required=('target_id', 'my_id'))
+def handle_accept_friend(db, cur, payload):
+    cur.execute("UPDATE friends SET status='accepted' WHERE user_id=? AND friend_id=?", (payload['target_id'], payload['my_id']))
+    db.commit(); utils.broadcast_to_user(payload['target_id'], {"event": "update_friends"})
+    introduce_presence(payload['my_id'], [payload['target_id']])
+    return {"status": "ok"}
+
+@action('block_user', write=True, required=('user_id', 'blocked_id'))
+def handle_block_user(db, cur, payload):
+    uid, tid = payload['user_id'], payload['blocked_id']
+    if str(tid) == "0": return {"status": "error", "msg": "Cannot block bot"}
+    cur.execute("INSERT OR IGNORE INTO user_blocks (user_id, blocked_id) VALUES (?,?)", (uid, tid))
+    db.commit()
+    utils.broadcast_to_user(tid, {"event": "update_friends"}) 
+    return {"status": "ok"}
+
+@action('unblock_user', write=True, required=('user_id', 'blocked_id'))
+def handle_unblock_user(db, cur, payload):
+    uid, tid = payload['user_id'], payload['blocked_id']
+    cur.execute("DELETE FROM user_blocks WHERE user_id=? AND blocked_id=?", (uid, tid))
+    db.commit()
+    return {"status": "ok"}
+
+@action('delete_chat_history', write=True, required=('user_id', 'target_id'))
+def handle_delete_chat_history(db, cur, payload):
+    uid, tid = payload['user_id'], payload['target_id']
+    if str(tid) == "0": return {"status": "error", "msg": "Cannot delete bot chat"}
+    ids_sql, params = chat_ids_sql(chat_streams('private', uid, tid))
+    cur.execute(f"SELECT attachment_filename FROM messages WHERE attachment_filename IS NOT NULL AND id IN ({ids_sql})", params)
+    for (fname,) in cur.fetchall(): store.release(cur, fname)
+    cur.execute(f"DELETE FROM message_reactions WHERE message_id IN ({ids_sql})", params)
+    cur.execute(f"DELETE FROM messages WHERE id IN ({ids_sql})", params)
+    db.commit()
+    notify_chat(cur, 'private', uid, tid, "cleared")
+    return {"status": "ok"}
+
+@action('create_group', write=True, required=('members', 'name', 'owner_id'))
+def handle_create_group(db, cur, payload):
+    members = payload['members']
+    if 'invite_user' in payload and payload['invite_user']:
+        try:
+            nm, tg = payload['invite_user'].lower().split('#')
+            cur.execute(USER_BY_TAG_SQL, (nm, tg))
+            usr = cur.fetchone()
+            if usr:
+                cur.execute("SELECT * FROM group_blacklist WHERE user_id=?", (usr[0],))
+                if usr[0] not in members: members.append(usr[0])
+        except: pass
+    cur.execute("INSERT INTO groups (name, owner_id, avatar_color) VALUES (?,?,?)", (payload['name'], payload['owner_id'], '#5865F2'))
+    gid = cur.lastrowid
+    for m_id in members: cur.execute("INSERT INTO group_members (group_id, user_id) VALUES (?,?)", (gid, m_id))
+    db.commit()
+    for m_id in members: utils.broadcast_to_user(m_id, {"event": "update_friends"})
+    share_presence(members)
+    return {"status": "ok"}
+
+def replace_file_refs(cur, table, row_id, new_files, reset=()):
+    """Переносит ссылки file_refs со старых картинок строки на новые. None - колонка не меняется (кроме колонок из reset)"""
+    columns = [c for c, v in new_files.items() if v or c in reset]
+    if not columns: return
+    cur.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE id=?", (row_id,))
+    old = cur.fetchone()
+    if not old: return
+    for column, old_name in zip(columns, old):
+        store.replace_ref(cur, old_name, new_files[column])
+
+@action('update_group', write=True, required=('group_id', 'name', 'color'))
+def handle_update_group(db, cur, payload):
+    gid = payload['group_id']
+    fname = utils.save_file_to_disk(payload['image_b64']) if payload.get('image_b64') else None
+    bfname = utils.save_file_to_disk(payload['banner_b64'], "gif" if payload.get('is_gif_bn') else "png") if payload.get('banner_b64') else None
+    sql = "UPDATE groups SET name=?, avatar_color=?"; params = [payload['name'], payload['color']]
+    if fname: sql += ", avatar_image=?"; params.append(fname)
+    if bfname: sql += ", banner_image=?"; params.append(bfname)
+    replace_file_refs(cur, "groups", gid, {"avatar_image": fname, "banner_image": bfname})
+    sql += " WHERE id=?"; params.append(gid)
+    cur.execute(sql, params); db.commit()
+    cur.execute(GROUP_MEMBER_IDS_SQL, (gid,))
+    for m in cur.fetchall(): utils.broadcast_to_user(m[0], {"event": "update_friends"})
+    return {"status": "ok"}
+
+@action('invite_group_user', write=True, required=('group_id', 'target'))
+def handle_invite_group_user(db, cur, payload):
+    gid, target = payload['group_id'], payload['target']
+    try:
+        tid = None
+        if isinstance(target, int): tid = target
+        else:
+            nm, tg = target.lower().split('#')
+            cur.execute(USER_BY_TAG_SQL, (nm, tg))
+            res = cur.fetchone(); 
+            if res: tid = res[0]
+        if not tid: return {"status": "error", "msg": "Пользователь не найден"}
+        cur.execute("SELECT * FROM group_blacklist WHERE group_id=? AND user_id=?", (gid, tid))
+        if cur.fetchone(): return {"status": "error", "msg": "Пользователь в черном списке"}
+        cur.execute("SELECT * FROM group_members WHERE group_id=? AND user_id=?", (gid, tid))
+        if cur.fetchone(): return {"status": "error", "msg": "Уже участник"}
+        cur.execute("INSERT INTO group_members (group_id, user_id) VALUES (?,?)", (gid, tid))
+        db.commit(); utils.broadcast_to_user(tid, {"event": "update_friends"})
+        cur.execute("SELECT user_id FROM group_members WHERE group_id=? AND user_id!=?", (gid, tid))
+        introduce_presence(tid, [r[0] for r in cur.fetchall()])
+        return {"status": "ok", "msg": "Приглашен"}
+    except: return {"status": "error", "msg": "Ошибка"}
+
+@action('leave_group', write=True, required=('group_id', 'user_id'))
+def handle_leave_group(db, cur, payload):
+    gid, uid = payload['group_id'], payload['user_id']
+    cur.execute("DELETE FROM group_members WHERE group_id=? AND user_id=?", (gid, uid))
+    db.commit()
+    notify_chat(cur, 'group', uid, gid, "members")
+    return {"status": "ok"}
+
+@action('delete_group', write=True, required=('group_id', 'user_id'))
+def handle_delete_group(db, cur, payload):
+    gid, uid = payload['group_id'], payload['user_id']
+    cur.execute("SELECT owner_id FROM groups WHERE id=?", (gid,))
+    res = cur.fetchone()
+    if res and res[0] == uid:
+        cur.execute(GROUP_MEMBER_IDS_SQL, (gid,))
+        members = cur.fetchall()
+        cur.execute("DELETE FROM group_members WHERE group_id=?", (gid,))
+        cur.execute("DELETE FROM groups WHERE id=?", (gid,))
+        cur.execute("DELETE FROM group_blacklist WHERE group_id=?", (gid,))
+        db.commit()
+        for m in members: utils.broadcast_to_user(m[0], {"event": "update_friends"})
+        return {"status": "ok"}
+    return {"status": "error", "msg": "Not owner"}
+
+@action('kick_group_user', write=True, required=('group_id', 'user_id'))
+def handle_kick_group_user(db, cur, payload):
+    gid, uid = payload['group_id'], payload['user_id']
+    cur.execute("DELETE FROM group_members WHERE group_id=? AND user_id=?", (gid, uid)); db.commit()
+    utils.broadcast_to_user(uid, {"event": "update_friends"})
+    notify_chat(cur, 'group', uid, gid, "members")
+    return {"status": "ok"}
+
+@action('ban_group_user', write=True, required=('group_id', 'user_id'))
+def handle_ban_group_user(db, cur, payload):
+    gid, uid = payload['group_id'], payload['user_id']
+    cur.execute("DELETE FROM group_members WHERE group_id=? AND user_id=?", (gid, uid))
+    cur.execute("INSERT INTO group_blacklist (group_id, user_id) VALUES (?,?)", (gid, uid)); db.commit()
+    utils.broadcast_to_user(uid, {"event": "update_friends"})
+    return {"status": "ok"}
+
+@action('unban_group_user', write=True, required=('group_id', 'user_id'))
+def handle_unban_group_user(db, cur, payload):
+    gid, uid = payload['group_id'], payload['user_id']
+    cur.execute("DELETE FROM group_blacklist WHERE group_id=? AND user_id=?", (gid, uid)); db.commit()
+    return {"status": "ok"}
+
+@action('get_group_blacklist', required=('group_id',))
+def handle_get_group_blacklist(db, cur, payload):
+    cur.execute('''SELECT u.id, u.username, u.discriminator, u.avatar_image FROM users u JOIN group_blacklist gb ON u.id=gb.user_id WHERE gb.group_id=?''', (payload['group_id'],))
+    return {"status": "ok", "blacklist": [{"id":r[0], "username":r[1], "tag":r[2], "image":r[3]} for r in cur.fetchall()]}
+
+@action('get_group_members', required=('group_id',))
+def handle_get_group_members(db, cur, payload):
+    cur.execute(GROUP_MEMBER_IDS_SQL, (payload['group_id'],))
+    member_ids = [r[0] for r in cur.fetchall()]
+    profiles = profile_cache.get_many(cur, member_ids)
+    members = [profiles[uid] for uid in member_ids if uid in profiles]
+    return {"status": "ok", "members": [{"id": p["id"], "username": p["username"], "tag": p["discriminator"], "color": p["avatar_color"],
+                                         "image": p["avatar_image"], "nick_color": p["nickname_color"], "decoration": p["avatar_decoration"],
+                                         "units": p["units"] if p["units"] is not None else 0} for p in members]}
+
+# Изменения, для которых клиенты с delta_events получают само изменение, а не new_msg
+DELTA_EVENTS = {"message": "message_created", "edited": "message_edited",
+                "deleted": "message_deleted", "reactions": "reactions_changed"}
+
+def split_delta_subscribers(user_ids):
+    delta, legacy = [], []
+    for uid in user_ids:
+        session = state.connected_clients.get(uid)
+        (delta if session is not None and session.delta_events else legacy).append(uid)
+    return delta, legacy
+
+def fetch_message(cur, chat_type, sender_id, target_id, msg_id):
+    """Одно сообщение в том же виде, что в ответе get_chat"""
+    msgs = fetch_chat_messages(cur, chat_streams(chat_type, sender_id, target_id), chat_type, target_id, (msg_id, msg_id))
+    return msgs[0] if msgs else None
+
+def notify_chat(cur, chat_type, user_id, chat_target, change, msg_id=None, delta=None, **fields):
+    """
+    Сообщает участникам чата об изменении. Личный чат user_id с chat_target - обеим
+    сторонам, группа chat_target - всем участникам.
+    Клиенты с delta_events получают DELTA_EVENTS[change] с полями delta() (строится
+    один раз и только если такие клиенты есть), остальные - new_msg через слияние server_events.
+    """
+    if chat_type == 'private':
+        sides = [([chat_target], user_id), ([user_id], chat_target)]
+    else:
+        cur.execute(GROUP_MEMBER_IDS_SQL, (chat_target,))
+        sides = [([r[0] for r in cur.fetchall()], chat_target)]
+    delta_fields = None
+    for recipients, chat_id in sides:
+        legacy = recipients
+        if delta is not None:
+            subscribers, legacy = split_delta_subscribers(recipients)
+            if subscribers:
+                if delta_fields is None: delta_fields = delta()
+                event = {"event": DELTA_EVENTS[change], "chat_id": chat_id, "type": chat_type}
+                event.update(delta_fields)
+                utils.broadcast_to_users(subscribers, event)
+        if legacy: events.chat_changed(legacy, chat_type, chat_id, change, msg_id, **fields)
+
+@action('send_msg', write=True, required=('sender', 'target', 'type', 'text'))
+def handle_send_msg(db, cur, payload):
+    sender, target = payload['sender'], payload['target']
+
+    if payload['type'] == 'private':
+        cur.execute("SELECT * FROM user_blocks WHERE user_id=? AND blocked_id=?", (target, sender))
+        if cur.fetchone():
+            return {"status": "blocked"}
+
+    att_fname = None
+    if payload.get('att_data'):
+        ext = "mp4" if payload.get('att_type') == 'video' else "png"
+        if payload.get('att_type') == 'gif': ext = "gif"
+        if payload.get('att_type') == 'audio': ext = "mp3"
+        if payload.get('att_type') == 'voice': ext = "wav"
+        att_fname = utils.save_file_to_disk(payload['att_data'], ext)
+    elif payload.get('att_type') == 'sticker':
+        att_fname = payload['text'] 
+    elif payload.get('att_file'): # Forwarded file logic
+        att_fname = payload['att_file']
+
+    cur.execute("INSERT INTO messages (sender_id, target_id, target_type, content, timestamp, reply_to_id, attachment_type, attachment_filename, status, forward_from_id) VALUES (?,?,?,?,?,?,?,?,?,?)",
+                (sender, target, payload['type'], payload['text'], str(datetime.now()), payload.get('reply'), payload.get('att_type'), att_fname, 'sent', payload.get('forward_sender_id')))
+    msg_id = cur.lastrowid
+    store.add_ref(cur, att_fname)
+    db.commit()
+
+    notify_chat(cur, payload['type'], sender, target, "message", msg_id,
+                delta=lambda: {"message": fetch_message(cur, payload['type'], sender, target, msg_id)},
+                att_type=payload.get('att_type'), sender_id=sender,
+                **(store.describe(att_fname) if att_fname else {"att_file": None}))
+    return {"status": "ok", "msg_id": msg_id}
+
+@action('edit_msg', write=True, required=('msg_id', 'sender_id', 'content'))
+def handle_edit_msg(db, cur, payload):
+    cur.execute("SELECT sender_id, target_id, target_type FROM messages WHERE id=?", (payload['msg_id'],))
+    res = cur.fetchone()
+    if res and res[0] == payload['sender_id']:
+        cur.execute("UPDATE messages SET content=?, is_edited=1 WHERE id=?", (payload['content'], payload['msg_id']))
+        db.commit()
+        notify_chat(cur, res[2], res[0], res[1], "edited", payload['msg_id'],
+                    delta=lambda: {"message": fetch_message(cur, res[2], res[0], res[1], payload['msg_id'])})
+        return {"status": "ok"}
+    return {"status": "error"}
+
+@action('delete_msg', write=True, required=('msg_id', 'sender_id'))
+def handle_delete_msg(db, cur, payload):
+    cur.execute("SELECT sender_id, target_id, target_type, attachment_filename FROM messages WHERE id=?", (payload['msg_id'],))
+    res = cur.fetchone()
+    if res and res[0] == payload['sender_id']:
+        store.release(cur, res[3])
+        cur.execute("DELETE FROM messages WHERE id=?", (payload['msg_id'],))
+        cur.execute("DELETE FROM message_reactions WHERE message_id=?", (payload['msg_id'],))
+        db.commit()
+        notify_chat(cur, res[2], res[0], res[1], "deleted", payload['msg_id'], delta=lambda: {"msg_id": payload['msg_id']})
+        return {"status": "ok"}
+    return {"status": "error"}
+
+@action('add_reaction', write=True, required=('msg_id', 'emoji', 'user_id'))
+def handle_add_reaction(db, cur, payload):
+    mid, emoji = payload['msg_id'], payload['emoji']
+    cur.execute("SELECT id, target_id, target_type, sender_id FROM messages WHERE id=?", (mid,))
+    curr = cur.fetchone()
+    if curr:
+        # Переключение: убрать свою реакцию, а если её не было - поставить
+        cur.execute("DELETE FROM message_reactions WHERE message_id=? AND emoji=? AND user_id=?", (mid, emoji, payload['user_id']))
+        if not cur.rowcount:
+            cur.execute("INSERT INTO message_reactions (message_id, emoji, user_id) VALUES (?,?,?)", (mid, emoji, payload['user_id']))
+        db.commit()
+        notify_chat(cur, curr[2], curr[3], curr[1], "reactions", mid,
+                    delta=lambda: {"msg_id": mid, "reactions": fetch_reactions(cur, "?", (mid,)).get(mid, {})})
+        return {"status": "ok"}
+    return {"status": "error"}
+
+# Представление чата собирается одним запросом: цитируемое сообщение подтягивается
+# через LEFT JOIN вместо запроса на строку, профили авторов - из profile_cache.
+CHAT_VIEW_SQL = """SELECT m.id, m.sender_id, m.content, m.timestamp, m.reply_to_id, m.is_edited,
+        m.attachment_type, m.attachment_filename, m.status, m.forward_from_id,
+        rm.sender_id, rm.content, rm.attachment_filename
+    FROM messages m
+    LEFT JOIN messages rm ON rm.id = m.reply_to_id
+    WHERE {where}
+    ORDER BY m.id"""
+
+REACTIONS_SQL = """SELECT message_id, emoji, user_id FROM message_reactions
+    WHERE message_id IN ({ids}) ORDER BY message_id, rowid"""
+
+def fetch_reactions(cur, ids_sql, params):
+    """
+    Реакции сообщений из подзапроса ids_sql одним запросом: {msg_id: {emoji: [user_id, ...]}}.
+    Порядок rowid - порядок нажатий: эмодзи по первому использованию, пользователи по времени реакции.
+    """
+    cur.execute(REACTIONS_SQL.format(ids=ids_sql), params)
+    reactions = {}
+    for mid, emoji, uid in cur.fetchall():
+        reactions.setdefault(mid, {}).setdefault(emoji, []).append(uid)
+    return reactions
+
+GROUP_WATERMARKS_SQL = "SELECT user_id, last_read_id FROM chat_reads WHERE chat_type='group' AND chat_id=?"
+
+def get_group_watermarks(cur, group_id):
+    """Отметки прочтения группы: {user_id: last_read_id} и их отсортированный список"""
+    cur.execute(GROUP_WATERMARKS_SQL, (group_id,))
+    marks = dict(cur.fetchall())
+    return marks, sorted(marks.values())
+
+def group_read_count(marks, sorted_marks, msg_id, sender_id):
+    """Сколько участников (кроме автора) дочитали группу до msg_id"""
+    count = len(sorted_marks) - bisect.bisect_left(sorted_marks, msg_id)
+    if marks.get(sender_id, 0) >= msg_id: count -= 1
+    return count
+
+def chat_streams(t_type, my_id, t_id):
+    """
+    Условия выборки сообщений чата, каждое из которых покрывается индексом
+    и упорядочено по id. Личный чат - это два потока (в обе стороны).
+    """
+    if t_type == 'private':
+        return [("sender_id=? AND target_id=? AND target_type='private'", (my_id, t_id)),
+                ("sender_id=? AND target_id=? AND target_type='private'", (t_id, my_id))]
+    return [("target_type='group' AND target_id=?", (t_id,))]
+
+def chat_ids_sql(streams, id_range=None):
+    """Подзапрос id сообщений чата: UNION ALL потоков, каждый идёт по своему индексу"""
+    parts, params = [], []
+    for where, stream_params in streams:
+        if id_range:
+            where += " AND id BETWEEN ? AND ?"; stream_params = tuple(stream_params) + tuple(id_range)
+        parts.append(f"SELECT id FROM messages WHERE {where}")
+        params.extend(stream_params)
+    return " UNION ALL ".join(parts), params
+
+def chat_page_sql(where, params, before_id, after_id, limit):
+    """Запрос страницы id одного потока chat_streams: (sql, params)"""
+    sql = f"SELECT id FROM messages WHERE {where}"; params = list(params)
+    if before_id is not None: sql += " AND id < ?"; params.append(before_id)
+    if after_id is not None: sql += " AND id > ?"; params.append(after_id)
+    sql += f" ORDER BY id {'ASC' if after_id is not None else 'DESC'} LIMIT ?"; params.append(limit)
+    return sql, params
+
+def fetch_chat_page_ids(cur, streams, before_id, after_id, limit):
+    """
+    Keyset-пагинация: id страницы и флаг has_more.
+    Без after_id берутся последние сообщения перед before_id, иначе - первые после after_id.
+    """
+    newest_first = after_id is None
+    ids = []
+    for where, params in streams:
+        cur.execute(*chat_page_sql(where, params, before_id, after_id, limit + 1))
+        ids.extend(r[0] for r in cur.fetchall())
+    ids.sort(reverse=newest_first)
+    return sorted(ids[:limit]), len(ids) > limit
+
+def fetch_chat_messages(cur, streams, t_type, t_id, id_range=None):
+    ids_sql, params = chat_ids_sql(streams, id_range)
+    cur.execute(CHAT_VIEW_SQL.format(where=f"m.id IN ({ids_sql})"), params)
+    rows = cur.fetchall()
+    reactions = fetch_reactions(cur, ids_sql, params) if rows else {}
+    marks, sorted_marks = get_group_watermarks(cur, t_id) if t_type == 'group' and rows else ({}, [])
+
+    profiles = profile_cache.get_many(cur, {uid for r in rows for uid in (r[1], r[9], r[10]) if uid is not None})
+
+    msgs = []
+    for r in rows:
+        sender = profiles.get(r[1]) if r[1] is not None else None
+        has_sender = sender is not None
+        forward_name, forward_color, forward_img = None, None, None
+        forwarded = profiles.get(r[9]) if r[9] else None
+        if forwarded:
+            forward_name, forward_color, forward_img = forwarded["username"], forwarded["avatar_color"], forwarded["avatar_image"]
+
+        reply_text = None
+        if r[4] and r[10] is not None and r[10] in profiles:
+            reply_text = r[12] if r[12] else r[11]
+
+        msgs.append({
+            "id": r[0], "sender_id": r[1], "content": r[2], "time": r[3], "reply_id": r[4], "reply_text": reply_text,
+            "is_edited": r[5], "att_type": r[6], "att_file": r[7], "attachment_filename": r[7],
+            "reactions": reactions.get(r[0], {}),
+            "status": r[8] if r[8] else 'sent',
+            "read_count": group_read_count(marks, sorted_marks, r[0], r[1]) if marks else 0,
+            "sender_name": sender["username"] if has_sender else "?", "sender_color": sender["avatar_color"] if has_sender else "grey",
+            "sender_image": sender["avatar_image"] if has_sender else None,
+            "nick_color": sender["nickname_color"] if has_sender else "white", "decoration": sender["avatar_decoration"] if has_sender else None,
+            "forward_from": forward_name, "forward_sender_color": forward_color, "forward_sender_image": forward_img
+        })
+    return msgs
+
+@action('get_chat', required=('my_id', 'target_id', 'target_type'))
+def handle_get_chat(db, cur, payload):
+    my_id, t_id, t_type = payload['my_id'], payload['target_id'], payload['target_type']
+
+    is_blocked = False
+    if t_type == 'private':
+        cur.execute("SELECT 1 FROM user_blocks WHERE user_id=? AND blocked_id=?", (my_id, t_id))
+        if cur.fetchone(): is_blocked = True
+    streams = chat_streams(t_type, my_id, t_id)
+
+    before_id, after_id, limit = payload.get('before_id'), payload.get('after_id'), payload.get('limit')
+    if before_id is None and after_id is None and limit is None:
+        # Старые клиенты: вся история целиком
+        msgs = fetch_chat_messages(cur, streams, t_type, t_id)
+        return {"status": "ok", "messages": msgs, "is_blocked": is_blocked}
+
+    limit = max(1, min(int_param(payload, 'limit') or cfg.CHAT_PAGE_SIZE, cfg.CHAT_MAX_PAGE_SIZE))
+    before_id, after_id = int_param(payload, 'before_id'), int_param(payload, 'after_id')
+    page_ids, has_more = fetch_chat_page_ids(cur, streams, before_id, after_id, limit)
+
+    # Страница - непрерывный диапазон id этого чата, поэтому хватает BETWEEN
+    msgs = fetch_chat_messages(cur, streams, t_type, t_id, (page_ids[0], page_ids[-1])) if page_ids else []
+    return {"status": "ok", "messages": msgs, "is_blocked": is_blocked, "has_more": has_more}
+
+@action('get_chat_since', required=('my_id', 'target_id', 'target_type', 'last_id'))
+def handle_get_chat_since(db, cur, payload):
+    """
+    Догрузка после переподключения для клиентов с локальной копией чата: сообщения с id > last_id
+    (не больше CHAT_MAX_PAGE_SIZE, дальше - повторный вызов по has_more).
+    Правки и реакции, пропущенные за время отключения, сюда не попадают - их перечитывают через get_chat.
+    """
+    my_id, t_id, t_type = payload['my_id'], payload['target_id'], payload['target_type']
+    limit = max(1, min(int_param(payload, 'limit') or cfg.CHAT_MAX_PAGE_SIZE, cfg.CHAT_MAX_PAGE_SIZE))
+    last_id = int_param(payload, 'last_id', 0)
+    streams = chat_streams(t_type, my_id, t_id)
+    page_ids, has_more = fetch_chat_page_ids(cur, streams, None, last_id, limit)
+    msgs = fetch_chat_messages(cur, streams, t_type, t_id, (page_ids[0], page_ids[-1])) if page_ids else []
+    return {"status": "ok", "messages": msgs, "has_more": has_more,
+            "last_id": page_ids[-1] if page_ids else last_id}
+
+# Поиск по истории: FTS5-индекс messages_fts (server_db), ранжирование bm25
+SEARCH_SQL = """SELECT m.id, m.sender_id, m.target_id, m.target_type, m.timestamp, u.username,
+        snippet(messages_fts, 0, ?, ?, '…', ?)
+    FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+    LEFT JOIN users u ON u.id = m.sender_id
+    WHERE messages_fts MATCH ? AND {scope}
+    ORDER BY messages_fts.rank LIMIT ? OFFSET ?"""
+
+# Только чаты пользователя: его личные переписки и группы, где он состоит
+SEARCH_SCOPE_ALL = """((m.target_type='private' AND (m.sender_id=? OR m.target_id=?))
+        OR (m.target_type='group' AND m.target_id IN (SELECT group_id FROM group_members WHERE user_id=?)))"""
+
+def fts_query(text):
+    """Строка пользователя -> запрос FTS5: все слова обязательны, последнее - как префикс"""
+    words = re.findall(r"\w+", text or "")
+    if not words: return None
+    return " ".join(f'"{w}"' for w in words[:-1]) + f' "{words[-1]}"*'
+
+@action('search_messages', required=('user_id', 'query'))
+def handle_search_messages(db, cur, payload):
+    user_id = payload['user_id']
+    match = fts_query(payload['query'])
+    limit = max(1, min(int_param(payload, 'limit') or cfg.SEARCH_PAGE_SIZE, cfg.SEARCH_MAX_PAGE_SIZE))
+    offset = max(0, int_param(payload, 'offset', 0))
+    if not match: return {"status": "ok", "results": [], "has_more": False}
+
+    t_id, t_type = payload.get('target_id'), payload.get('target_type')
+    if t_id is None:
+        scope, scope_params = SEARCH_SCOPE_ALL, [user_id, user_id, user_id]
+    elif t_type == 'group':
+        cur.execute("SELECT 1 FROM group_members WHERE group_id=? AND user_id=?", (t_id, user_id))
+        if not cur.fetchone(): return {"status": "error", "msg": "Not a member"}
+        scope, scope_params = "m.target_type='group' AND m.target_id=?", [t_id]
+    else:
+        ids_sql, scope_params = chat_ids_sql(chat_streams('private', user_id, t_id))
+        scope = f"m.id IN ({ids_sql})"
+
+    mark_open, mark_close = cfg.SEARCH_HIGHLIGHT
+    params = [mark_open, mark_close, cfg.SEARCH_SNIPPET_TOKENS, match] + list(scope_params) + [limit + 1, offset]
+    try:
+        cur.execute(SEARCH_SQL.format(scope=scope), params)
+    except sqlite3.OperationalError as e:
+        return {"status": "error", "msg": f"Bad query: {e}"}
+    rows = cur.fetchall()
+    results = [{
+        "msg_id": r[0], "sender_id": r[1], "sender_name": r[5] if r[5] is not None else "?",
+        "type": r[3], "chat_id": r[2] if r[3] == 'group' or r[1] == user_id else r[1],
+        "time": r[4], "snippet": r[6]
+    } for r in rows[:limit]]
+    return {"status": "ok", "results": results, "has_more": len(rows) > limit, "next_offset": offset + len(results)}
+
+@action('update_profile', write=True, required=('username', 'about', 'banner', 'custom_status', 'nickname_color', 'id'))
+def handle_update_profile(db, cur, payload):
+    av_fname = utils.save_file_to_disk(payload['avatar_b64'], "gif" if payload.get('is_gif_av') else "png") if payload.get('avatar_b64') else None
+    bn_fname = utils.save_file_to_disk(payload['banner_b64'], "gif" if payload.get('is_gif_bn') else "png") if payload.get('banner_b64') else None
+    dec_fname = utils.save_file_to_disk(payload['decor_b64'], "gif") if payload.get('decor_b64') else None
+    bg_fname = utils.save_file_to_disk(payload['bg_b64'], "jpg") if payload.get('bg_b64') and payload.get('bg_b64') != 'reset' else None
+
+    sql = "UPDATE users SET username=?, about_me=?, banner_color=?, custom_status=?, nickname_color=?"
+    params = [payload['username'], payload['about'], payload['banner'], payload['custom_status'], payload['nickname_color']]
+    if av_fname: sql += ", avatar_image=?"; params.append(av_fname)
+    if bn_fname: sql += ", banner_image=?"; params.append(bn_fname)
+    if dec_fname: sql += ", avatar_decoration=?"; params.append(dec_fname)
+    if bg_fname: sql += ", chat_bg=?"; params.append(bg_fname)
+    elif payload.get('bg_b64') == 'reset': sql += ", chat_bg=?"; params.append(None)
+    replace_file_refs(cur, "users", payload['id'], {"avatar_image": av_fname, "banner_image": bn_fname,
+                                                    "avatar_decoration": dec_fname, "chat_bg": bg_fname},
+                      reset=("chat_bg",) if payload.get('bg_b64') == 'reset' else ())
+
+    sql += " WHERE id=?"; params.append(payload['id'])
+    cur.execute(sql, params); db.commit()
+    profile_cache.invalidate(payload['id'])
+    utils.broadcast_to_users(presence_audience(cur, payload['id']) | {payload['id']}, {"event": "profile_updated", "user_id": payload['id']})
+    return {"status": "ok", "new_avatar": av_fname, "new_banner": bn_fname, "new_decor": dec_fname, "new_bg": bg_fname}
+
+@action('admin_get_all_users')
+def handle_admin_get_all_users(db, cur, payload):
+    cur.execute("SELECT id, username, discriminator, email, is_blocked, is_admin FROM users")
+    return {"status": "ok", "users": [{"id":r[0], "tag":f"{r[1]}#{r[2]}", "email":r[3], "blocked":r[4], "is_admin":r[5]} for r in cur.fetchall()]}
+
+@action('admin_ban_user', write=True, required=('target_id',))
+def handle_admin_ban_user(db, cur, payload):
+    cur.execute("UPDATE users SET is_blocked=1, ban_reason=? WHERE id=?", (payload.get('reason', 'Нарушение правил'), payload['target_id']))
+    db.commit(); profile_cache.invalidate(payload['target_id']); return {"status": "ok"}
+
+@action('admin_unban_user', write=True, required=('target_id',))
+def handle_admin_unban_user(db, cur, payload):
+    cur.execute("UPDATE users SET is_blocked=0 WHERE id=?", (payload['target_id'],)); db.commit()
+    profile_cache.invalidate(payload['target_id']); return {"status": "ok"}
+
+BROADCAST_INSERT_SQL = "INSERT INTO messages (sender_id, target_id, target_type, content, timestamp, status) VALUES (0, ?, 'private', ?, ?, 'sent')"
+BROADCAST_READBACK_SQL = "SELECT target_id, id FROM messages WHERE id > ?"
+
+def run_broadcast(job, text):
+    """
+    Рассылка от системы всем пользователям порциями по BROADCAST_BATCH_SIZE:
+    каждая порция - один executemany в своей короткой транзакции писателя.
+    Онлайн-клиенты порции получают то же, что от notify_chat: delta_events -
+    message_created со своим сообщением, остальные - new_msg через слияние server_events.
+    """
+    last_id = 0
+    while True:
+        with db_mod.reader() as db:
+            cur = db.cursor()
+            cur.execute("SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?", (last_id, cfg.BROADCAST_BATCH_SIZE))
+            batch = [r[0] for r in cur.fetchall()]
+        if not batch: break
+        timestamp = str(datetime.now())
+        with db_mod.writer() as db:
+            cur = db.cursor()
+            # Писатель один, поэтому всё, что выше max_id_before, вставлено этой порцией
+            cur.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+            max_id_before = cur.fetchone()[0]
+            cur.executemany(BROADCAST_INSERT_SQL, [(uid, text, timestamp) for uid in batch])
+            db.commit()
+            cur.execute(BROADCAST_READBACK_SQL, (max_id_before,))
+            msg_ids = dict(cur.fetchall())
+        subscribers, legacy = split_delta_subscribers([uid for uid in batch if uid in state.connected_clients])
+        if subscribers:
+            ids = [msg_ids[uid] for uid in subscribers]
+            with db_mod.reader() as db:
+                msgs = fetch_chat_messages(db.cursor(), [(f"id IN ({','.join('?' * len(ids))})", ids)], 'private', None)
+            by_id = {m['id']: m for m in msgs}
+            for uid in subscribers:
+                utils.broadcast_to_user(uid, {"event": DELTA_EVENTS["message"], "chat_id": 0, "type": "private",
+                                              "message": by_id.get(msg_ids[uid])})
+        for uid in legacy:
+            events.chat_changed([uid], 'private', 0, "message", msg_ids[uid], sender_id=0)
+        job.done += len(batch)
+        last_id = batch[-1]
+
+@action('admin_broadcast_msg', write=True, required=('text',))
+def handle_admin_broadcast_msg(db, cur, payload):
+    target_id = payload.get('target_id')
+    text = payload['text']
+    if target_id is not None:
+        cur.execute(BROADCAST_INSERT_SQL, (target_id, text, str(datetime.now())))
+        db.commit()
+        msg_id = cur.lastrowid
+        notify_chat(cur, 'private', 0, target_id, "message", msg_id,
+                    delta=lambda: {"message": fetch_message(cur, 'private', 0, target_id, msg_id)}, sender_id=0)
+        return {"status": "ok"}
+    # Всем - фоновой задачей: обработчик только ставит её в очередь, а задача
+    # берёт запись короткими порциями, уже после того как этот запрос отпустит писателя
+    cur.execute("SELECT COUNT(*) FROM users WHERE id > 0")
+    job = jobs.start("broadcast", cur.fetchone()[0], run_broadcast, text)
+    return {"status": "ok", "job_id": job.id, "total": job.total}
+
+@action('admin_get_jobs', db=False)
+def handle_admin_get_jobs(db, cur, payload):
+    # Прогресс фоновых задач: одна по job_id или все недавние
+    if payload.get('job_id'):
+        job = jobs.get(payload['job_id'])
+        if job is None: return {"status": "error", "msg": "Unknown job"}
+        return dict(job.info(), status="ok")
+    return {"status": "ok", "jobs": jobs.list_jobs()}
+
+@action('admin_add_units', write=True, required=('amount', 'target_id'))
+def handle_admin_add_units(db, cur, payload):
+    cur.execute("UPDATE users SET units = units + ? WHERE id=?", (payload['amount'], payload['target_id']))
+    db.commit()
+    profile_cache.invalidate(payload['target_id'])
+    utils.broadcast_to_user(payload['target_id'], {"event": "profile_updated", "user_id": payload['target_id']})
+    return {"status": "ok"}
+
+@action('get_mutual_info', db=False)
+def handle_get_mutual_info(db, cur, payload):
+    return {"status": "ok", "mutual_friends": [], "mutual_groups": []}
+
+@action('update_profile_music', write=True, required=('user_id', 'track_src', 'track_name'))
+def handle_update_profile_music(db, cur, payload):
+    uid, track_src, track_name = payload['user_id'], payload['track_src'], payload['track_name']
+    music_data = json.dumps({"src": track_src, "name": track_name})
+    cur.execute("UPDATE users SET profile_music=? WHERE id=?", (music_data, uid))
+    db.commit()
+    profile_cache.invalidate(uid)
+    utils.broadcast_to_users(presence_audience(cur, uid) | {uid}, {"event": "profile_updated", "user_id": uid})
+    return {"status": "ok"}
+
+MARK_PRIVATE_READ_SQL = "UPDATE messages SET status='read' WHERE sender_id=? AND target_id=? AND target_type='private' AND status != 'read'"
+LAST_PRIVATE_ID_SQL = "SELECT MAX(id) FROM messages WHERE sender_id=? AND target_id=? AND target_type='private'"
+LAST_GROUP_ID_SQL = "SELECT MAX(id) FROM messages WHERE target_type='group' AND target_id=?"
+
+@action('mark_messages_read', write=True, required=('user_id', 'chat_id', 'chat_type'))
+def handle_mark_messages_read(db, cur, payload):
+    user_id = payload['user_id']
+    chat_id = payload['chat_id']
+    chat_type = payload['chat_type']
+    # Отметка "прочитано до" - последнее сообщение чата (в личном - последнее от собеседника)
+    if chat_type == 'private':
+        cur.execute(MARK_PRIVATE_READ_SQL, (chat_id, user_id))
+        newly_read = cur.rowcount
+        cur.execute(LAST_PRIVATE_ID_SQL, (chat_id, user_id))
+    else:
+        newly_read = 0
+        cur.execute(LAST_GROUP_ID_SQL, (chat_id,))
+    last_id = cur.fetchone()[0]
+    if last_id is not None:
+        cur.execute("""INSERT INTO chat_reads (chat_type, chat_id, user_id, last_read_id, read_at) VALUES (?,?,?,?,?)
+                       ON CONFLICT(chat_type, chat_id, user_id) DO UPDATE SET last_read_id=excluded.last_read_id, read_at=excluded.read_at
+                       WHERE excluded.last_read_id > last_read_id""", (chat_type, chat_id, user_id, last_id, str(datetime.now())))
+    db.commit()
+    if newly_read:
+        utils.broadcast_to_user(chat_id, {"event": "messages_read", "chat_id": user_id, "type": "private"})
+    return {"status": "ok"}
+
+def message_readers_sql(msg_id, sender_id, target_id, target_type):
+    """Прочитали те, чья отметка в этом чате не меньше msg_id (автор не считается): (sql, params)"""
+    if target_type == 'group':
+        where, params = "cr.chat_type='group' AND cr.chat_id=? AND cr.user_id != ?", (target_id, sender_id)
+    else:
+        where, params = "cr.chat_type='private' AND cr.chat_id=? AND cr.user_id=?", (sender_id, target_id)
+    return f"SELECT cr.user_id, cr.read_at FROM chat_reads cr WHERE {where} AND cr.last_read_id >= ?", params + (msg_id,)
+
+@action('get_message_readers', required=('message_id',))
+def handle_get_message_readers(db, cur, payload):
+    msg_id = payload['message_id']
+    cur.execute("SELECT sender_id, target_id, target_type FROM messages WHERE id=?", (msg_id,))
+    msg = cur.fetchone()
+    if not msg: return {"status": "ok", "readers": []}
+    sender_id, target_id, target_type = msg
+    cur.execute(*message_readers_sql(msg_id, sender_id, target_id, target_type))
+    reads = cur.fetchall()
+    profiles = profile_cache.get_many(cur, [r[0] for r in reads])
+    readers = [{"id": p["id"], "username": p["username"], "tag": p["discriminator"], "color": p["avatar_color"],
+                "image": p["avatar_image"], "read_at": read_at} for p, read_at in ((profiles.get(uid), read_at) for uid, read_at in reads) if p]
+    return {"status": "ok", "readers": readers}
+
+# --- SERVER STATS ---
+
+@action('admin_get_server_stats', db=False)
+def handle_admin_get_server_stats(db, cur, payload):
+    with state.clients_lock:
+        sessions = dict(state.connected_clients)
+    clients = {uid: s.stats() for uid, s in sessions.items()}
+    return {"status": "ok", "actions": get_action_stats(), "clients": clients,
+            "queued_frames": sum(c["queue"] for c in clients.values()),
+            "slow_clients": [uid for uid, c in clients.items() if c["slow"]],
+            "coalesced_events": events.coalescer.merged, "profile_cache": profile_cache.stats()}
+
+@action('admin_get_voice_stats', db=False)
+def handle_admin_get_voice_stats(db, cur, payload):
+    # Счётчики голосового релея: пакеты/байты in/out, отброшенные кадры и джиттер по каналам и участникам
+    return dict(voice_server.get_stats(), status="ok")
@@ -0,0 +1,79 @@
+"""
+LRU-кеш профилей пользователей.
+
+get_chat, get_group_members, get_voice_participants, get_friends_data и
+get_message_readers берут одни и те же колонки users; кеш отдаёт их без
+запроса к БД. Запись сбрасывается обработчиками, которые меняют профиль
+(update_profile, update_profile_music, admin_add_units, бан, покупка подарка).
+"""
+import threading
+from collections import OrderedDict
+import server_config as cfg
+
+PROFILE_COLUMNS = ("id", "username", "discriminator", "avatar_color", "avatar_image", "nickname_color",
+                   "avatar_decoration", "units", "about_me", "banner_color", "banner_image", "custom_status",
+                   "profile_music")
+PROFILE_SQL = f"SELECT {', '.join(PROFILE_COLUMNS)} FROM users WHERE id IN ({{marks}})"
+QUERY_CHUNK = 500       # id на один SELECT ... IN (...)
+
+class ProfileCache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()    # user_id -> dict колонок PROFILE_COLUMNS
+        self.lock = threading.Lock()
+        self.generation = 0             # растёт при каждом сбросе
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, cur, user_ids):
+        """{int user_id: профиль} для существующих пользователей; недостающие читаются одним запросом"""
+        found, missing = {}, []
+        with self.lock:
+            for uid in dict.fromkeys(int(u) for u in user_ids):
+                profile = self.entries.get(uid)
+                if profile is None:
+                    missing.append(uid)
+                else:
+                    self.entries.move_to_end(uid)
+                    found[uid] = profile
+            self.hits += len(found)
+            self.misses += len(missing)
+            generation = self.generation
+        if not missing: return found
+
+        loaded = {}
+        for i in range(0, len(missing), QUERY_CHUNK):
+            chunk = missing[i:i + QUERY_CHUNK]
+            cur.execute(PROFILE_SQL.format(marks=",".join("?" * len(chunk))), chunk)
+            for row in cur.fetchall():
+                loaded[row[0]] = dict(zip(PROFILE_COLUMNS, row))
+        found.update(loaded)
+        if self.capacity <= 0: return found
+        with self.lock:
+            # Профиль изменился, пока шёл запрос - прочитанное могло устареть, не кешируем
+            if generation != self.generation: return found
+            self.entries.update(loaded)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return found
+
+    def get(self, cur, user_id):
+        return self.get_many(cur, (user_id,)).get(int(user_id))
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(int(user_id), None)
+            self.generation += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"size": len(self.entries), "capacity": self.capacity, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / total, 4) if total else 0.0}
+
+profile_cache = ProfileCache(cfg.PROFILE_CACHE_SIZE)
@@ -1,6 +1,7 @@
 import threading
 
-db_lock = threading.Lock()
+# Единственный путь записи в БД; чтения идут параллельно через read_pool
+db_write_lock = threading.Lock()
 clients_lock = threading.Lock()
-connected_clients = {}
+connected_clients = {}   # user_id -> ClientSession
 online_users = set()
\ No newline at end of file
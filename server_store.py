@@ -0,0 +1,197 @@
+"""
+Контентно-адресуемое хранилище загруженных файлов.
+
+Файл сохраняется один раз под своим SHA-256: server_files/store/ab/cd/<sha256>.
+Клиенты и БД видят имя "<sha256>.<ext>", поэтому одинаковые аватарки, стикеры
+и вложения занимают место на диске один раз.
+Таблица file_refs считает ссылки из БД (сообщения, профили, группы); файлы без
+ссылок удаляет команда gc.
+
+Старые имена вида "<timestamp>_<rand>.<ext>" продолжают открываться из server_files.
+Перенести их в хранилище: python server_store.py migrate
+"""
+import os
+import re
+import uuid
+import hashlib
+from datetime import datetime
+import server_config as cfg
+
+STORE_DIR = os.path.join(cfg.UPLOAD_DIR, "store")
+STORE_NAME_RE = re.compile(r"^([0-9a-f]{64})\.([A-Za-z0-9]{1,5})$")
+
+# Колонки БД, в которых лежат имена файлов из server_files
+FILE_COLUMNS = [
+    ("messages", "attachment_filename"),
+    ("users", "avatar_image"),
+    ("users", "banner_image"),
+    ("users", "avatar_decoration"),
+    ("users", "chat_bg"),
+    ("groups", "avatar_image"),
+    ("groups", "banner_image"),
+]
+
+def parse_name(name):
+    """Хеш из имени хранилища или None для старых имён / стикеров / NFT"""
+    m = STORE_NAME_RE.match(name) if isinstance(name, str) else None
+    return m.group(1) if m else None
+
+def blob_path(digest):
+    return os.path.join(STORE_DIR, digest[:2], digest[2:4], digest)
+
+def resolve(name):
+    """Путь к файлу по имени из БД: хранилище или (для старых имён) server_files"""
+    digest = parse_name(name)
+    if digest: return blob_path(digest)
+    return os.path.join(cfg.UPLOAD_DIR, name)
+
+def describe(name):
+    """Имя, размер и хеш файла для событий - вместо содержимого, которое клиент скачает сам"""
+    path = resolve(name)
+    size = os.path.getsize(path) if os.path.exists(path) else None
+    return {"att_file": name, "att_size": size, "att_hash": parse_name(name)}
+
+def _place(digest, write_tmp):
+    """Кладёт блоб на место атомарно; если такой уже есть - ничего не пишет"""
+    path = blob_path(digest)
+    if os.path.exists(path): return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    write_tmp(tmp)
+    os.replace(tmp, path)
+    return True
+
+def put_bytes(data, ext):
+    digest = hashlib.sha256(data).hexdigest()
+    def write_tmp(tmp):
+        with open(tmp, "wb") as f: f.write(data)
+    _place(digest, write_tmp)
+    return f"{digest}.{ext}"
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def put_file(src_path, ext, keep_source=False):
+    """Переносит (или копирует при keep_source) готовый файл в хранилище"""
+    digest = hash_file(src_path)
+    if keep_source:
+        def write_tmp(tmp):
+            with open(src_path, "rb") as src, open(tmp, "wb") as dst:
+                for chunk in iter(lambda: src.read(1024 * 1024), b""): dst.write(chunk)
+    else:
+        def write_tmp(tmp): os.replace(src_path, tmp)
+    if not _place(digest, write_tmp) and not keep_source:
+        os.remove(src_path)   # дубликат
+    return f"{digest}.{ext}"
+
+# --- REFERENCE COUNTS ---
+# Вызываются внутри транзакции писателя, вместе с изменением, которое
+# добавляет или убирает ссылку на файл.
+
+def add_ref(cur, name):
+    digest = parse_name(name)
+    if not digest: return
+    size = os.path.getsize(blob_path(digest)) if os.path.exists(blob_path(digest)) else None
+    cur.execute("""INSERT INTO file_refs (hash, size, refs, created_at) VALUES (?, ?, 1, ?)
+                   ON CONFLICT(hash) DO UPDATE SET refs = refs + 1""", (digest, size, str(datetime.now())))
+
+def release(cur, name):
+    digest = parse_name(name)
+    if not digest: return
+    cur.execute("UPDATE file_refs SET refs = MAX(refs - 1, 0) WHERE hash=?", (digest,))
+
+def replace_ref(cur, old_name, new_name):
+    if old_name == new_name: return
+    add_ref(cur, new_name)
+    release(cur, old_name)
+
+def recount_refs(cur):
+    """Пересчитывает file_refs по всем колонкам FILE_COLUMNS"""
+    counts = {}
+    for table, column in FILE_COLUMNS:
+        cur.execute(f"SELECT {column} FROM {table} WHERE {column} IS NOT NULL")
+        for (name,) in cur.fetchall():
+            digest = parse_name(name)
+            if digest: counts[digest] = counts.get(digest, 0) + 1
+    cur.execute("UPDATE file_refs SET refs = 0")
+    now = str(datetime.now())
+    for digest, refs in counts.items():
+        path = blob_path(digest)
+        size = os.path.getsize(path) if os.path.exists(path) else None
+        cur.execute("""INSERT INTO file_refs (hash, size, refs, created_at) VALUES (?, ?, ?, ?)
+                       ON CONFLICT(hash) DO UPDATE SET refs = excluded.refs""", (digest, size, refs, now))
+    return counts
+
+# --- MAINTENANCE ---
+
+def migrate_legacy_files(cur):
+    """
+    Переносит файлы из корня server_files в хранилище и переписывает ссылки в БД.
+    На старом месте остаётся жёсткая ссылка на блоб, чтобы закешированные у
+    клиентов старые имена продолжали открываться, не занимая места.
+    """
+    renamed, saved_bytes = {}, 0
+    for fname in os.listdir(cfg.UPLOAD_DIR):
+        path = os.path.join(cfg.UPLOAD_DIR, fname)
+        if not os.path.isfile(path) or parse_name(fname): continue
+        ext = os.path.splitext(fname)[1].lstrip(".") or "bin"
+        if not ext.isalnum() or len(ext) > 5: ext = "bin"
+        digest = hash_file(path)
+        existed = os.path.exists(blob_path(digest))
+        new_name = put_file(path, ext)
+        if existed: saved_bytes += os.path.getsize(blob_path(digest))
+        try:
+            os.link(blob_path(digest), path)
+        except OSError:
+            pass
+        renamed[fname] = new_name
+
+    for table, column in FILE_COLUMNS:
+        cur.executemany(f"UPDATE {table} SET {column}=? WHERE {column}=?",
+                        [(new, old) for old, new in renamed.items()])
+    recount_refs(cur)
+    return len(renamed), saved_bytes
+
+def collect_garbage(cur, min_age_seconds=24 * 3600):
+    """Удаляет блобы без ссылок (старше min_age_seconds, чтобы не задеть свежие загрузки)"""
+    recount_refs(cur)
+    cur.execute("SELECT hash FROM file_refs WHERE refs > 0")
+    referenced = {r[0] for r in cur.fetchall()}
+    if not os.path.exists(STORE_DIR): return 0, 0
+    removed, freed = 0, 0
+    now = datetime.now().timestamp()
+    for root, dirs, files in os.walk(STORE_DIR):
+        for f in files:
+            if f in referenced: continue
+            path = os.path.join(root, f)
+            if now - os.path.getmtime(path) < min_age_seconds: continue
+            freed += os.path.getsize(path)
+            os.remove(path)
+            removed += 1
+    cur.execute("DELETE FROM file_refs WHERE refs = 0")
+    return removed, freed
+
+if __name__ == "__main__":
+    import sys
+    import server_db as db_mod
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    db_mod.init_db()
+    with db_mod.writer() as db:
+        cur = db.cursor()
+        if command == "migrate":
+            moved, saved = migrate_legacy_files(cur)
+            print(f"Перенесено файлов: {moved}, дубликатов на {saved // 1024} KB")
+        elif command == "gc":
+            removed, freed = collect_garbage(cur)
+            print(f"Удалено блобов без ссылок: {removed} ({freed // 1024} KB)")
+        else:
+            recount_refs(cur)
+            cur.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refs), 0) FROM file_refs WHERE refs > 0")
+            blobs, size, refs = cur.fetchone()
+            print(f"Блобов: {blobs}, {size // 1024} KB, ссылок: {refs}")
+        db.commit()
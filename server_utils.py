@@ -1,8 +1,10 @@
 import json
 import struct
+import socket
+import threading
+from collections import deque
 import base64
 import os
-import random
 import hashlib
 import smtplib
 from email.mime.text import MIMEText
@@ -10,6 +12,124 @@ from email.mime.multipart import MIMEMultipart
 from datetime import datetime
 import server_config as cfg
 import server_state as state
+import server_store
+from server_logger import logger
+
+class ClientSession:
+    """
+    Состояние одного TCP-подключения и его исходящая очередь.
+    broadcast_* только кладут готовые кадры в очередь, в сокет их пишет
+    отдельный поток-писатель, поэтому медленный клиент никого не тормозит.
+    """
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.user_id = None
+        self.delta_events = False   # клиент просил message_* события вместо new_msg (connect_user)
+
+        self.max_queue = cfg.CLIENT_QUEUE_SIZE
+        self.pending = 0        # кадры в очереди, ещё не записанные в сокет
+        self.max_pending = 0
+        self.dropped = 0        # потерянные из-за переполнения события
+        self.slow = False
+        self.closed = False
+        self._lock = threading.Lock()
+        self._frames = deque()
+        self._ready = threading.Condition(self._lock)
+
+    def send_frame(self, frame, critical=False):
+        """
+        Ставит кадр в очередь. Ответы на запросы (critical=True) не теряются,
+        события при переполнении обрабатываются по SLOW_CLIENT_POLICY.
+        """
+        with self._lock:
+            if self.closed: return False
+            if self.pending >= self.max_queue and not critical:
+                self.dropped += 1
+                overflow = not self.slow
+                self.slow = True
+            else:
+                overflow = False
+                self.pending += 1
+                if self.pending > self.max_pending: self.max_pending = self.pending
+                self._push(frame)
+                return True
+        if overflow:
+            logger.warning(f"Slow client {self.user_id} at {self.addr}: queue full ({self.max_queue}), policy {cfg.SLOW_CLIENT_POLICY}")
+            if cfg.SLOW_CLIENT_POLICY == "disconnect": self.abort()
+        return False
+
+    def send_json(self, data, critical=False):
+        return self.send_frame(encode_frame(data), critical)
+
+    def frame_sent(self):
+        with self._lock:
+            self.pending -= 1
+
+    def stats(self):
+        return {"addr": str(self.addr), "queue": self.pending, "max_queue": self.max_pending,
+                "dropped": self.dropped, "slow": self.slow}
+
+    # --- Потоковое ядро: очередь в памяти + поток-писатель ---
+
+    def _push(self, frame):
+        self._frames.append(frame)
+        self._ready.notify()
+
+    def start_writer(self):
+        self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer.start()
+
+    def _writer_loop(self):
+        # Сокет закрывает писатель: так кадры, поставленные до close(), успевают уйти
+        try:
+            while True:
+                with self._lock:
+                    while not self._frames and not self.closed:
+                        self._ready.wait()
+                    if not self._frames: return
+                    frame = self._frames.popleft()
+                try:
+                    self.conn.sendall(frame)
+                except OSError:
+                    self.abort()
+                    return
+                self.frame_sent()
+        finally:
+            try: self.conn.close()
+            except OSError: pass
+
+    def close_and_drain(self, timeout):
+        """
+        Закрывает сессию, дав писателю дописать очередь не дольше timeout секунд;
+        если клиент не читает, соединение разрывается. Сокет закрывает сам писатель.
+        """
+        self.close()
+        writer = getattr(self, "_writer", None)
+        if writer is None:
+            self.conn.close()
+            return
+        writer.join(timeout)
+        if writer.is_alive():
+            self.abort()
+            writer.join(1)
+
+    def close(self):
+        """Останавливает писателя после отправки уже поставленных кадров"""
+        with self._lock:
+            self.closed = True
+            self._ready.notify()
+
+    def abort(self):
+        """Разрывает соединение: читающий поток получит EOF и выполнит очистку"""
+        self.close()
+        try: self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+def encode_frame(data):
+    """JSON + 4-байтовый префикс длины; кодируется один раз на любое число получателей"""
+    msg = json.dumps(data).encode('utf-8')
+    return struct.pack('>I', len(msg)) + msg
 
 def send_json(conn, data):
     try:
@@ -35,17 +155,31 @@ def recv_json(conn):
     except: return None
 
 def save_file_to_disk(b64_data, file_ext="png"):
+    """Кладёт файл в контентно-адресуемое хранилище; одинаковое содержимое не дублируется"""
     try:
-        file_data = base64.b64decode(b64_data)
-        filename = f"{datetime.now().timestamp()}_{random.randint(1000,9999)}.{file_ext}"
-        filepath = os.path.join(cfg.UPLOAD_DIR, filename)
-        with open(filepath, "wb") as f:
-            f.write(file_data)
-        return filename
+        return server_store.put_bytes(base64.b64decode(b64_data), file_ext)
     except Exception as e:
         print(f"Save error: {e}")
         return None
 
+def move_file_to_uploads(src_path, file_ext):
+    """Переносит собранный файл (чанковая загрузка) в хранилище"""
+    return server_store.put_file(src_path, file_ext)
+
+def read_file_chunk(path, offset, length):
+    """
+    Читает кусок файла, не загружая его целиком.
+    Возвращает (b64, размер файла, прочитано байт) или (None, None, 0)
+    """
+    if not path or not os.path.isfile(path) or length <= 0: return None, None, 0
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(offset)
+            data = f.read(length)
+            return base64.b64encode(data).decode('utf-8'), size, len(data)
+    except: return None, None, 0
+
 def load_file_b64(path):
     if not path or not os.path.exists(path): return None
     try:
@@ -119,13 +253,21 @@ def send_email(to, code):
         print(f"Email send error: {e}")
 
 def broadcast_to_user(user_id, message):
-    with state.clients_lock:
-        if user_id in state.connected_clients:
-            try: send_json(state.connected_clients[user_id], message)
-            except: pass
+    session = state.connected_clients.get(user_id)
+    if session: session.send_frame(encode_frame(message))
+
+def broadcast_to_users(user_ids, message):
+    """Одно событие нескольким пользователям: JSON кодируется один раз"""
+    frame = None
+    for user_id in user_ids:
+        session = state.connected_clients.get(user_id)
+        if session:
+            if frame is None: frame = encode_frame(message)
+            session.send_frame(frame)
 
 def broadcast_all(message):
+    frame = encode_frame(message)
     with state.clients_lock:
-        for uid, conn in state.connected_clients.items():
-            try: send_json(conn, message)
-            except: pass
\ No newline at end of file
+        sessions = list(state.connected_clients.values())
+    for session in sessions:
+        session.send_frame(frame)
\ No newline at end of file
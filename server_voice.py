@@ -1,77 +1,467 @@
 import socket
 import threading
 import struct
+import time
+from bisect import bisect_right
+from collections import deque
 import server_config as cfg
+import server_utils as utils
 from server_logger import logger
 
+try:
+    import numpy as np
+except ImportError:
+    np = None   # без numpy режим микширования недоступен, каналы работают пересылкой
+
+VOICE_PACKET_SIZE = 4096
+MIX_HEADER = struct.pack('>I', cfg.VOICE_MIX_SENDER_ID)
+
+# Границы корзин гистограммы джиттера: отклонение интервала между пакетами от длины кадра, мс
+JITTER_BOUNDS_MS = (2, 5, 10, 20, 40, 80)
+JITTER_BOUNDS = tuple(b / 1000 for b in JITTER_BOUNDS_MS)
+JITTER_LABELS = [f"<{b}" for b in JITTER_BOUNDS_MS] + [f">={JITTER_BOUNDS_MS[-1]}"]
+
+class VoiceStats:
+    """
+    Счётчики участника канала. Пишет их только поток-приёмник этого адреса
+    (с SO_REUSEPORT адрес всегда попадает в один сокет), поэтому без блокировок.
+    """
+    __slots__ = ("packets_in", "bytes_in", "packets_out", "bytes_out", "dropped", "last_arrival", "jitter")
+
+    def __init__(self):
+        self.packets_in = self.bytes_in = self.packets_out = self.bytes_out = self.dropped = 0
+        self.last_arrival = 0.0
+        self.jitter = [0] * len(JITTER_LABELS)
+
+    def add(self, other):
+        self.packets_in += other.packets_in
+        self.bytes_in += other.bytes_in
+        self.packets_out += other.packets_out
+        self.bytes_out += other.bytes_out
+        self.dropped += other.dropped
+        self.jitter = [a + b for a, b in zip(self.jitter, other.jitter)]
+
+    def as_dict(self):
+        return {"packets_in": self.packets_in, "bytes_in": self.bytes_in, "packets_out": self.packets_out,
+                "bytes_out": self.bytes_out, "dropped": self.dropped, "jitter_ms": dict(zip(JITTER_LABELS, self.jitter))}
+
+LEVEL_STRIDE = 8   # для оценки громкости берётся каждый 8-й сэмпл
+
+def frame_level(frame, size):
+    """
+    Дешёвая громкость кадра: средняя |амплитуда| по прореженным сэмплам.
+    PCM 16-bit в порядке байт машины (little-endian на x86/ARM, как у клиента).
+    """
+    if size < 2: return 0
+    samples = frame[:size & ~1].cast('h')[::LEVEL_STRIDE]
+    return sum(map(abs, samples)) // len(samples)
+
+class SpeakerFloor:
+    """
+    Кто сейчас говорит в канале. Тихие кадры (открытый микрофон) отбрасываются,
+    дальше пропускаются только VOICE_MAX_SPEAKERS самых громких говорящих.
+    Гистерезис: новый говорящий вытесняет самого тихого из активных, только если громче
+    его в VOICE_SPEAKER_SWITCH_RATIO раз и тот держит слот не меньше VOICE_SPEAKER_HOLD_MS.
+    """
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self.members = ()       # user_id участников, для событий voice_speaking
+        self.levels = {}        # user_id -> сглаженная громкость
+        self.active = {}        # user_id -> [начало слота, последний громкий кадр]
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def admit(self, user_id, level, now):
+        """Пропускать ли кадр дальше"""
+        hangover = cfg.VOICE_SILENCE_HANGOVER_MS / 1000
+        with self.lock:
+            prev = self.levels.get(user_id, level)
+            smooth = prev + (level - prev) * 0.3
+            self.levels[user_id] = smooth
+            slot = self.active.get(user_id)
+            if level < cfg.VOICE_SILENCE_LEVEL:
+                # Тишина: у активного говорящего пропускаем только хвост фразы
+                return slot is not None and now - slot[1] < hangover
+            if slot is not None:
+                slot[1] = now
+                return True
+            if not cfg.VOICE_MAX_SPEAKERS or len(self.active) < cfg.VOICE_MAX_SPEAKERS:
+                self.active[user_id] = [now, now]
+                self.changed = True
+                return True
+            weakest = min(self.active, key=lambda uid: self.levels.get(uid, 0))
+            since, last_voice = self.active[weakest]
+            louder = smooth > self.levels.get(weakest, 0) * cfg.VOICE_SPEAKER_SWITCH_RATIO
+            if (louder and now - since >= cfg.VOICE_SPEAKER_HOLD_MS / 1000) or now - last_voice >= hangover:
+                del self.active[weakest]
+                self.active[user_id] = [now, now]
+                self.changed = True
+                return True
+            return False
+
+    def set_members(self, members):
+        with self.lock:
+            self.members = tuple(members)
+            for uid in [u for u in self.levels if u not in members]: del self.levels[uid]
+            for uid in [u for u in self.active if u not in members]:
+                del self.active[uid]
+                self.changed = True
+
+    def speaking(self):
+        with self.lock:
+            return sorted(self.active)
+
+    def expire(self, now):
+        """Освобождает слоты замолчавших; возвращает новый список говорящих, если он изменился"""
+        hangover = cfg.VOICE_SILENCE_HANGOVER_MS / 1000
+        with self.lock:
+            for uid in [u for u, slot in self.active.items() if now - slot[1] >= hangover]:
+                del self.active[uid]
+                self.changed = True
+            if not self.changed: return None
+            self.changed = False
+            return sorted(self.active)
+
+class ChannelMixer:
+    """
+    Микширование группового канала: вместо N*(N-1) пересылок каждый слушатель
+    получает один пакет в такт VOICE_MIX_FRAME_MS - сумму всех говорящих без своего голоса.
+    Кадры - PCM 16-bit little-endian mono, как их шлёт клиент.
+    """
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self.listeners = ()     # ((user_id, addr), ...), обновляется в _rebuild_routes
+        self.queues = {}        # sender_id -> deque кадров
+        self.packets_out = self.bytes_out = 0
+        self.lock = threading.Lock()
+
+    def push(self, sender_id, frame):
+        with self.lock:
+            queue = self.queues.get(sender_id)
+            if queue is None:
+                queue = self.queues[sender_id] = deque(maxlen=cfg.VOICE_MIX_MAX_BACKLOG)
+            queue.append(frame)
+
+    def take_slot(self):
+        """По одному кадру от каждого говорящего; замолчавшие убираются"""
+        with self.lock:
+            slot = {}
+            for uid, queue in list(self.queues.items()):
+                if queue: slot[uid] = queue.popleft()
+                else: del self.queues[uid]
+            return slot
+
+    def mix(self):
+        """Пакеты этого такта: [(addr, packet)]"""
+        slot = self.take_slot()
+        if not slot: return []
+        speakers = list(slot)
+        samples = max(len(f) for f in slot.values()) // 2
+        frames = np.zeros((len(speakers), samples), dtype=np.int32)
+        for i, uid in enumerate(speakers):
+            pcm = np.frombuffer(slot[uid], dtype='<i2', count=len(slot[uid]) // 2)
+            frames[i, :len(pcm)] = pcm
+        total = frames.sum(axis=0)
+        # Говорящим - сумма без собственного голоса (одна векторная операция на всех),
+        # остальным - общая сумма, закодированная один раз
+        own = np.clip(total[None, :] - frames, -32768, 32767).astype('<i2')
+        common = MIX_HEADER + np.clip(total, -32768, 32767).astype('<i2').tobytes()
+        index = {uid: i for i, uid in enumerate(speakers)}
+        packets = []
+        for uid, addr in self.listeners:
+            i = index.get(uid)
+            if i is None: packets.append((addr, common))
+            elif len(speakers) > 1: packets.append((addr, MIX_HEADER + own[i].tobytes()))
+        return packets
+
 class VoiceServer:
     def __init__(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind((cfg.HOST, cfg.VOICE_PORT))
+        self.sock = None        # первый сокет; при VOICE_WORKERS > 1 их несколько на одном порту
+        self.sockets = []
         self.running = False
         
         # Mappings
         self.addr_to_user = {}  # (ip, port) -> user_id
         self.user_to_addr = {}  # user_id -> (ip, port)
         self.user_channels = {} # user_id -> channel_id (group_id or 'private_id')
+        self.channels = {}      # channel_id -> set(user_id)
+
+        # Готовые маршруты для горячего пути:
+        # addr отправителя -> (sender_id, адреса остальных участников, ChannelMixer или None, SpeakerFloor или None, VoiceStats).
+        # Значения неизменяемые и заменяются целиком под lock, поэтому _listen читает их без блокировки.
+        self.routes = {}
+        self.mixers = {}        # channel_id -> ChannelMixer для каналов в режиме микширования
+        self.floors = {}        # channel_id -> SpeakerFloor (если включён отбор говорящих)
+
+        # Телеметрия
+        self.stats = {}         # channel_id -> {user_id: VoiceStats}
+        self.departed = {}      # channel_id -> VoiceStats ушедших участников
+        self.unrouted = []      # по потоку-приёмнику: пакеты с неизвестных адресов
+        self.rates = {}         # ("channel"|"user", id) -> (pkt/s in, pkt/s out) за последний интервал сводки
         
         # Locks
         self.lock = threading.Lock()
 
+    def _open_socket(self, reuse_port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port: sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if cfg.VOICE_SOCKET_BUFFER:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, cfg.VOICE_SOCKET_BUFFER)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, cfg.VOICE_SOCKET_BUFFER)
+        sock.bind((cfg.HOST, cfg.VOICE_PORT))
+        return sock
+
     def start(self):
+        # Несколько сокетов на одном порту (SO_REUSEPORT): ядро раскладывает клиентов
+        # по сокетам по хешу адреса, и каждый сокет обслуживает свой поток.
+        workers = max(1, cfg.VOICE_WORKERS)
+        if workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+            logger.warning("SO_REUSEPORT недоступен, голосовой сервер работает в один поток")
+            workers = 1
+        self.sockets = [self._open_socket(workers > 1) for _ in range(workers)]
+        self.sock = self.sockets[0]
+        self.unrouted = [0] * workers
         self.running = True
-        logger.info(f"Voice Server started on UDP port {cfg.VOICE_PORT}")
-        threading.Thread(target=self._listen, daemon=True).start()
+        logger.info(f"Voice Server started on UDP port {cfg.VOICE_PORT} ({workers} worker(s))")
+        for worker, sock in enumerate(self.sockets):
+            threading.Thread(target=self._listen, args=(sock, worker), daemon=True).start()
+        if cfg.VOICE_STATS_LOG_SECONDS:
+            threading.Thread(target=self._stats_loop, daemon=True).start()
+        if cfg.VOICE_SILENCE_LEVEL:
+            threading.Thread(target=self._speaking_loop, daemon=True).start()
+        if cfg.VOICE_MIX_THRESHOLD:
+            if np is None:
+                logger.warning("numpy не установлен, микширование голосовых каналов отключено")
+            else:
+                threading.Thread(target=self._mix_loop, daemon=True).start()
 
-    def _listen(self):
+    def _listen(self, sock, worker=0):
+        # Буфер на поток выделяется один раз: данные читаются сразу после
+        # 4-байтового заголовка, заголовок дописывается на месте.
+        buf = bytearray(4 + VOICE_PACKET_SIZE)
+        view = memoryview(buf)
+        payload = view[4:]
+        recv_into, sendto = sock.recvfrom_into, sock.sendto
+        routes = self.routes
+        clock = time.monotonic
+        frame_interval = cfg.VOICE_MIX_FRAME_MS / 1000
+        unrouted = self.unrouted
         while self.running:
             try:
-                data, addr = self.sock.recvfrom(4096) # Standard MTU safe size
+                size, addr = recv_into(payload) # Standard MTU safe size
                 
                 # Protocol:
                 # 1. Handshake: "VOICE_INIT:{user_id}"
                 # 2. Audio Data: Raw Bytes
                 
-                if data.startswith(b"VOICE_INIT:"):
+                if size > 11 and payload[:11] == b"VOICE_INIT:":
                     try:
-                        user_id = int(data.decode().split(":")[1])
-                        with self.lock:
-                            self.addr_to_user[addr] = user_id
-                            self.user_to_addr[user_id] = addr
+                        self.register_addr(int(bytes(payload[11:size]).decode()), addr)
                         # logger.info(f"Voice registered user {user_id} at {addr}")
                     except: pass
                     continue
                 
                 # Handling Audio Data
-                with self.lock:
-                    sender_id = self.addr_to_user.get(addr)
-                    if not sender_id: continue
-                    
-                    channel_id = self.user_channels.get(sender_id)
-                    if not channel_id: continue
-                    
-                    # Broadcast to others in same channel
-                    # Packet format to client: [Sender ID (4 bytes)][Audio Data]
-                    packet = struct.pack('>I', sender_id) + data
-                    
-                    for uid, cid in self.user_channels.items():
-                        if cid == channel_id and uid != sender_id:
-                            target_addr = self.user_to_addr.get(uid)
-                            if target_addr:
-                                self.sock.sendto(packet, target_addr)
+                # Packet format to client: [Sender ID (4 bytes)][Audio Data]
+                route = routes.get(addr)
+                if not route:
+                    unrouted[worker] += 1
+                    continue
+                sender_id, targets, mixer, floor, stats = route
+                now = clock()
+                stats.packets_in += 1
+                stats.bytes_in += size
+                if stats.last_arrival:
+                    stats.jitter[bisect_right(JITTER_BOUNDS, abs(now - stats.last_arrival - frame_interval))] += 1
+                stats.last_arrival = now
+                if floor is not None and not floor.admit(sender_id, frame_level(payload, size), now):
+                    stats.dropped += 1
+                    continue
+                if mixer is not None:
+                    mixer.push(sender_id, bytes(payload[:size]))
+                    continue
+                if not targets: continue
+                struct.pack_into('>I', buf, 0, sender_id)
+                packet = view[:4 + size]
+                for target_addr in targets:
+                    sendto(packet, target_addr)
+                stats.packets_out += len(targets)
+                stats.bytes_out += (4 + size) * len(targets)
                                 
             except Exception as e:
-                logger.error(f"Voice server error: {e}")
+                if self.running: logger.error(f"Voice server error: {e}")
+
+    def _mix_loop(self):
+        interval = cfg.VOICE_MIX_FRAME_MS / 1000
+        next_tick = time.perf_counter()
+        while self.running:
+            for mixer in list(self.mixers.values()):
+                try:
+                    for addr, packet in mixer.mix():
+                        self.sock.sendto(packet, addr)
+                        mixer.packets_out += 1
+                        mixer.bytes_out += len(packet)
+                except Exception as e:
+                    logger.error(f"Voice mix error in {mixer.channel_id}: {e}")
+            next_tick += interval
+            delay = next_tick - time.perf_counter()
+            if delay > 0: time.sleep(delay)
+            else: next_tick = time.perf_counter()   # отстали - не догоняем пачкой тактов
+
+    def _speaking_loop(self):
+        """Освобождает слоты замолчавших и рассылает voice_speaking при изменении списка говорящих"""
+        while self.running:
+            time.sleep(cfg.VOICE_SPEAKING_EVENT_MS / 1000)
+            now = time.monotonic()
+            for floor in list(self.floors.values()):
+                speakers = floor.expire(now)
+                if speakers is not None:
+                    utils.broadcast_to_users(floor.members, {"event": "voice_speaking", "chat_id": floor.channel_id, "speakers": speakers})
+
+    # --- TELEMETRY ---
+
+    def get_stats(self):
+        """Счётчики по каналам и участникам; pps_* - за последний интервал сводки"""
+        with self.lock:
+            snapshot = {cid: dict(members) for cid, members in self.stats.items()}
+            departed = dict(self.departed)
+            mixers = dict(self.mixers)
+        channels, users = {}, {}
+        for cid, members in snapshot.items():
+            total = VoiceStats()
+            if cid in departed: total.add(departed[cid])
+            for uid, st in members.items():
+                total.add(st)
+                users[uid] = dict(st.as_dict(), channel=cid)
+                users[uid]["pps_in"], users[uid]["pps_out"] = self.rates.get(("user", uid), (0, 0))
+            if cid in mixers:
+                total.packets_out += mixers[cid].packets_out
+                total.bytes_out += mixers[cid].bytes_out
+            channels[cid] = dict(total.as_dict(), members=len(members), mode="mix" if cid in mixers else "forward")
+            channels[cid]["pps_in"], channels[cid]["pps_out"] = self.rates.get(("channel", cid), (0, 0))
+        return {"channels": channels, "users": users, "unrouted": sum(self.unrouted)}
+
+    def _stats_loop(self):
+        """Раз в VOICE_STATS_LOG_SECONDS считает скорости и пишет строку-сводку в лог"""
+        previous, last_time = {}, time.monotonic()
+        while self.running:
+            time.sleep(cfg.VOICE_STATS_LOG_SECONDS)
+            now = time.monotonic()
+            elapsed, last_time = now - last_time, now
+            stats = self.get_stats()
+            current, rates = {}, {}
+            total_in = total_out = dropped = 0
+            top_sender = None
+            for kind, items in (("channel", stats["channels"]), ("user", stats["users"])):
+                for key, st in items.items():
+                    counters = (st["packets_in"], st["packets_out"], st["dropped"])
+                    prev = previous.get((kind, key), (0, 0, 0))
+                    current[(kind, key)] = counters
+                    pps_in, pps_out = (counters[0] - prev[0]) / elapsed, (counters[1] - prev[1]) / elapsed
+                    rates[(kind, key)] = (round(pps_in, 1), round(pps_out, 1))
+                    if kind == "channel":
+                        total_in += pps_in
+                        total_out += pps_out
+                        dropped += counters[2] - prev[2]
+                    elif top_sender is None or pps_in > top_sender[1]:
+                        top_sender = (key, pps_in)
+            self.rates, previous = rates, current
+            if not stats["channels"]: continue
+            logger.info(f"Voice: {len(stats['channels'])} channels, {len(stats['users'])} users, "
+                        f"in {total_in:.0f} pkt/s, out {total_out:.0f} pkt/s, dropped {dropped}, unrouted {stats['unrouted']}"
+                        + (f", top sender {top_sender[0]} ({top_sender[1]:.0f} pkt/s)" if top_sender else ""))
+
+    def get_speaking(self, channel_id):
+        floor = self.floors.get(channel_id)
+        return floor.speaking() if floor else []
+
+    def stop(self):
+        self.running = False
+        for sock in self.sockets:
+            try: sock.close()
+            except: pass
+        self.sockets = []
+
+    # --- CHANNEL INDEX ---
+    # Вызываются под self.lock
+
+    def _should_mix(self, channel_id, members):
+        # Личные звонки (private_a_b) всегда идут пересылкой
+        return (np is not None and cfg.VOICE_MIX_THRESHOLD > 0 and not channel_id.startswith("private_")
+                and len(members) >= cfg.VOICE_MIX_THRESHOLD)
+
+    def _rebuild_routes(self, channel_id):
+        """Пересчитывает маршруты всех участников канала"""
+        members = self.channels.get(channel_id, ())
+        addrs = {uid: self.user_to_addr[uid] for uid in members if uid in self.user_to_addr}
+        mixer = None
+        if self._should_mix(channel_id, members):
+            mixer = self.mixers.get(channel_id) or ChannelMixer(channel_id)
+            mixer.listeners = tuple(addrs.items())
+            self.mixers[channel_id] = mixer
+        else:
+            self.mixers.pop(channel_id, None)
+        channel_stats = self.stats.setdefault(channel_id, {}) if members else {}
+        floor = None
+        if cfg.VOICE_SILENCE_LEVEL and members:
+            floor = self.floors.get(channel_id) or SpeakerFloor(channel_id)
+            floor.set_members(members)
+            self.floors[channel_id] = floor
+        else:
+            self.floors.pop(channel_id, None)
+        for uid, addr in addrs.items():
+            if not uid: continue   # как и раньше, user_id 0 не вещает
+            targets = () if mixer else tuple(a for other, a in addrs.items() if other != uid)
+            stats = channel_stats.get(uid) or channel_stats.setdefault(uid, VoiceStats())
+            self.routes[addr] = (uid, targets, mixer, floor, stats)
+
+    def _drop_route(self, user_id):
+        addr = self.user_to_addr.get(user_id)
+        if addr: self.routes.pop(addr, None)
+
+    def register_addr(self, user_id, addr):
+        with self.lock:
+            old_addr = self.user_to_addr.get(user_id)
+            if old_addr and old_addr != addr:
+                self.addr_to_user.pop(old_addr, None)
+                self.routes.pop(old_addr, None)
+            self.addr_to_user[addr] = user_id
+            self.user_to_addr[user_id] = addr
+            channel_id = self.user_channels.get(user_id)
+            if channel_id: self._rebuild_routes(channel_id)
+
+    def _remove_from_channel(self, user_id):
+        channel_id = self.user_channels.pop(user_id, None)
+        if channel_id is None: return None
+        self._drop_route(user_id)
+        members = self.channels.get(channel_id)
+        if members is not None:
+            members.discard(user_id)
+            if not members: del self.channels[channel_id]
+        # Счётчики ушедшего остаются в итогах канала, пока в нём кто-то есть
+        stats = self.stats.get(channel_id, {}).pop(user_id, None)
+        if stats: self.departed.setdefault(channel_id, VoiceStats()).add(stats)
+        if channel_id not in self.channels:
+            self.stats.pop(channel_id, None)
+            self.departed.pop(channel_id, None)
+        self._rebuild_routes(channel_id)
+        return channel_id
+
+    def get_channel_members(self, channel_id):
+        with self.lock:
+            return list(self.channels.get(channel_id, ()))
 
     def join_channel(self, user_id, channel_id):
         with self.lock:
+            self._remove_from_channel(user_id)
             self.user_channels[user_id] = channel_id
+            self.channels.setdefault(channel_id, set()).add(user_id)
+            self._rebuild_routes(channel_id)
             logger.info(f"User {user_id} joined voice channel {channel_id}")
 
     def leave_channel(self, user_id):
         with self.lock:
-            if user_id in self.user_channels:
-                del self.user_channels[user_id]
+            if self._remove_from_channel(user_id) is not None:
                 logger.info(f"User {user_id} left voice channel")
 
 # Global instance